@@ -0,0 +1,89 @@
+#!/usr/bin/python
+""" Pi Garage Alert event encoding benchmark
+
+Compares the cost of building and encoding one alert event with the
+compiled EventEncoder formats against the old path, which built a dict,
+called time.strftime and ran it through demjson.encode for every alert.
+
+Results are printed as one JSON object per line.
+
+Usage: bench_encoder.py [recipients_per_alert]
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'etc'))
+sys.path.insert(0, os.path.join(HERE, '..', 'bin'))
+
+import pi_garage_alert as pga
+
+try:
+    import demjson
+except ImportError:
+    demjson = None
+
+# Minimum wall clock time to spend measuring each case
+MIN_SECONDS = 1.0
+
+def demjson_event(door, state, time_in_state):
+    """The event encoding used before EventEncoder"""
+    stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime())
+    event = {
+        'timestamp': stamp,
+        'door': door,
+        'state': state,
+        'time': time_in_state,
+    }
+    return str(demjson.encode(event))
+
+def measure(func):
+    """Return the average microseconds per call of func"""
+    calls = 0
+    start = time.time()
+    while time.time() - start < MIN_SECONDS:
+        for _ in range(100):
+            func()
+        calls += 100
+    return (time.time() - start) / calls * 1e6
+
+def main():
+    """Run the benchmark"""
+    logging.basicConfig(level=logging.WARNING)
+    recipients = 5
+    if len(sys.argv) > 1:
+        recipients = int(sys.argv[1])
+
+    encoder = pga.EventEncoder()
+    encoder.compile([{'name': "Garage Door 1"}])
+
+    def encoded(event_format):
+        """Create an event and fetch its payload once per recipient"""
+        def run():
+            event = encoder.create("Garage Door 1", 'open', 600)
+            for _ in range(recipients):
+                event.payload(event_format)
+        return run
+
+    cases = [(event_format, encoded(event_format)) for event_format in pga.EventEncoder.FORMATS]
+
+    if demjson is not None:
+        cases.insert(0, ('demjson', lambda: demjson_event("Garage Door 1", 'open', 600)))
+    else:
+        sys.stderr.write("demjson is not installed - skipping the demjson baseline\n")
+
+    for name, func in cases:
+        print(json.dumps({
+            'benchmark': 'encoder',
+            'format': name,
+            'recipients': recipients,
+            'us_per_alert': round(measure(func), 3),
+        }, sort_keys=True))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
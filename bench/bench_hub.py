@@ -0,0 +1,245 @@
+#!/usr/bin/python
+""" Pi Garage Alert hub ingest benchmark
+
+Runs the hub in-process with sink alert senders, sends it forwarded door
+events over UDP from separate processes at --rate events per second in
+total, and measures how many events per second are received and evaluated
+by the shards. A --rate of 0 sends as fast as possible.
+
+Results are printed as one JSON object per line. Events sent but never
+received are reported as lost, and events received but never evaluated
+as unprocessed; the benchmark exits with status 1 if any run dropped
+events either way, since the throughput of a lossy run is not the hub's.
+Lower --rate until no events are lost to find the load the hub sustains.
+
+Before the benchmark, events are forwarded from sites in time zones either
+side of the hub's, and each is checked to fall due in a shard at its own
+deadline, with the right time in state. The benchmark exits with status 1
+if any is not.
+
+Usage: bench_hub.py [--events 200000] [--doors 1000] [--shards 1,2,4]
+                    [--senders 2] [--rate 20000]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+import simulation
+from simulation import pga
+
+def free_port():
+    """Return a UDP port that is free right now"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+# Site time zones for the time zone check, behind and ahead of any hub
+SITE_ZONES = ('Pacific/Honolulu', 'Pacific/Kiritimati')
+
+# Seconds a door has been open when its event is forwarded, and after which
+# its alert is due, in the time zone check
+OPENED_AGO = 2
+ALERT_AFTER = 5
+
+class Capture(object):
+    """Stands in for the Mqtt sender of a HubForwarder, keeping the last
+    payload"""
+
+    def __init__(self):
+        self.payload = None
+
+    def send(self, topic, payload, retain):
+        # pylint: disable=unused-argument
+        self.payload = payload
+
+def forward(site, door, state, when):
+    """Return the payload a HubForwarder at site sends for a transition"""
+    pga.cfg.HUB_SITE = site
+    pga.cfg.HUB_FORWARD_ADDRESS = None
+    pga.cfg.HUB_FORWARD_TOPIC = 'garage/events'
+    capture = Capture()
+    pga.HubForwarder(capture).door_changed(door, state, when, 0)
+    return capture.payload
+
+def make_payloads(doors, count, offset):
+    """Return count event payloads that alternate the state of each door"""
+    now = time.time()
+    payloads = []
+    for index in range(count):
+        site = "site%d" % ((index + offset) % doors)
+        state = ('open', 'closed')[(index // doors) % 2]
+        payloads.append(forward(site, 'Door', state, now).encode('utf-8'))
+    return payloads
+
+def check_time_zones():
+    """Forward a door opening from sites in other time zones to a shard
+    and check when its alert falls due
+
+    Returns:
+        True if every alert was sent at its deadline.
+    """
+    hub_zone = os.environ.get('TZ')
+    opened = time.time() - OPENED_AGO
+    payloads = dict()
+    try:
+        for zone in SITE_ZONES:
+            os.environ['TZ'] = zone
+            time.tzset()
+            payloads[zone] = forward(zone, 'Door', 'open', opened)
+    finally:
+        if hub_zone is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = hub_zone
+        time.tzset()
+
+    events = multiprocessing.Queue()
+    alerts = multiprocessing.Queue()
+    default_alerts = [{'state': 'open', 'time': ALERT_AFTER, 'recipients': ['sms:+10000000000']}]
+    shard = multiprocessing.Process(target=pga.run_hub_shard,
+                                    args=([], default_alerts, events, alerts, multiprocessing.Value('L', 0)))
+    shard.start()
+    events.put([pga.parse_hub_event(payload, dict()) for payload in payloads.values()])
+
+    received = dict()
+    deadline = opened + ALERT_AFTER + 2
+    while len(received) < len(payloads) and time.time() < deadline:
+        try:
+            _, _, door, _, time_in_state, stamp = alerts.get(timeout=max(deadline - time.time(), 0))
+        except pga.queue.Empty:
+            break
+        received[door] = (time_in_state, stamp)
+    events.put(None)
+    shard.join()
+
+    ok = True
+    for zone in SITE_ZONES:
+        time_in_state, stamp = received.get('%s/Door' % zone, (None, None))
+        passed = time_in_state == ALERT_AFTER and abs(stamp - (opened + ALERT_AFTER)) < 0.5
+        ok = ok and passed
+        print(json.dumps({
+            'check': 'time_zone',
+            'zone': zone,
+            'alert_after': ALERT_AFTER,
+            'time_in_state': time_in_state,
+            'late_ms': None if stamp is None else round((stamp - opened - ALERT_AFTER) * 1000, 1),
+            'passed': passed,
+        }, sort_keys=True))
+    sys.stdout.flush()
+    return ok
+
+def send_events(port, payloads, rate):
+    """Sender process: send every payload at rate payloads per second, or
+    as fast as possible if rate is 0"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start = time.time()
+    for index, payload in enumerate(payloads):
+        if rate:
+            delay = start + index / float(rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sock.sendto(payload, ('127.0.0.1', port))
+
+def bench(args, shards):
+    """Measure ingest with the given number of shard processes"""
+    port = free_port()
+    pga.cfg.HUB_UDP_PORT = port
+    pga.cfg.HUB_UDP_ADDRESS = '127.0.0.1'
+    pga.cfg.HUB_SHARDS = shards
+    pga.cfg.HUB_MQTT_TOPIC = None
+    pga.cfg.STATE_DIR = None
+    pga.cfg.HUB_DOORS = []
+    pga.cfg.HUB_DEFAULT_ALERTS = [{'state': 'open', 'time': 3600, 'recipients': ['sms:+10000000000']}]
+    for name, value in simulation.CHANNEL_ACCOUNTS.items():
+        setattr(pga.cfg, name, value)
+
+    calls = []
+    saved_backends = simulation.skip_channel_imports()
+    hub = pga.PiGarageAlertHub({'Twilio': lambda: simulation.SinkSender('Twilio', calls)})
+    thread = threading.Thread(target=hub.main, name="hub")
+    thread.start()
+    while hub.ingest is None:
+        if not thread.is_alive():
+            raise RuntimeError("Hub did not start")
+        time.sleep(0.01)
+
+    per_sender = args.events // args.senders
+    senders = [multiprocessing.Process(target=send_events,
+                                       args=(port, make_payloads(args.doors, per_sender, index * per_sender),
+                                             args.rate / float(args.senders)))
+               for index in range(args.senders)]
+
+    start = time.time()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    sent_time = time.time() - start
+
+    # Wait until the shards stop making progress
+    last = -1
+    while hub.events_processed() != last:
+        last = hub.events_processed()
+        time.sleep(0.2)
+    elapsed = time.time() - start - 0.2
+
+    received = hub.ingest.received
+    rejected = hub.ingest.rejected
+    hub.stop()
+    thread.join()
+    pga.ALERT_CHANNELS.update(saved_backends)
+
+    sent = per_sender * args.senders
+    print(json.dumps({
+        'benchmark': 'hub',
+        'shards': shards,
+        'doors': args.doors,
+        'senders': args.senders,
+        'rate': args.rate,
+        'sent': sent,
+        'sent_per_sec': round(sent / sent_time, 1),
+        'received': received,
+        'rejected': rejected,
+        'lost': sent - received,
+        'unprocessed': received - last,
+        'processed': last,
+        'processed_per_sec': round(last / elapsed, 1),
+    }, sort_keys=True))
+    sys.stdout.flush()
+    return sent - last
+
+def main():
+    """Run the benchmark for each shard count"""
+    parser = argparse.ArgumentParser(description="Pi Garage Alert hub ingest benchmark")
+    parser.add_argument('--events', type=int, default=200000, help="events to send (default 200000)")
+    parser.add_argument('--doors', type=int, default=1000, help="number of doors (default 1000)")
+    parser.add_argument('--shards', default='1,2,4', help="comma separated shard counts (default 1,2,4)")
+    parser.add_argument('--senders', type=int, default=2, help="sending processes (default 2)")
+    parser.add_argument('--rate', type=float, default=20000,
+                        help="events per second from all senders, 0 for no limit (default 20000)")
+    args = parser.parse_args()
+
+    if not check_time_zones():
+        sys.stderr.write("alerts for sites in other time zones were not sent at their deadline\n")
+        sys.exit(1)
+
+    lossy = []
+    for shards in [int(value) for value in args.shards.split(',')]:
+        if bench(args, shards):
+            lossy.append(shards)
+
+    if lossy:
+        sys.stderr.write("events were dropped with %s shards - lower --rate\n" %
+                         ', '.join(str(shards) for shards in lossy))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
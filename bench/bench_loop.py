@@ -0,0 +1,215 @@
+#!/usr/bin/python
+""" Pi Garage Alert monitoring loop benchmark
+
+Runs the whole daemon against the simulation harness and measures:
+    detection - time from a pin changing to the door monitor seeing it,
+                and CPU time per main loop tick (for the whole process, so
+                it includes the harness toggling the pins)
+    alerts    - how late each alert is sent relative to alert['time']
+    dispatch  - alerts per second through AlertDispatcher
+
+Results are printed as one JSON object per line.
+
+Usage: bench_loop.py [--doors 1,10,100] [--rate 20] [--duration 5]
+                     [--backend edge|poll] [--alert-time 0.5]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import simulation
+from simulation import pga
+
+def percentiles(values):
+    """Return the p50, p95, p99 and max of values in milliseconds"""
+    if not values:
+        return {}
+    values = sorted(values)
+    result = dict()
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        result[name + '_ms'] = round(values[min(int(len(values) * fraction), len(values) - 1)] * 1000, 3)
+    result['max_ms'] = round(values[-1] * 1000, 3)
+    return result
+
+def cpu_time():
+    """Return the user + system CPU time of this process"""
+    times = os.times()
+    return times[0] + times[1]
+
+def make_doors(count, alert_time=None):
+    """Return a GARAGE_DOORS list with pins 1..count"""
+    doors = []
+    for index in range(count):
+        alerts = []
+        if alert_time is not None:
+            alerts.append({'state': 'open', 'time': alert_time, 'recipients': ['sms:+10000000000']})
+        doors.append({'pin': index + 1, 'name': "Door %d" % index, 'alerts': alerts})
+    return doors
+
+def emit(result):
+    """Print one result line"""
+    print(json.dumps(result, sort_keys=True))
+    sys.stdout.flush()
+
+def bench_detection(args, count):
+    """Toggle random doors at args.rate per second and time their detection"""
+    doors = make_doors(count)
+    sim = simulation.Simulation(doors, {'SENSOR_BACKEND': args.backend})
+    sim.start()
+
+    # Give each door time to settle so no transition is missed in poll mode
+    min_gap = max(0.05, 5 * pga.cfg.SENSOR_POLL_INTERVAL)
+    states = dict((door['pin'], 'closed') for door in doors)
+    last_change = dict((door['pin'], 0) for door in doors)
+    changes = []
+
+    ticks = sim.app.ticks
+    cpu = cpu_time()
+    end = time.time() + args.duration
+    next_change = time.time()
+    while time.time() < end:
+        time.sleep(max(next_change - time.time(), 0))
+        next_change += 1.0 / args.rate
+
+        pin = random.choice(doors)['pin']
+        if time.time() - last_change[pin] < min_gap:
+            continue
+        states[pin] = 'open' if states[pin] == 'closed' else 'closed'
+        last_change[pin] = sim.set_door(pin, states[pin])
+        changes.append((last_change[pin], "Door %d" % (pin - 1), states[pin]))
+
+    time.sleep(min_gap)
+    cpu = cpu_time() - cpu
+    ticks = sim.app.ticks - ticks
+    sim.stop()
+
+    # Match each change to the first later detection of the same door and state
+    detected = dict()
+    for stamp, _, _, (name, state) in sim.calls_to('door_changed'):
+        detected.setdefault((name, state), []).append(stamp)
+
+    latencies = []
+    missed = 0
+    for stamp, name, state in changes:
+        seen = [when for when in detected.get((name, state), []) if when >= stamp]
+        if not seen:
+            missed += 1
+            continue
+        latencies.append(seen[0] - stamp)
+        detected[(name, state)].remove(seen[0])
+
+    result = {
+        'benchmark': 'detection',
+        'backend': args.backend,
+        'doors': count,
+        'transitions': len(changes),
+        'missed': missed,
+        'ticks': ticks,
+        'cpu_us_per_tick': round(cpu / max(ticks, 1) * 1e6, 2),
+    }
+    result.update(percentiles(latencies))
+    emit(result)
+
+def bench_alerts(args, count):
+    """Open every door once and measure how late its alert is"""
+    doors = make_doors(count, args.alert_time)
+    sim = simulation.Simulation(doors, {'SENSOR_BACKEND': args.backend})
+    sim.start()
+
+    opened = dict()
+    for door in doors:
+        opened[door['name']] = sim.set_door(door['pin'], 'open')
+        time.sleep(random.uniform(0, 0.01))
+
+    time.sleep(args.alert_time + 0.5)
+    sim.stop()
+
+    errors = []
+    for stamp, _, _, (_, msg) in sim.calls_to('send_sms'):
+        event = json.loads(msg)
+        if event['state'] == 'open':
+            errors.append(stamp - opened[event['door']] - args.alert_time)
+
+    result = {
+        'benchmark': 'alerts',
+        'backend': args.backend,
+        'doors': count,
+        'alert_time': args.alert_time,
+        'alerts': len(errors),
+        'missed': count - len(errors),
+    }
+    result.update(percentiles(errors))
+    emit(result)
+
+def bench_dispatch(args, count):
+    """Push alerts for count recipients through the dispatcher"""
+    # pylint: disable=unused-argument
+    # Measure the dispatcher itself, even if the config limits the rate
+    pga.cfg.ALERT_RATE_LIMITS = {}
+    pga.cfg.ALERT_DIGEST_WINDOW = {}
+
+    calls = []
+    senders = dict((name, simulation.SinkSender(name, calls)) for name in ('Email', 'Twilio', 'Mqtt'))
+    dispatcher = pga.AlertDispatcher(senders)
+
+    total = count * 100
+    start = time.time()
+    for index in range(total):
+        recipient = index % count
+        dispatcher.send_alert('Twilio', 'send_sms', '+1%010d' % recipient, 'Door', 'alert %d' % index)
+        dispatcher.send_alert('Mqtt', 'publish', 'garage/%d' % recipient, 'Door', 'alert %d' % index)
+        dispatcher.send_alert('Email', 'send_email', ('door%d@example.com' % recipient,), 'Door',
+                              'alert %d' % index)
+
+        # Stay under ALERT_QUEUE_SIZE so nothing is deferred
+        while dispatcher.queue_depth() > 50:
+            time.sleep(0.0001)
+
+    while len(calls) < total * 3 and time.time() - start < 60:
+        time.sleep(0.001)
+    elapsed = time.time() - start
+    dispatcher.shutdown(5)
+
+    emit({
+        'benchmark': 'dispatch',
+        'recipients': count,
+        'alerts': total * 3,
+        'delivered': len(calls),
+        'alerts_per_sec': round(len(calls) / elapsed, 1),
+    })
+
+BENCHMARKS = {
+    'detection': bench_detection,
+    'alerts': bench_alerts,
+    'dispatch': bench_dispatch,
+}
+
+def main():
+    """Run the selected benchmarks for each door count"""
+    parser = argparse.ArgumentParser(description="Pi Garage Alert monitoring loop benchmark")
+    parser.add_argument('--doors', default='1,10,100',
+                        help="comma separated door counts (default 1,10,100)")
+    parser.add_argument('--rate', type=float, default=20,
+                        help="door transitions per second (default 20)")
+    parser.add_argument('--duration', type=float, default=5,
+                        help="seconds to run the detection benchmark (default 5)")
+    parser.add_argument('--backend', default='edge', choices=('edge', 'poll'),
+                        help="sensor backend (default edge)")
+    parser.add_argument('--alert-time', type=float, default=0.5,
+                        help="alert['time'] in seconds for the alert benchmark (default 0.5)")
+    parser.add_argument('--only', choices=sorted(BENCHMARKS),
+                        help="run one benchmark")
+    args = parser.parse_args()
+    random.seed(1)
+
+    for count in [int(value) for value in args.doors.split(',')]:
+        for name in sorted(BENCHMARKS):
+            if args.only is None or args.only == name:
+                BENCHMARKS[name](args, count)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+""" Pi Garage Alert MQTT channel benchmark
+
+Runs the real Mqtt channel against FakeMqttBroker, a local broker stand-in,
+and measures:
+    publish - alerts published per second at each QoS, each waiting for
+              the broker's acknowledgement at QoS 1 and 2
+    offline - alerts sent through the dispatcher while the broker is down
+              wait in the outbox without using up attempts, and are each
+              delivered once as soon as it comes back
+    dropped - alerts published after the connection dropped but before
+              the channel noticed fail once --ack-timeout passes without
+              an acknowledgement, but QoS 1 and 2 alerts are still kept
+              by the client and each delivered once
+    state   - every door's retained state topic ends up holding its last
+              state
+
+Results are printed as one JSON object per line. Each result also reports
+the message ids still tracked by the channel, which should be 0.
+
+Usage: bench_mqtt.py [--messages 10000] [--ack-delay 0.001] [--ack-timeout 0.01]
+                     [--doors 50]
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+import simulation
+from simulation import pga
+
+def emit(result):
+    """Print one result line"""
+    print(json.dumps(result, sort_keys=True))
+    sys.stdout.flush()
+
+def create_channel(ack_delay, qos, ack_timeout=10):
+    """Return a FakeMqttBroker and an Mqtt channel connected to it"""
+    broker = simulation.install_fake_mqtt(ack_delay)
+    pga.cfg.ALERT_TIMEOUTS = {'Mqtt': ack_timeout}
+    pga.cfg.MQTT_HOST = 'localhost'
+    pga.cfg.MQTT_QOS = qos
+    pga.cfg.MQTT_STATE_TOPIC = 'garage/%s/state'
+    return broker, pga.Mqtt()
+
+def tracked(channel):
+    """Return the number of message ids the channel still holds"""
+    with channel.lock:
+        return len(channel.unacked) + len(channel.early_acks)
+
+def bench_publish(args):
+    """Publish alerts as fast as possible and wait for the acks"""
+    for qos in (0, 1, 2):
+        broker, channel = create_channel(args.ack_delay, qos)
+        start = time.time()
+        for index in range(args.messages):
+            channel.publish('garage/alerts', 'alert %d' % index)
+        published = time.time() - start
+        acked = channel.wait_for_acks(30)
+        elapsed = time.time() - start
+        channel.terminate()
+
+        emit({
+            'benchmark': 'publish',
+            'qos': qos,
+            'messages': args.messages,
+            'delivered': len(broker.messages),
+            'all_acked': acked,
+            'publish_per_sec': round(args.messages / published, 1),
+            'acked_ms': round(elapsed * 1000, 1),
+            'tracked': tracked(channel),
+        })
+
+def bench_offline(args):
+    """Send alerts through the dispatcher while the broker is down, then
+    bring it back"""
+    count = args.messages // 10
+
+    # The default backoff: reconnecting should send the alerts at once
+    pga.cfg.BREAKER_COOLDOWN = 60
+    pga.cfg.OUTBOX_RETRY_BASE = 30
+    pga.cfg.OUTBOX_RETRY_MAX = 1800
+
+    broker, channel = create_channel(args.ack_delay, 1)
+    dispatcher = pga.AlertDispatcher({'Mqtt': channel})
+    broker.set_online(False)
+    for index in range(count):
+        dispatcher.submit('Mqtt', 'publish', 'garage/alerts', 'alert %d' % index)
+    time.sleep(0.5)
+    failed = dispatcher.channels['Mqtt'].failed
+
+    start = time.time()
+    broker.set_online(True)
+    deadline = start + 60
+    while len(broker.messages) < count and time.time() < deadline:
+        time.sleep(0.001)
+    elapsed = time.time() - start
+    acked = channel.wait_for_acks(30)
+    with dispatcher.outbox.lock:
+        attempts = dispatcher.outbox.db.execute("SELECT SUM(attempts) FROM outbox").fetchone()[0]
+    dispatcher.shutdown(5)
+    channel.terminate()
+
+    expected = ['alert %d' % index for index in range(count)]
+    emit({
+        'benchmark': 'offline',
+        'messages': count,
+        'failed_while_offline': failed,
+        'breaker_rejected': dispatcher.channels['Mqtt'].breaker.rejected,
+        'attempts_used': attempts,
+        'delivered_once': sorted(message[1] for message in broker.messages) == sorted(expected),
+        'all_acked': acked,
+        'drain_ms': round(elapsed * 1000, 1),
+        'tracked': tracked(channel),
+    })
+
+def bench_dropped(args):
+    """Publish alerts while the connection is down but the channel still
+    thinks it is up, then bring the broker back"""
+    count = args.messages // 100
+    for qos in (0, 1, 2):
+        broker, channel = create_channel(args.ack_delay, qos, args.ack_timeout)
+        broker.set_online(False, notify=False)
+        failed = 0
+        for index in range(count):
+            try:
+                channel.publish('garage/alerts', 'alert %d' % index)
+            except pga.AlertError:
+                failed += 1
+        broker.set_online(True)
+        acked = channel.wait_for_acks(30)
+        channel.terminate()
+
+        expected = [] if qos == 0 else ['alert %d' % index for index in range(count)]
+        emit({
+            'benchmark': 'dropped',
+            'qos': qos,
+            'messages': count,
+            'failed': failed,
+            'delivered_once': sorted(message[1] for message in broker.messages) == sorted(expected),
+            'all_acked': acked,
+            'tracked': tracked(channel),
+        })
+
+def bench_state(args):
+    """Change every door's state several times, some of it while offline"""
+    broker, channel = create_channel(args.ack_delay, 1)
+    states = dict()
+    for index in range(args.doors * 4):
+        if index == args.doors * 2:
+            broker.set_online(False)
+        elif index == args.doors * 3:
+            broker.set_online(True)
+        name = "Door %d" % (index % args.doors)
+        states[name] = ('open', 'closed')[(index // args.doors) % 2]
+        channel.door_changed(name, states[name], time.time(), 0)
+    broker.set_online(True)
+    acked = channel.wait_for_acks(30)
+    channel.terminate()
+
+    emit({
+        'benchmark': 'state',
+        'doors': args.doors,
+        'retained_correct': broker.retained == dict(
+            ('garage/%s/state' % name, state) for name, state in states.items()),
+        'retained_flags': all(message[3] for message in broker.messages),
+        'all_acked': acked,
+        'tracked': tracked(channel),
+    })
+
+def main():
+    """Run every benchmark"""
+    parser = argparse.ArgumentParser(description="Pi Garage Alert MQTT channel benchmark")
+    parser.add_argument('--messages', type=int, default=10000, help="alerts to publish (default 10000)")
+    parser.add_argument('--ack-delay', type=float, default=0.001,
+                        help="seconds the broker takes to acknowledge a message (default 0.001)")
+    parser.add_argument('--ack-timeout', type=float, default=0.01,
+                        help="seconds an alert waits for its acknowledgement in the dropped benchmark "
+                             "(default 0.01)")
+    parser.add_argument('--doors', type=int, default=50, help="doors in the state benchmark (default 50)")
+    args = parser.parse_args()
+
+    # The offline benchmark makes alerts fail on purpose
+    logging.basicConfig(level=logging.CRITICAL)
+
+    bench_publish(args)
+    bench_offline(args)
+    bench_dropped(args)
+    bench_state(args)
+
+if __name__ == "__main__":
+    main()
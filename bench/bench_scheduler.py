@@ -0,0 +1,161 @@
+#!/usr/bin/python
+""" Pi Garage Alert scheduler benchmark
+
+Measures the cost of one main loop tick with thousands of simulated doors,
+comparing the deadline heap used by DoorMonitor with the old approach of
+checking every door on every tick. Both run the same door changes for the
+same number of ticks, and both send the alerts and the "now closed" reset
+alerts, so they must send the same number of alerts.
+
+Results are printed as one JSON object per line. Exits with status 1 if
+the two approaches sent different numbers of alerts.
+
+Usage: bench_scheduler.py [door_count ...]
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'etc'))
+sys.path.insert(0, os.path.join(HERE, '..', 'bin'))
+
+import pi_garage_alert as pga
+
+# Doors that change state on each tick
+CHANGES_PER_TICK = 5
+
+# Simulated seconds between ticks
+TICK_SECONDS = 30
+
+# Ticks per case times the number of doors, so cases with many doors run
+# fewer ticks (but at least 3)
+TOTAL_DOOR_TICKS = 200000
+
+def make_doors(count):
+    """Return a GARAGE_DOORS style list of simulated doors"""
+    doors = []
+    for index in range(count):
+        doors.append({
+            'pin': index,
+            'name': "Door %d" % index,
+            'alerts': [
+                {'state': 'open', 'time': random.randint(60, 600), 'recipients': []},
+                {'state': 'open', 'time': random.randint(600, 3600), 'recipients': []},
+            ]
+        })
+    return doors
+
+def toggle(state):
+    """Return the opposite door state"""
+    if state == 'open':
+        return 'closed'
+    return 'open'
+
+def make_plan(doors):
+    """Return the initial state of every door and the names of the doors
+    that change on each tick, so both approaches see the same inputs"""
+    ticks = max(3, TOTAL_DOOR_TICKS // len(doors))
+    initial = dict((door['name'], random.choice(('open', 'closed'))) for door in doors)
+    changes = [[door['name'] for door in random.sample(doors, CHANGES_PER_TICK)] for _ in range(ticks)]
+    return initial, changes
+
+def bench_heap(doors, plan):
+    """Time ticks of DoorMonitor with its deadline heap"""
+    initial, changes = plan
+    sent = []
+    monitor = pga.DoorMonitor(lambda recipients, subject, msg: sent.append(subject))
+    now = 0.0
+    for door in doors:
+        monitor.add_door(door, initial[door['name']], now)
+
+    start = time.time()
+    for changed in changes:
+        now += TICK_SECONDS
+        for name in changed:
+            monitor.update(name, toggle(monitor.door_states[name]), now, now)
+        monitor.run_due(now)
+        monitor.next_deadline()
+
+    return len(changes), time.time() - start, len(sent)
+
+def bench_scan(doors, plan):
+    """Time ticks of the old loop that checks every door every tick"""
+    initial, changes = plan
+    sent = []
+    door_states = dict(initial)
+    time_of_last_state_change = dict()
+    alert_states = dict()
+    now = 0.0
+    for door in doors:
+        time_of_last_state_change[door['name']] = now
+        alert_states[door['name']] = 0
+
+    start = time.time()
+    for changed in changes:
+        now += TICK_SECONDS
+        changed = set(changed)
+        for door in doors:
+            name = door['name']
+            state = door_states[name]
+            if name in changed:
+                state = toggle(state)
+            time_in_state = now - time_of_last_state_change[name]
+
+            if door_states[name] != state:
+                door_states[name] = state
+                time_of_last_state_change[name] = now
+                # Reset alert, as DoorMonitor.update() does
+                if alert_states[name] > 0:
+                    sent.append(pga.create_event(name, state, round(time_in_state)))
+                alert_states[name] = 0
+                time_in_state = 0
+
+            # Due once time_in_state reaches the alert's time, as in
+            # next_alert_deadline()
+            if len(door['alerts']) > alert_states[name]:
+                alert = door['alerts'][alert_states[name]]
+                if time_in_state >= alert['time'] and state == alert['state']:
+                    sent.append(pga.create_event(name, state, round(time_in_state)))
+                    alert_states[name] += 1
+
+    return len(changes), time.time() - start, len(sent)
+
+def main():
+    """Run the benchmark for each door count"""
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(1)
+
+    counts = [int(arg) for arg in sys.argv[1:]] or [10, 1000, 100000]
+    mismatched = []
+    for count in counts:
+        doors = make_doors(count)
+        plan = make_plan(doors)
+        sent = dict()
+        for impl, func in (('heap', bench_heap), ('scan', bench_scan)):
+            ticks, elapsed, alerts = func(doors, plan)
+            sent[impl] = alerts
+            print(json.dumps({
+                'benchmark': 'scheduler',
+                'impl': impl,
+                'doors': count,
+                'changes_per_tick': CHANGES_PER_TICK,
+                'ticks': ticks,
+                'alerts': alerts,
+                'us_per_tick': round(elapsed / ticks * 1e6, 2),
+            }, sort_keys=True))
+            sys.stdout.flush()
+        if sent['heap'] != sent['scan']:
+            mismatched.append(count)
+
+    if mismatched:
+        sys.stderr.write("heap and scan sent different numbers of alerts with %s doors\n" %
+                         ', '.join(str(count) for count in mismatched))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+""" Pi Garage Alert sensor read benchmark
+
+Runs the mmap sensor backend against a plain file standing in for
+/dev/gpiomem, and measures:
+    read    - time to read every door sensor once, with the mmap backend
+              (one register read) and the poll backend (one GPIO.input()
+              call per door, against FakeGPIO)
+    latency - time from a bit changing in the level register to the
+              backend reporting the transition
+
+Results are printed as one JSON object per line.
+
+Usage: bench_sensor.py [--doors 1,10,28] [--interval 0.005] [--rate 50]
+                       [--duration 5]
+"""
+
+import argparse
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from simulation import pga
+
+class FakeRegisters(object):
+    """File standing in for /dev/gpiomem, with a writable mapping to
+    change pin levels through"""
+
+    def __init__(self):
+        handle, self.path = tempfile.mkstemp(prefix='gpiomem')
+        os.write(handle, b'\0' * 4096)
+        self.mem = mmap.mmap(handle, 4096)
+        os.close(handle)
+        self.offset = pga.cfg.SENSOR_GPIO_LEVEL_OFFSET
+
+    def set_level(self, pin, level):
+        """Set the level of a header pin
+
+        Returns:
+            time.time() of the change.
+        """
+        bit = 1 << pga.BOARD_TO_BCM[pin]
+        value = struct.unpack_from('<I', self.mem, self.offset)[0]
+        value = value | bit if level else value & ~bit
+        struct.pack_into('<I', self.mem, self.offset, value)
+        return time.time()
+
+    def close(self):
+        """Delete the file"""
+        self.mem.close()
+        os.remove(self.path)
+
+def percentiles(values):
+    """Return the p50, p95, p99 and max of values in milliseconds"""
+    if not values:
+        return {}
+    values = sorted(values)
+    result = dict()
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        result[name + '_ms'] = round(values[min(int(len(values) * fraction), len(values) - 1)] * 1000, 3)
+    result['max_ms'] = round(values[-1] * 1000, 3)
+    return result
+
+def emit(result):
+    """Print one result line"""
+    print(json.dumps(result, sort_keys=True))
+    sys.stdout.flush()
+
+def header_pins(count):
+    """Return the first count GPIO header pins"""
+    return sorted(pga.BOARD_TO_BCM)[:count]
+
+def bench_read(args, count):
+    """Time reading every door sensor once"""
+    # pylint: disable=unused-argument
+    pins = header_pins(count)
+    registers = FakeRegisters()
+    pga.cfg.SENSOR_GPIOMEM = registers.path
+    pga.cfg.SENSOR_POLL_INTERVAL = 1
+
+    for name in ('mmap', 'poll'):
+        sensor = pga.create_sensor_backend(name)
+        sensor.setup(pins)
+        reads = 20000
+        start = time.time()
+        for _ in range(reads):
+            sensor.read_all(pins)
+        elapsed = time.time() - start
+        sensor.cleanup()
+
+        emit({
+            'benchmark': 'read',
+            'backend': name,
+            'doors': count,
+            'us_per_read_all': round(elapsed / reads * 1e6, 2),
+        })
+    registers.close()
+
+def bench_latency(args, count):
+    """Toggle random pins and time how long the backend takes to notice"""
+    pins = header_pins(count)
+    registers = FakeRegisters()
+    pga.cfg.SENSOR_GPIOMEM = registers.path
+    pga.cfg.SENSOR_POLL_INTERVAL = args.interval
+
+    sensor = pga.create_sensor_backend('mmap')
+    sensor.setup(pins)
+    detected = []
+    stopping = []
+
+    def consume():
+        """Collect the reported transitions"""
+        while not stopping:
+            for pin, stamp in sensor.wait(0.1).items():
+                detected.append((pin, stamp))
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+
+    # Leave each pin alone for a few intervals so no change is missed
+    min_gap = 3 * args.interval
+    levels = dict((pin, 0) for pin in pins)
+    last_change = dict((pin, 0) for pin in pins)
+    changes = []
+    cpu = sum(os.times()[:2])
+    end = time.time() + args.duration
+    while time.time() < end:
+        time.sleep(1.0 / args.rate)
+        pin = random.choice(pins)
+        if time.time() - last_change[pin] < min_gap:
+            continue
+        levels[pin] ^= 1
+        last_change[pin] = registers.set_level(pin, levels[pin])
+        changes.append((pin, last_change[pin]))
+
+    time.sleep(min_gap)
+    cpu = sum(os.times()[:2]) - cpu
+    stopping.append(True)
+    consumer.join()
+    sensor.cleanup()
+    registers.close()
+
+    # Match each change to the first later report for the same pin
+    latencies = []
+    missed = 0
+    for pin, stamp in changes:
+        seen = [when for other, when in detected if other == pin and when >= stamp]
+        if not seen:
+            missed += 1
+            continue
+        latencies.append(seen[0] - stamp)
+        detected.remove((pin, seen[0]))
+
+    result = {
+        'benchmark': 'latency',
+        'doors': count,
+        'interval': args.interval,
+        'transitions': len(changes),
+        'missed': missed,
+        'cpu_percent': round(cpu / args.duration * 100, 1),
+    }
+    result.update(percentiles(latencies))
+    emit(result)
+
+BENCHMARKS = {
+    'read': bench_read,
+    'latency': bench_latency,
+}
+
+def main():
+    """Run the selected benchmarks for each door count"""
+    parser = argparse.ArgumentParser(description="Pi Garage Alert sensor read benchmark")
+    parser.add_argument('--doors', default='1,10,28',
+                        help="comma separated door counts, at most 28 (default 1,10,28)")
+    parser.add_argument('--interval', type=float, default=0.005,
+                        help="mmap backend sampling interval in seconds (default 0.005)")
+    parser.add_argument('--rate', type=float, default=50,
+                        help="pin changes per second in the latency benchmark (default 50)")
+    parser.add_argument('--duration', type=float, default=5,
+                        help="seconds to run the latency benchmark (default 5)")
+    parser.add_argument('--only', choices=sorted(BENCHMARKS),
+                        help="run one benchmark")
+    args = parser.parse_args()
+    random.seed(1)
+
+    for count in [int(value) for value in args.doors.split(',')]:
+        for name in sorted(BENCHMARKS):
+            if args.only is None or args.only == name:
+                BENCHMARKS[name](args, count)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+""" Pi Garage Alert Twilio fan-out benchmark
+
+Sends alerts to several SMS recipients through AlertDispatcher and the real
+Twilio channel, pointed at a local fake of the Twilio REST API. The fake
+server sleeps for --handshake seconds on each new connection, to imitate a
+TLS handshake, and for --latency seconds on each request, to imitate the
+round trip. It can also close every connection after one request, to
+compare against not keeping connections open.
+
+Results are printed as one JSON object per line.
+
+Usage: bench_twilio.py [--recipients 1,5,20] [--workers 1,4,8] [--alerts 5]
+                       [--latency 0.05] [--handshake 0.1]
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+import simulation
+from simulation import pga
+
+try:
+    from http.server import BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+class FakeTwilio(object):
+    """Local HTTP server answering like the Twilio Messages API"""
+
+    def __init__(self, latency, handshake, keepalive):
+        self.connections = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Answers every POST with a new message sid"""
+            protocol_version = 'HTTP/1.1' if keepalive else 'HTTP/1.0'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with fake.lock:
+                    fake.connections += 1
+                time.sleep(handshake)
+
+            def do_POST(self):
+                # pylint: disable=invalid-name
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(latency)
+                with fake.lock:
+                    fake.requests += 1
+                    sid = 'SM%032d' % fake.requests
+                body = json.dumps({'sid': sid, 'status': 'queued'}).encode('utf-8')
+                self.send_response(201)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # pylint: disable=redefined-builtin
+                pass
+
+        class Server(pga.ThreadingHTTPServer):
+            """Accepts a burst of connections without SYN retries"""
+            request_queue_size = 64
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self):
+        """Return the base URL of the server"""
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def stop(self):
+        """Stop the server"""
+        self.server.shutdown()
+        self.server.server_close()
+
+def emit(result):
+    """Print one result line"""
+    print(json.dumps(result, sort_keys=True))
+    sys.stdout.flush()
+
+def bench(args, recipients, workers, keepalive):
+    """Send args.alerts alerts to recipients phone numbers"""
+    fake = FakeTwilio(args.latency, args.handshake, keepalive)
+    pga.cfg.TWILIO_API_URL = fake.url()
+    pga.cfg.TWILIO_ACCOUNT = 'AC00000000000000000000000000000000'
+    pga.cfg.TWILIO_TOKEN = 'token'
+    pga.cfg.ALERT_WORKERS = {'Twilio': workers}
+    pga.cfg.ALERT_RATE_LIMITS = {}
+    pga.cfg.ALERT_DIGEST_WINDOW = {}
+
+    sender = pga.Twilio()
+    dispatcher = pga.AlertDispatcher({'Twilio': sender})
+    channel = dispatcher.channels['Twilio']
+
+    fan_out = []
+    for index in range(args.alerts):
+        start = time.time()
+        for recipient in range(recipients):
+            dispatcher.send_alert('Twilio', 'send_sms', '+1555%07d' % recipient, 'Door', 'alert %d' % index)
+        while channel.sent + channel.failed < (index + 1) * recipients:
+            time.sleep(0.001)
+        fan_out.append(time.time() - start)
+
+    dispatcher.shutdown(5)
+    sender.terminate()
+    fake.stop()
+
+    fan_out.sort()
+    emit({
+        'benchmark': 'twilio',
+        'recipients': recipients,
+        'workers': workers,
+        'keepalive': keepalive,
+        'alerts': args.alerts,
+        'sent': channel.sent,
+        'failed': channel.failed,
+        'connections': fake.connections,
+        'fan_out_p50_ms': round(fan_out[len(fan_out) // 2] * 1000, 1),
+        'fan_out_max_ms': round(fan_out[-1] * 1000, 1),
+    })
+
+def main():
+    """Run the benchmark for each recipient and worker count"""
+    parser = argparse.ArgumentParser(description="Pi Garage Alert Twilio fan-out benchmark")
+    parser.add_argument('--recipients', default='1,5,20',
+                        help="comma separated recipients per alert (default 1,5,20)")
+    parser.add_argument('--workers', default='1,4,8',
+                        help="comma separated Twilio worker counts (default 1,4,8)")
+    parser.add_argument('--alerts', type=int, default=5, help="alerts to send (default 5)")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="seconds the fake server takes per request (default 0.05)")
+    parser.add_argument('--handshake', type=float, default=0.1,
+                        help="seconds the fake server takes per new connection (default 0.1)")
+    args = parser.parse_args()
+
+    saved = simulation.skip_channel_imports()
+    pga.import_twilio()
+    for recipients in [int(value) for value in args.recipients.split(',')]:
+        for workers in [int(value) for value in args.workers.split(',')]:
+            for keepalive in (False, True):
+                bench(args, recipients, workers, keepalive)
+    pga.ALERT_CHANNELS.update(saved)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+""" Pi Garage Alert sensor filter check
+
+Replays the bounce traces in traces/ through each sensor filter with
+replay_trace() and checks that the filtered transitions are the expected
+ones: one "closed" and one "open" transition per trace, at the times the
+filter's settings imply, with the bounce and the single-sample glitch
+rejected.
+
+Results are printed as one JSON object per line. Exits with status 1 if
+any filter's output differs from what is expected.
+
+Usage: check_filters.py
+"""
+
+import json
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'etc'))
+sys.path.insert(0, os.path.join(HERE, '..', 'bin'))
+
+import pi_garage_alert as pga
+
+# Trace file -> list of (filter spec, expected (time, level) transitions)
+EXPECTED = {
+    'reed_switch_bounce.txt': [
+        # Third closed reading out of five, then third open reading
+        ({'type': 'majority', 'samples': 5}, [(1.06, 0), (3.06, 1)]),
+        # 200 ms after the last bounce of each transition
+        ({'type': 'stable', 'time': 0.2}, [(1.36, 0), (3.24, 1)]),
+        # Count reaches 0 and then 3 once the bounce settles
+        ({'type': 'schmitt', 'threshold': 3}, [(1.12, 0), (3.08, 1)]),
+    ],
+}
+
+def load_trace(path):
+    """Return the (time, level) readings in a trace file"""
+    trace = []
+    with open(path, 'r') as trace_file:
+        for line in trace_file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                stamp, level = line.split()
+                trace.append((float(stamp), int(level)))
+    return trace
+
+def main():
+    """Check every filter against every trace"""
+    ok = True
+    for name, cases in sorted(EXPECTED.items()):
+        trace = load_trace(os.path.join(HERE, 'traces', name))
+        raw = sum(1 for before, after in zip(trace, trace[1:]) if before[1] != after[1])
+        for spec, expected in cases:
+            transitions = [(round(stamp, 3), level)
+                           for stamp, level in pga.replay_trace(pga.create_door_filter(spec), trace)]
+            passed = transitions == expected
+            ok = ok and passed
+            print(json.dumps({
+                'check': 'filter',
+                'trace': name,
+                'filter': spec['type'],
+                'raw_transitions': raw,
+                'transitions': transitions,
+                'expected': expected,
+                'passed': passed,
+            }, sort_keys=True))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+#!/usr/bin/python
+""" Pi Garage Alert simulation harness
+
+Runs PiGarageAlert.main() without Raspberry Pi hardware or alert accounts.
+FakeGPIO stands in for the RPi.GPIO module, and SinkSender stands in for
+every alert channel, recording each call with the time it was made.
+FakeMqttBroker stands in for an MQTT broker, to run the real Mqtt channel
+against.
+
+Example:
+    sim = Simulation([{'pin': 1, 'name': "Door", 'alerts': [...]}])
+    sim.start()
+    sim.set_door(1, 'open')
+    ...
+    sim.stop()
+    print(sim.calls)
+"""
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'etc'))
+sys.path.insert(0, os.path.join(HERE, '..', 'bin'))
+
+class FakeGPIO(object):
+    """Stand-in for the RPi.GPIO module.
+
+    Pins read 0 (door closed) until set_level() is called. Edge callbacks
+    are called from the thread that calls set_level().
+    """
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None
+        self.levels = dict()
+        self.callbacks = dict()
+        self.reads = 0
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=None):
+        # pylint: disable=unused-argument
+        with self.lock:
+            self.levels.setdefault(pin, 0)
+
+    def input(self, pin):
+        self.reads += 1
+        return self.levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        # pylint: disable=unused-argument
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self):
+        self.callbacks.clear()
+
+    def set_level(self, pin, level):
+        """Change the level of a pin, calling its edge callback if it changed
+
+        Returns:
+            time.time() of the change.
+        """
+        with self.lock:
+            changed = self.levels.get(pin, 0) != level
+            self.levels[pin] = level
+            stamp = time.time()
+
+        callback = self.callbacks.get(pin)
+        if changed and callback is not None:
+            callback(pin)
+        return stamp
+
+def install_fake_gpio():
+    """Make "import RPi.GPIO" return a FakeGPIO"""
+    gpio = FakeGPIO()
+    package = types.ModuleType('RPi')
+    package.GPIO = gpio
+    sys.modules['RPi'] = package
+    sys.modules['RPi.GPIO'] = gpio
+    return gpio
+
+GPIO = install_fake_gpio()
+
+import pi_garage_alert as pga
+pga.GPIO = GPIO
+
+class FakeMqttClient(object):
+    """Stand-in for a paho.mqtt.client.Client connected to a FakeMqttBroker.
+
+    Callbacks are called with the same arguments as paho's. Publishes are
+    acknowledged through on_publish after the broker's ack_delay, or before
+    publish() returns if ack_delay is 0, as paho can do. Like paho,
+    publish() and on_publish both run with out_message_mutex held.
+    """
+
+    def __init__(self, broker, client_id=None):
+        self.broker = broker
+        self.client_id = client_id
+        self.connected = False
+
+        # QoS 1 and 2 messages published while disconnected, sent after
+        # reconnecting, as paho does
+        self.queued = []
+        self.out_message_mutex = threading.RLock()
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def connect_async(self, host, port=1883):
+        pass
+
+    def loop_start(self):
+        self.broker.attach(self)
+
+    def loop_stop(self):
+        self.broker.detach(self)
+
+    def disconnect(self):
+        self.broker.detach(self)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self.out_message_mutex:
+            return self.broker.publish(self, topic, payload, qos, retain)
+
+    def acknowledged(self, mid):
+        """Call on_publish for a message, as paho's network thread does"""
+        with self.out_message_mutex:
+            self.on_publish(self, None, mid)
+
+class FakeMqttBroker(object):
+    """Local MQTT broker stand-in, also standing in for the paho client
+    module so the Mqtt channel runs unchanged against it.
+
+    Every accepted message is appended to messages as a (topic, payload,
+    qos, retain) tuple, and retained payloads are kept in retained. While
+    the broker is offline, publishes fail with MQTT_ERR_NO_CONN and
+    clients are told they are disconnected. As with paho, QoS 1 and 2
+    messages that fail this way are kept by the client and delivered once
+    it reconnects.
+    """
+
+    MQTT_ERR_SUCCESS = 0
+    MQTT_ERR_NO_CONN = 4
+    MQTTMessageInfo = collections.namedtuple('MQTTMessageInfo', 'rc mid')
+
+    def __init__(self, ack_delay=0):
+        """
+        Args:
+            ack_delay: Seconds before a message is acknowledged.
+        """
+        self.ack_delay = ack_delay
+        self.lock = threading.Lock()
+        self.online = True
+        self.clients = []
+        self.messages = []
+        self.retained = dict()
+        self.next_mid = 0
+
+    def Client(self, client_id=None):
+        # pylint: disable=invalid-name
+        return FakeMqttClient(self, client_id)
+
+    def attach(self, client):
+        """Connect a client, if the broker is online"""
+        with self.lock:
+            if client not in self.clients:
+                self.clients.append(client)
+            connect = self.online and not client.connected
+            client.connected = client.connected or self.online
+        if connect:
+            client.on_connect(client, None, {}, 0)
+            self.resend(client)
+
+    def detach(self, client):
+        """Disconnect a client at its own request"""
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+            disconnect, client.connected = client.connected, False
+        if disconnect:
+            client.on_disconnect(client, None, 0)
+
+    def set_online(self, online, notify=True):
+        """Take the broker down or bring it back, telling the clients
+
+        Args:
+            online: True to bring the broker back.
+            notify: False to take the broker down without calling the
+                    clients' on_disconnect, as when a connection drops
+                    before paho notices.
+        """
+        with self.lock:
+            self.online = online
+            changed = [client for client in self.clients if client.connected != online]
+            for client in changed:
+                client.connected = online
+        for client in changed:
+            if online:
+                client.on_connect(client, None, {}, 0)
+                self.resend(client)
+            elif notify:
+                client.on_disconnect(client, None, 1)
+
+    def publish(self, client, topic, payload, qos, retain):
+        """Accept a message from a client"""
+        with self.lock:
+            # paho message ids run from 1 to 65535 and then wrap
+            self.next_mid = self.next_mid % 65535 + 1
+            mid = self.next_mid
+            if not client.connected:
+                if qos > 0:
+                    client.queued.append((mid, topic, payload, qos, retain))
+                return self.MQTTMessageInfo(self.MQTT_ERR_NO_CONN, mid)
+            self.accept(topic, payload, qos, retain)
+        self.acknowledge(client, mid)
+        return self.MQTTMessageInfo(self.MQTT_ERR_SUCCESS, mid)
+
+    def resend(self, client):
+        """Deliver the messages a client kept while it was disconnected"""
+        with self.lock:
+            queued, client.queued = client.queued, []
+            for _, topic, payload, qos, retain in queued:
+                self.accept(topic, payload, qos, retain)
+        for mid, _, _, _, _ in queued:
+            self.acknowledge(client, mid)
+
+    def accept(self, topic, payload, qos, retain):
+        """Record a delivered message. Called with the lock held."""
+        self.messages.append((topic, payload, qos, retain))
+        if retain:
+            self.retained[topic] = payload
+
+    def acknowledge(self, client, mid):
+        """Acknowledge a message through the client's on_publish"""
+        if self.ack_delay:
+            timer = threading.Timer(self.ack_delay, client.acknowledged, (mid,))
+            timer.daemon = True
+            timer.start()
+        else:
+            client.acknowledged(mid)
+
+def install_fake_mqtt(ack_delay=0):
+    """Make the Mqtt channel use a new FakeMqttBroker instead of paho
+
+    Returns:
+        The FakeMqttBroker.
+    """
+    broker = FakeMqttBroker(ack_delay)
+    paho = types.ModuleType('paho')
+    paho.mqtt = types.ModuleType('paho.mqtt')
+    paho.mqtt.client = broker
+    sys.modules['paho'] = paho
+    sys.modules['paho.mqtt'] = paho.mqtt
+    sys.modules['paho.mqtt.client'] = broker
+    pga.mqtt = broker
+    return broker
+
+class SinkSender(object):
+    """Stand-in for the sender of any alert channel.
+
+    Every call is appended to calls as a (time.time(), channel, method,
+    args) tuple. door_changed() is recorded too, since the MQTT sender is
+    also a DoorMonitor listener.
+    """
+
+    def __init__(self, channel, calls, delay=0):
+        """
+        Args:
+            channel: Name of the channel.
+            calls: List to record calls in.
+            delay: Seconds each send takes, to imitate a network round trip.
+        """
+        self.channel = channel
+        self.calls = calls
+        self.delay = delay
+
+    def record(self, method, *args):
+        """Record a call"""
+        self.calls.append((time.time(), self.channel, method, args))
+        if self.delay:
+            time.sleep(self.delay)
+
+    def send_sms(self, recipient, msg):
+        self.record('send_sms', recipient, msg)
+
+    def direct_msg(self, user, msg):
+        self.record('direct_msg', user, msg)
+
+    def update_status(self, msg):
+        self.record('update_status', msg)
+
+    def send_email(self, recipients, subject, msg):
+        self.record('send_email', recipients, subject, msg)
+
+    def send_msg(self, recipient, msg):
+        self.record('send_msg', recipient, msg)
+
+    def publish(self, topic, msg):
+        self.record('publish', topic, msg)
+
+    def door_changed(self, name, state, when, time_in_previous_state):
+        # pylint: disable=unused-argument
+        self.calls.append((time.time(), self.channel, 'door_changed', (name, state)))
+
+    def alert_sent(self, name, state, alert_index, when):
+        pass
+
+def skip_channel_imports():
+    """Stop the alert channels' modules being imported, since the sinks
+    don't need them
+
+    Returns:
+        The replaced ALERT_CHANNELS entries, to restore afterwards.
+    """
+    saved = dict(pga.ALERT_CHANNELS)
+    for name, channel in saved.items():
+        pga.ALERT_CHANNELS[name] = channel._replace(load=lambda: None)
+    return saved
+
+# Account settings the channels need before alerts can be sent to them.
+# The sinks don't use them.
+CHANNEL_ACCOUNTS = {
+    'TWILIO_ACCOUNT': 'AC00000000000000000000000000000000',
+    'TWILIO_TOKEN': 'token',
+    'TWILIO_PHONE_NUMBER': '+10000000000',
+    'TWITTER_CONSUMER_KEY': 'key',
+    'TWITTER_CONSUMER_SECRET': 'secret',
+    'TWITTER_ACCESS_KEY': 'key',
+    'TWITTER_ACCESS_SECRET': 'secret',
+    'MQTT_HOST': 'localhost',
+}
+
+# Settings applied to the config while a simulation runs
+DEFAULT_SETTINGS = dict(CHANNEL_ACCOUNTS, **{
+    'SENSOR_BACKEND': 'edge',
+    'SENSOR_POLL_INTERVAL': 0.01,
+    'SENSOR_RESYNC_INTERVAL': 60,
+    'STATE_DIR': None,
+    'ALERT_RATE_LIMITS': {},
+    'ALERT_DIGEST_WINDOW': {},
+    'JABBER_ID': '',
+    'MQTT_STATE_TOPIC': 'garage/%s/state',
+    'MQTT_EVENT_FORMAT': 'json',
+    'HTTP_PORT': None,
+})
+
+class Simulation(object):
+    """Runs PiGarageAlert.main() on a background thread against FakeGPIO
+    and SinkSender channels"""
+
+    def __init__(self, doors, settings=None, send_delay=0):
+        """
+        Args:
+            doors: GARAGE_DOORS list to monitor.
+            settings: Config settings to override, on top of DEFAULT_SETTINGS.
+            send_delay: Seconds each alert send takes.
+        """
+        self.doors = doors
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        self.settings['GARAGE_DOORS'] = doors
+        self.send_delay = send_delay
+        self.calls = []
+        self.saved = dict()
+        self.saved_backends = None
+        self.app = None
+        self.thread = None
+
+    def start(self, timeout=10):
+        """Start the daemon and wait until its main loop is running"""
+        if not logging.getLogger().handlers:
+            logging.basicConfig(level=logging.WARNING)
+
+        for name, value in self.settings.items():
+            if hasattr(pga.cfg, name):
+                self.saved[name] = getattr(pga.cfg, name)
+            setattr(pga.cfg, name, value)
+
+        self.saved_backends = skip_channel_imports()
+
+        factories = dict()
+        for name in pga.ALERT_CHANNELS:
+            factories[name] = lambda name=name: SinkSender(name, self.calls, self.send_delay)
+
+        # Every door starts closed
+        GPIO.levels.clear()
+
+        self.app = pga.PiGarageAlert(factories)
+        self.thread = threading.Thread(target=self.app.main, name="sim-main")
+        self.thread.daemon = True
+        self.thread.start()
+
+        deadline = time.time() + timeout
+        while self.app.ticks == 0:
+            if not self.thread.is_alive() or time.time() > deadline:
+                raise RuntimeError("Pi Garage Alert did not start")
+            time.sleep(0.001)
+
+    def set_door(self, pin, state):
+        """Open or close the door on pin
+
+        Returns:
+            time.time() of the change.
+        """
+        return GPIO.set_level(pin, int(state == 'open'))
+
+    def calls_to(self, method):
+        """Return the recorded calls of a sender method"""
+        return [call for call in self.calls if call[2] == method]
+
+    def stop(self):
+        """Stop the daemon and restore the config"""
+        self.app.stop()
+        self.thread.join()
+
+        for name in self.settings:
+            if name in self.saved:
+                setattr(pga.cfg, name, self.saved[name])
+            else:
+                delattr(pga.cfg, name)
+        pga.ALERT_CHANNELS.update(self.saved_backends)
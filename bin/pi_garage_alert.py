@@ -35,29 +35,79 @@ Learn more at http://www.richlynch.com/code/pi_garage_alert
 #
 ##############################################################################
 
-import RPi.GPIO as GPIO
 import time
 import subprocess
 import re
+import os
 import sys
-import tweepy
+import threading
+import heapq
+import collections
+import array
+import fcntl
+import select
+import mmap
+import struct
+import bisect
+import random
+import json
+import base64
+import uuid
+import sqlite3
 import logging
-import smtplib
-import httplib2
-import sleekxmpp
-from sleekxmpp.xmlstream import resolver, cert
-import ssl
 import traceback
-from email.mime.text import MIMEText
+import socket
+import signal
+import zlib
+import multiprocessing
+import copy
+import gzip
+import shutil
 
 from time import strftime
 from datetime import timedelta
-from twilio.rest import TwilioRestClient
-from twilio.rest.exceptions import TwilioRestException
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # Only the simulated sensor backend works without RPi.GPIO
+    GPIO = None
 
 sys.path.append('/usr/local/etc')
 import pi_garage_alert_config as cfg
 
+##############################################################################
+# Alert sender errors
+##############################################################################
+
+class AlertError(Exception):
+    """An alert sender was unable to send an alert. The outbox tries it
+    again later."""
+    pass
+
+class PermanentAlertError(AlertError):
+    """Sending the alert again can't succeed, e.g. because the recipient
+    doesn't exist. The outbox gives up on it straight away, and it doesn't
+    count toward the channel's circuit breaker."""
+    pass
+
+class NotConnectedError(AlertError):
+    """The channel's connection is down. The outbox tries the alert again
+    once the channel reconnects, without counting it as an attempt."""
+    pass
+
 ##############################################################################
 # Jabber support
 ##############################################################################
@@ -68,17 +118,43 @@ if sys.version_info < (3, 0):
     reload(sys)
     sys.setdefaultencoding('utf8')
 
-class Jabber(sleekxmpp.ClientXMPP):
+def import_jabber():
+    """Import the modules needed by the Jabber channel"""
+    # pylint: disable=global-variable-undefined,redefined-outer-name
+    global sleekxmpp, resolver, cert, ssl
+    import ssl
+    import sleekxmpp
+    from sleekxmpp.xmlstream import resolver, cert
+
+class Jabber(object):
     """Interfaces with a Jabber instant messaging service"""
 
-    def __init__(self, door_states, time_of_last_state_change):
+    def __init__(self, door_states, time_of_last_state_change, history=None, analytics=None):
         self.logger = logging.getLogger(__name__)
+        self.xmpp = None
+
+        # True while a Jabber session is established. Only changed by the
+        # sleekxmpp threads, so it can be checked without blocking.
         self.connected = False
 
+        self.stopping = threading.Event()
+        self.connector = None
+        self.processing = False
+
+        # Function called with no arguments each time a session starts, set
+        # by the AlertDispatcher to retry the alerts waiting for it
+        self.on_reconnect = None
+
         # Save references to door states for status queries
         self.door_states = door_states
         self.time_of_last_state_change = time_of_last_state_change
 
+        # EventHistory for history queries, if enabled
+        self.history = history
+
+        # DoorAnalytics for stats queries
+        self.analytics = analytics
+
         if not hasattr(cfg, 'JABBER_ID'):
             self.logger.debug("Jabber ID not defined - Jabber support disabled")
             return
@@ -88,47 +164,74 @@ class Jabber(sleekxmpp.ClientXMPP):
 
         self.logger.info("Signing into Jabber as %s", cfg.JABBER_ID)
 
-        sleekxmpp.ClientXMPP.__init__(self, cfg.JABBER_ID, cfg.JABBER_PASSWORD)
+        self.xmpp = sleekxmpp.ClientXMPP(cfg.JABBER_ID, cfg.JABBER_PASSWORD)
 
         # Register event handlers
-        self.add_event_handler("session_start", self.handle_session_start)
-        self.add_event_handler("message", self.handle_message)
-        self.add_event_handler("ssl_invalid_cert", self.ssl_invalid_cert)
+        self.xmpp.add_event_handler("session_start", self.handle_session_start)
+        self.xmpp.add_event_handler("message", self.handle_message)
+        self.xmpp.add_event_handler("ssl_invalid_cert", self.ssl_invalid_cert)
+        self.xmpp.add_event_handler("disconnected", self.handle_disconnected)
 
-        # ctrl-c processing
-        self.use_signals()
+        # The daemon handles its own signals, so sleekxmpp's use_signals()
+        # isn't called. Its handlers would disconnect on every SIGHUP.
 
         # Setup plugins. Order does not matter.
-        self.register_plugin('xep_0030') # Service Discovery
-        self.register_plugin('xep_0004') # Data Forms
-        self.register_plugin('xep_0060') # PubSub
-        self.register_plugin('xep_0199') # XMPP Ping
+        self.xmpp.register_plugin('xep_0030') # Service Discovery
+        self.xmpp.register_plugin('xep_0004') # Data Forms
+        self.xmpp.register_plugin('xep_0060') # PubSub
+        self.xmpp.register_plugin('xep_0199') # XMPP Ping
 
         # If you are working with an OpenFire server, you may need
         # to adjust the SSL version used:
-        # self.ssl_version = ssl.PROTOCOL_SSLv3
+        # self.xmpp.ssl_version = ssl.PROTOCOL_SSLv3
 
-        # Connect to the XMPP server and start processing XMPP stanzas.
-        # This will block if the network is down.
+        # Once connected, sleekxmpp reconnects by itself, backing off up to
+        # this many seconds between attempts
+        self.reconnect_max = getattr(cfg, 'JABBER_RECONNECT_MAX', 300)
+        self.xmpp.reconnect_max_delay = self.reconnect_max
 
-        if hasattr(cfg, 'JABBER_SERVER') and hasattr(cfg, 'JABBER_PORT'):
-            # Config file overrode the default server and port
-            if not self.connect((cfg.JABBER_SERVER, cfg.JABBER_PORT)):
-                return
-        else:
-            # Use default server and port from DNS SRV records
-            if not self.connect():
-                return
+        # Connect to the XMPP server in the background, since this blocks
+        # while the network is down
+        self.connector = threading.Thread(target=self.connect, name="jabber-connect")
+        self.connector.daemon = True
+        self.connector.start()
 
-        # Start up Jabber threads and return
-        self.process(block=False)
-        self.connected = True
+    def connect(self):
+        """Connect to the XMPP server, retrying with exponential backoff,
+        then start processing XMPP stanzas"""
+        delay = 1
+        while not self.stopping.is_set():
+            if hasattr(cfg, 'JABBER_SERVER') and hasattr(cfg, 'JABBER_PORT'):
+                # Config file overrode the default server and port
+                address = (cfg.JABBER_SERVER, cfg.JABBER_PORT)
+            else:
+                # Use default server and port from DNS SRV records
+                address = tuple()
+
+            try:
+                if self.xmpp.connect(address, reattempt=False):
+                    # Start up Jabber threads and return
+                    self.xmpp.process(block=False)
+                    self.processing = True
+                    return
+            except:
+                self.logger.error("Exception connecting to Jabber: %s", sys.exc_info()[0])
+
+            # Add jitter so many daemons don't retry in lockstep
+            wait = delay * random.uniform(0.5, 1.5)
+            self.logger.error("Unable to connect to Jabber - retrying in %.0f sec", wait)
+            self.stopping.wait(wait)
+            delay = min(delay * 2, self.reconnect_max)
+
+    def is_connected(self):
+        """Return True if a Jabber session is established. Never blocks."""
+        return self.connected
 
     def ssl_invalid_cert(self, raw_cert):
         """Handle an invalid certificate from the Jabber server
            This may happen if the domain is using Google Apps
            for their XMPP server and the XMPP server."""
-        hosts = resolver.get_SRV(self.boundjid.server, 5222,
+        hosts = resolver.get_SRV(self.xmpp.boundjid.server, 5222,
                                  'xmpp-client',
                                  resolver=resolver.default_resolver())
 
@@ -140,13 +243,13 @@ class Jabber(sleekxmpp.ClientXMPP):
         if domain_uses_google:
             try:
                 if cert.verify('talk.google.com', ssl.PEM_cert_to_DER_cert(raw_cert)):
-                    logging.debug('Google certificate found for %s', self.boundjid.server)
+                    logging.debug('Google certificate found for %s', self.xmpp.boundjid.server)
                     return
             except cert.CertificateError:
                 pass
 
-        logging.error("Invalid certificate received for %s", self.boundjid.server)
-        self.disconnect()
+        logging.error("Invalid certificate received for %s", self.xmpp.boundjid.server)
+        self.xmpp.disconnect()
 
     def handle_session_start(self, event):
         """Process the session_start event.
@@ -161,8 +264,19 @@ class Jabber(sleekxmpp.ClientXMPP):
                    data.
         """
         # pylint: disable=unused-argument
-        self.send_presence()
-        self.get_roster()
+        self.xmpp.send_presence()
+        self.xmpp.get_roster()
+        self.connected = True
+        self.logger.info("Jabber session started")
+        if self.on_reconnect is not None:
+            self.on_reconnect()
+
+    def handle_disconnected(self, event):
+        """Process the disconnected event"""
+        # pylint: disable=unused-argument
+        if self.connected:
+            self.logger.error("Disconnected from Jabber")
+        self.connected = False
 
     def handle_message(self, msg):
         """Process incoming message stanzas.
@@ -179,45 +293,220 @@ class Jabber(sleekxmpp.ClientXMPP):
             if msg['from'].bare in cfg.JABBER_AUTHORIZED_IDS:
                 if msg['body'].lower() == 'status':
                     # Generate status report
+                    # The monitor's doors, which lag the configuration
+                    # while a reload is being applied
                     states = []
-                    for door in cfg.GARAGE_DOORS:
-                        name = door['name']
-                        state = self.door_states[name]
+                    for name, state in sorted(self.door_states.items()):
                         how_long = time.time() - self.time_of_last_state_change[name]
                         states.append("%s: %s (%s)" % (name, state, format_duration(how_long)))
                     response = ' / '.join(states)
+                elif msg['body'].lower().split(' ')[0] == 'history':
+                    response = self.history_report(msg['body'])
+                elif msg['body'].lower().split(' ')[0] == 'stats':
+                    response = self.stats_report(msg['body'])
                 else:
                     # Invalid command received
-                    response = "I don't understand that command. Valid commands are: status"
+                    response = "I don't understand that command. Valid commands are: status, history, stats"
                 self.logger.info("Replied to %s: %s", msg['from'], response)
                 msg.reply(response).send()
             else:
                 self.logger.info("Ignored unauthorized user: %s", msg['from'].bare)
 
+    def stats_report(self, command):
+        """Answer a stats query.
+
+        The command is "stats [door name]". Without a door name, every door
+        is reported.
+
+        Args:
+            command: Text of the command
+        """
+        if self.analytics is None:
+            return "Door analytics are not enabled"
+
+        args = command.split(None, 1)[1:]
+        if args:
+            if args[0] not in self.door_states:
+                return "Unknown door: %s" % args[0]
+            return self.analytics.report([args[0]])
+        return self.analytics.report(sorted(self.door_states))
+
+    def history_report(self, command):
+        """Answer a history query.
+
+        The command is "history [count|<hours>h|<days>d] [door name]". With a
+        count, the most recent events are returned. With a duration, all
+        events in that period are returned (up to a limit).
+
+        Args:
+            command: Text of the command
+        """
+        if self.history is None:
+            return "Event history is not enabled"
+
+        args = command.split(None, 2)[1:]
+        limit = 5
+        start = None
+        if args:
+            match = re.match(r'^(\d+)([hd]?)$', args[0].lower())
+            if match:
+                args.pop(0)
+                if match.group(2) == 'h':
+                    start = time.time() - int(match.group(1)) * 3600
+                    limit = 50
+                elif match.group(2) == 'd':
+                    start = time.time() - int(match.group(1)) * 86400
+                    limit = 50
+                else:
+                    limit = int(match.group(1))
+
+        door = None
+        if args:
+            door = ' '.join(args)
+            if door not in self.door_states:
+                return "Unknown door: %s" % door
+
+        records = self.history.query(door=door, start=start, limit=limit)
+        if not records:
+            return "No events found"
+        return '\n'.join(format_history_record(record) for record in records)
+
     def send_msg(self, recipient, msg):
-        """Send jabber message to specified recipient"""
+        """Send jabber message to specified recipient.
+
+        Raises:
+            NotConnectedError if there is no Jabber session. The outbox
+            sends the message again once the session is back up.
+        """
+        if self.xmpp is None:
+            self.logger.error("Jabber is not configured - unable to send jabber message!")
+            raise PermanentAlertError("Jabber is not configured")
+
         if not self.connected:
-            self.logger.error("Unable to connect to Jabber - unable to send jabber message!")
-            return
+            raise NotConnectedError("Jabber is not connected")
 
         self.logger.info("Sending Jabber message to %s: %s", recipient, msg)
-        self.send_message(mto=recipient, mbody=msg)
+        self.xmpp.send_message(mto=recipient, mbody=msg)
 
     def terminate(self):
         """Terminate all jabber threads"""
-        if self.connected:
-            self.disconnect()
+        self.stopping.set()
+        if self.processing:
+            self.xmpp.auto_reconnect = False
+            self.xmpp.disconnect()
 
 ##############################################################################
 # Twilio support
 ##############################################################################
 
+def import_twilio():
+    """Import the modules needed by the Twilio channel"""
+    # pylint: disable=global-variable-undefined,redefined-outer-name
+    global http_client, urlencode, urlsplit
+    try:
+        import http.client as http_client
+        from urllib.parse import urlencode, urlsplit
+    except ImportError:
+        import httplib as http_client
+        from urllib import urlencode
+        from urlparse import urlsplit
+
+class TwilioError(AlertError):
+    """Twilio did not accept a message"""
+    pass
+
 class Twilio(object):
-    """Class to connect to and send SMS using Twilio"""
+    """Class to send SMS using the Twilio REST API.
+
+    HTTPS connections to Twilio are kept open between messages and shared by
+    the Twilio worker threads, so the recipients of an alert are sent to in
+    parallel, up to ALERT_WORKERS['Twilio'] at a time, without a new TLS
+    handshake for each one.
+    """
 
     def __init__(self):
-        self.twilio_client = None
         self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+
+        # Idle connections, most recently used last
+        self.idle = []
+
+        url = urlsplit(getattr(cfg, 'TWILIO_API_URL', 'https://api.twilio.com'))
+        self.https = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.path = "%s/2010-04-01/Accounts/%s/Messages.json" % (url.path.rstrip('/'), cfg.TWILIO_ACCOUNT)
+        credentials = ("%s:%s" % (cfg.TWILIO_ACCOUNT, cfg.TWILIO_TOKEN)).encode('utf-8')
+        self.headers = {
+            'Authorization': 'Basic ' + base64.b64encode(credentials).decode('ascii'),
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'application/json',
+        }
+
+        self.sent = 0
+        self.connections = 0
+
+    def connect(self):
+        """Open a new connection to Twilio"""
+        self.logger.info("Connecting to Twilio at %s", self.host)
+        with self.lock:
+            self.connections += 1
+        if self.https:
+            return http_client.HTTPSConnection(self.host, self.port, timeout=alert_timeout('Twilio'))
+        return http_client.HTTPConnection(self.host, self.port, timeout=alert_timeout('Twilio'))
+
+    def acquire(self):
+        """Return an open connection and whether it was reused"""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection = self.idle.pop()
+
+            # An idle connection has nothing to read unless Twilio closed it
+            if connection.sock is not None and not select.select([connection.sock], [], [], 0)[0]:
+                return connection, True
+            connection.close()
+
+        return self.connect(), False
+
+    def post(self, body):
+        """POST a message to Twilio, reusing an idle connection if there is one
+
+        Returns:
+            The HTTP status and the response body.
+        """
+        connection, reused = self.acquire()
+
+        try:
+            connection.request('POST', self.path, body, self.headers)
+        except socket.timeout:
+            connection.close()
+            raise
+        except (http_client.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+            # Twilio closed the idle connection before the request reached
+            # it, so it is safe to send again on a new one
+            return self.post(body)
+
+        # Once the request is sent, Twilio may have accepted the message
+        # even if the response is lost, so failures are left to the outbox
+        # rather than sent again straight away
+        try:
+            response = connection.getresponse()
+            data = response.read()
+        except:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            with self.lock:
+                self.idle.append(connection)
+        return response.status, data
 
     def send_sms(self, recipient, msg):
         """Sends SMS message to specified phone number using Twilio.
@@ -226,35 +515,62 @@ class Twilio(object):
             recipient: Phone number to send SMS to.
             msg: Message to send. Long messages will automatically be truncated.
         """
+        if cfg.TWILIO_ACCOUNT == '' or cfg.TWILIO_TOKEN == '':
+            self.logger.error("Twilio account or token not specified - unable to send SMS!")
+            raise PermanentAlertError("Twilio is not configured")
 
-        # User may not have configured twilio - don't initialize it until it's
-        # first used
-        if self.twilio_client == None:
-            self.logger.info("Initializing Twilio")
+        self.logger.info("Sending SMS to %s: %s", recipient, msg)
+        fields = {'To': recipient, 'From': cfg.TWILIO_PHONE_NUMBER, 'Body': truncate(msg, 140)}
+        body = urlencode(dict((name, value.encode('utf-8')) for name, value in fields.items()))
+        try:
+            status, data = self.post(body)
+        except (http_client.HTTPException, socket.error) as ex:
+            self.logger.error("Unable to send SMS - internet connectivity issues: %s", ex)
+            raise
 
-            if cfg.TWILIO_ACCOUNT == '' or cfg.TWILIO_TOKEN == '':
-                self.logger.error("Twilio account or token not specified - unable to send SMS!")
-            else:
-                self.twilio_client = TwilioRestClient(cfg.TWILIO_ACCOUNT, cfg.TWILIO_TOKEN)
+        try:
+            result = json.loads(data.decode('utf-8'))
+        except ValueError:
+            result = dict()
+
+        if status >= 300:
+            self.logger.error("Unable to send SMS to %s: HTTP %d: %s", recipient, status,
+                              result.get('message', data[:200]))
+            # Twilio rejects bad numbers and messages with a 4xx status, and
+            # sending them again won't help. 429 means too many requests.
+            if 400 <= status < 500 and status != 429:
+                raise PermanentAlertError("Twilio rejected SMS to %s: HTTP %d: %s" % (
+                    recipient, status, result.get('message')))
+            raise TwilioError(status, result.get('code'), result.get('message'))
+
+        with self.lock:
+            self.sent += 1
+        self.logger.info("SMS to %s accepted as %s", recipient, result.get('sid'))
+
+    def status(self):
+        """Return string summarizing the Twilio connections"""
+        with self.lock:
+            return "Twilio: %d sent, %d connections opened, %d idle" % (self.sent, self.connections,
+                                                                        len(self.idle))
 
-        if self.twilio_client != None:
-            self.logger.info("Sending SMS to %s: %s", recipient, msg)
-            try:
-                self.twilio_client.sms.messages.create(
-                    to=recipient,
-                    from_=cfg.TWILIO_PHONE_NUMBER,
-                    body=truncate(msg, 140))
-            except TwilioRestException as ex:
-                self.logger.error("Unable to send SMS: %s", ex)
-            except httplib2.ServerNotFoundError as ex:
-                self.logger.error("Unable to send SMS - internet connectivity issues: %s", ex)
-            except:
-                self.logger.error("Exception sending SMS: %s", sys.exc_info()[0])
+    def terminate(self):
+        """Close the idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for connection in idle:
+            connection.close()
 
 ##############################################################################
 # Twitter support
 ##############################################################################
 
+def import_twitter():
+    """Import the modules needed by the Twitter channel"""
+    # pylint: disable=global-variable-undefined,redefined-outer-name
+    global tweepy
+    import tweepy
+
 class Twitter(object):
     """Class to connect to and send DMs/update status on Twitter"""
 
@@ -281,7 +597,7 @@ class Twitter(object):
             else:
                 auth = tweepy.OAuthHandler(cfg.TWITTER_CONSUMER_KEY, cfg.TWITTER_CONSUMER_SECRET)
                 auth.set_access_token(cfg.TWITTER_ACCESS_KEY, cfg.TWITTER_ACCESS_SECRET)
-                self.twitter_api = tweepy.API(auth)
+                self.twitter_api = tweepy.API(auth, timeout=alert_timeout('Twitter'))
 
     def direct_msg(self, user, msg):
         """Send direct message to specified Twitter user.
@@ -293,15 +609,18 @@ class Twitter(object):
 
         self.connect()
 
-        if self.twitter_api != None:
-            # Twitter doesn't like the same msg sent over and over, so add a timestamp
-            msg = strftime("%Y-%m-%d %H:%M:%S: ") + msg
+        if self.twitter_api == None:
+            raise PermanentAlertError("Twitter is not configured")
 
-            self.logger.info("Sending twitter DM to %s: %s", user, msg)
-            try:
-                self.twitter_api.send_direct_message(user=user, text=truncate(msg, 140))
-            except tweepy.error.TweepError as ex:
-                self.logger.error("Unable to send Tweet: %s", ex)
+        # Twitter doesn't like the same msg sent over and over, so add a timestamp
+        msg = strftime("%Y-%m-%d %H:%M:%S: ") + msg
+
+        self.logger.info("Sending twitter DM to %s: %s", user, msg)
+        try:
+            self.twitter_api.send_direct_message(user=user, text=truncate(msg, 140))
+        except tweepy.error.TweepError as ex:
+            self.logger.error("Unable to send Tweet: %s", ex)
+            raise
 
     def update_status(self, msg):
         """Update the users's status
@@ -312,365 +631,5268 @@ class Twitter(object):
 
         self.connect()
 
-        if self.twitter_api != None:
-            # Twitter doesn't like the same msg sent over and over, so add a timestamp
-            msg = strftime("%Y-%m-%d %H:%M:%S: ") + msg
+        if self.twitter_api == None:
+            raise PermanentAlertError("Twitter is not configured")
 
-            self.logger.info("Updating Twitter status to: %s", msg)
-            try:
-                self.twitter_api.update_status(status=truncate(msg, 140))
-            except tweepy.error.TweepError as ex:
-                self.logger.error("Unable to update Twitter status: %s", ex)
+        # Twitter doesn't like the same msg sent over and over, so add a timestamp
+        msg = strftime("%Y-%m-%d %H:%M:%S: ") + msg
+
+        self.logger.info("Updating Twitter status to: %s", msg)
+        try:
+            self.twitter_api.update_status(status=truncate(msg, 140))
+        except tweepy.error.TweepError as ex:
+            self.logger.error("Unable to update Twitter status: %s", ex)
+            raise
 
 ##############################################################################
 # Email support
 ##############################################################################
 
+def import_email():
+    """Import the modules needed by the Email channel"""
+    # pylint: disable=global-variable-undefined,redefined-outer-name
+    global smtplib, MIMEText
+    import smtplib
+    from email.mime.text import MIMEText
+
 class Email(object):
-    """Class to send emails"""
+    """Class to send emails.
+
+    SMTP sessions are kept open between alerts and shared by the Email
+    worker threads. A session that has been idle for a while is checked with
+    NOOP before it is reused, and dropped if it has been idle longer than
+    SMTP_IDLE_TIMEOUT.
+    """
 
     def __init__(self):
         self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+
+        # Idle sessions as (smtplib.SMTP, time.time() last used) tuples
+        self.idle = []
+
+        self.idle_timeout = getattr(cfg, 'SMTP_IDLE_TIMEOUT', 240)
+        self.noop_after = getattr(cfg, 'SMTP_NOOP_AFTER', 15)
+
+    def connect(self):
+        """Open a new SMTP session, with STARTTLS and login if configured"""
+        self.logger.info("Connecting to SMTP server %s:%d", cfg.SMTP_SERVER, cfg.SMTP_PORT)
+        mail = smtplib.SMTP(cfg.SMTP_SERVER, cfg.SMTP_PORT, timeout=alert_timeout('Email'))
+
+        try:
+            if getattr(cfg, 'SMTP_STARTTLS', False):
+                mail.starttls()
+                mail.ehlo()
+
+            if getattr(cfg, 'SMTP_USER', ''):
+                mail.login(cfg.SMTP_USER, cfg.SMTP_PASSWORD)
+        except:
+            self.close(mail)
+            raise
+
+        return mail
 
-    def send_email(self, recipient, subject, msg):
-        """Sends an email to the specified email address.
+    def close(self, mail):
+        """Close an SMTP session, ignoring errors"""
+        try:
+            mail.quit()
+        except:
+            pass
+
+    def acquire(self):
+        """Return a healthy SMTP session and whether it was reused"""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                mail, last_used = self.idle.pop()
+
+            idle_time = time.time() - last_used
+            if idle_time > self.idle_timeout:
+                self.close(mail)
+                continue
+
+            if idle_time > self.noop_after:
+                try:
+                    if mail.noop()[0] != 250:
+                        raise smtplib.SMTPException("NOOP failed")
+                except:
+                    self.logger.info("Idle SMTP session went away - reconnecting")
+                    self.close(mail)
+                    continue
+
+            return mail, True
+
+        return self.connect(), False
+
+    def release(self, mail):
+        """Return an SMTP session to the pool"""
+        with self.lock:
+            self.idle.append((mail, time.time()))
+
+    def send_email(self, recipients, subject, msg):
+        """Sends an email to the specified email addresses in one SMTP transaction.
 
         Args:
-            recipient: Email address to send to.
+            recipients: Email address or list of addresses to send to.
             subject: Email subject.
             msg: Body of email to send.
         """
-        self.logger.info("Sending email to %s: subject = \"%s\", message = \"%s\"", recipient, subject, msg)
+        if not isinstance(recipients, list):
+            recipients = [recipients]
+
+        self.logger.info("Sending email to %s: subject = \"%s\"", ', '.join(recipients), subject)
+        self.logger.debug("Email message: %s", msg)
 
         msg = MIMEText(msg)
         msg['Subject'] = subject
-        msg['To'] = recipient
+        msg['To'] = ', '.join(recipients)
         msg['From'] = cfg.EMAIL_FROM
 
         try:
-            mail = smtplib.SMTP(cfg.SMTP_SERVER, cfg.SMTP_PORT)
-            mail.sendmail(cfg.EMAIL_FROM, recipient, msg.as_string())
-            mail.quit()
+            mail, reused = self.acquire()
+            try:
+                try:
+                    mail.sendmail(cfg.EMAIL_FROM, recipients, msg.as_string())
+                except smtplib.SMTPServerDisconnected:
+                    if not reused:
+                        raise
+                    # The server dropped the session since the NOOP check
+                    self.close(mail)
+                    mail = self.connect()
+                    mail.sendmail(cfg.EMAIL_FROM, recipients, msg.as_string())
+            except smtplib.SMTPRecipientsRefused as ex:
+                # Every recipient was refused, but the session is still
+                # usable (smtplib has already reset it). Refusals with a 5xx
+                # code are permanent; 4xx ones, such as greylisting, are not.
+                self.release(mail)
+                if all(code >= 500 for code, _ in ex.recipients.values()):
+                    raise PermanentAlertError("Recipients refused: %s" % ', '.join(sorted(ex.recipients)))
+                raise
+            except smtplib.SMTPResponseException:
+                # The server refused this message, but the session is still
+                # usable
+                self.release(mail)
+                raise
+            except:
+                self.close(mail)
+                raise
+            self.release(mail)
         except:
             self.logger.error("Exception sending email: %s", sys.exc_info()[0])
+            raise
+
+    def terminate(self):
+        """Close all pooled SMTP sessions"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for mail, _ in idle:
+            self.close(mail)
 
 ##############################################################################
 # MQTT Support
 ##############################################################################
 
-import paho.mqtt.client as mqtt
+def import_mqtt():
+    """Import the modules needed by the MQTT channel"""
+    # pylint: disable=global-variable-undefined,redefined-outer-name
+    global mqtt
+    import paho.mqtt.client as mqtt
+
+class Mqtt(object):
+    """Class to publish events to an MQTT broker.
+
+    The connection is opened at startup and kept open; paho reconnects by
+    itself if the broker goes away. Alerts published while disconnected
+    fail, and are kept by the outbox until the connection comes back. Door
+    states are retained messages, so only the latest state of each door is
+    kept, and published once the connection is back. Messages are published
+    with MQTT_QOS and tracked until the broker acknowledges them, and alerts
+    only count as sent once acknowledged.
+    """
 
-class Mqtt:
-    def __init__(self, clientid=None):
+    def __init__(self, clientid=None, client=None):
+        """
+        Args:
+            clientid: MQTT client id. Defaults to a random id.
+            client: Object with the paho Client interface to use instead of
+                    a real paho client, e.g. a local broker stand-in.
+        """
         self.logger = logging.getLogger(__name__)
-        self.client = mqtt.Client(clientid)
+        if client is None:
+            client = mqtt.Client(clientid)
+        self.client = client
 
-        self.client.on_connect   = self.mqtt_on_connect
-        self.client.on_message   = self.mqtt_on_message
-        self.client.on_publish   = self.mqtt_on_publish
-        self.client.on_subscribe = self.mqtt_on_subscribe
+        self.client.on_connect    = self.mqtt_on_connect
+        self.client.on_disconnect = self.mqtt_on_disconnect
+        self.client.on_message    = self.mqtt_on_message
+        self.client.on_publish    = self.mqtt_on_publish
+        self.client.on_subscribe  = self.mqtt_on_subscribe
 
-	self.connected = False;
+        self.connected = False
 
         self.host     = cfg.MQTT_HOST
-	self.user     = cfg.MQTT_USER
-	self.password = cfg.MQTT_PASSWORD
-    
+        self.port     = getattr(cfg, 'MQTT_PORT', 1883)
+        self.user     = getattr(cfg, 'MQTT_USER', '')
+        self.password = getattr(cfg, 'MQTT_PASSWORD', '')
+        self.qos      = getattr(cfg, 'MQTT_QOS', 1)
+
+        # Topic that each door's state is published to (retained), if any
+        self.state_topic = getattr(cfg, 'MQTT_STATE_TOPIC', None)
+
+        # Retained topic -> latest payload, waiting for a connection
+        self.unpublished = dict()
+
+        # Message ids published but not yet acknowledged by the broker
+        self.lock = threading.Condition()
+        self.unacked = dict()
+        self.early_acks = set()
+
+        # Function called with no arguments each time the connection comes
+        # back, set by the AlertDispatcher to retry the alerts waiting for it
+        self.on_reconnect = None
+
+        if self.user:
+            self.client.username_pw_set(self.user, self.password)
+
+        if self.host:
+            self.connect()
+        else:
+            self.logger.error("MQTT_HOST not configured - unable to publish MQTT messages!")
+
     def mqtt_on_connect(self, client, userdata, flags, rc):
-	self.connected = True
-        self.logger.info("Connected to MQTT server with result code: " + str(rc))
+        # pylint: disable=unused-argument
+        if rc != 0:
+            self.logger.error("Unable to connect to MQTT server, result code: %s", rc)
+            return
+
+        self.logger.info("Connected to MQTT server")
+        with self.lock:
+            self.connected = True
+            queued = list(self.unpublished.items())
+            self.unpublished.clear()
+
+        for topic, payload in queued:
+            self.send(topic, payload, True)
+        if self.on_reconnect is not None:
+            self.on_reconnect()
+
+    def mqtt_on_disconnect(self, client, userdata, rc):
+        # pylint: disable=unused-argument
+        with self.lock:
+            self.connected = False
+        if rc != 0:
+            self.logger.error("Lost connection to MQTT server, result code: %s", rc)
 
     def mqtt_on_message(self, client, userdata, msg):
+        # pylint: disable=unused-argument
         self.logger.info(msg.topic+" "+str(msg.payload))
 
     def mqtt_on_publish(self, client, userdata, mid):
-        self.logger.info("MQTT message id was published: "+ str(mid))
+        # pylint: disable=unused-argument
+        with self.lock:
+            if self.unacked.pop(mid, None) is None and self.qos > 0:
+                # Acknowledged before send() recorded the message id. QoS 0
+                # messages are never tracked, so their acks are ignored.
+                self.early_acks.add(mid)
+            self.lock.notify_all()
+        self.logger.debug("MQTT message id was published: %s", mid)
 
     def mqtt_on_subscribe(self, client, obj, mid, granted_qos):
+        # pylint: disable=unused-argument
         self.logger.info("MQTT Subscribed: "+str(mid)+" "+str(granted_qos))
 
     def connect(self):
-	self.logger.info("Connecting to MQTT broker: %s", self.host);
-        self.client.connect(self.host)
+        """Start connecting to the broker in the background"""
+        self.logger.info("Connecting to MQTT broker: %s", self.host)
+        self.client.reconnect_delay_set(1, getattr(cfg, 'MQTT_RECONNECT_MAX', 120))
+        self.client.connect_async(self.host, self.port)
         self.client.loop_start()
         self.logger.info("MQTT Client loop started")
 
+    def send(self, topic, payload, retain, timeout=None):
+        """Publish a message
+
+        Retained messages that can't be published now are kept, the latest
+        for each topic, and published once the connection comes back. If
+        the connection drops before paho notices, paho itself keeps QoS 1
+        and 2 messages and sends them after reconnecting.
+
+        Args:
+            timeout: Seconds to wait for the broker to acknowledge a QoS 1
+                     or 2 message, or None to return once paho has queued
+                     it. A message that isn't acknowledged in time is still
+                     kept by paho, so it may be delivered after all.
+
+        Raises:
+            NotConnectedError if the broker is unavailable and the message
+            isn't retained. AlertError if it wasn't acknowledged within
+            timeout.
+        """
+        with self.lock:
+            connected = self.connected
+            if not connected and retain:
+                self.unpublished[topic] = payload
+                return
+        if not connected:
+            raise NotConnectedError("Not connected to the MQTT broker")
+
+        # paho calls on_publish with its own message lock held, and
+        # publish() takes that lock, so self.lock mustn't be held here
+        info = self.client.publish(topic, payload, self.qos, retain)
+        kept = info.rc == mqtt.MQTT_ERR_NO_CONN and self.qos > 0
+        with self.lock:
+            if info.rc != mqtt.MQTT_ERR_SUCCESS and not kept:
+                self.logger.error("Unable to publish MQTT message, result code: %s", info.rc)
+                if not retain:
+                    raise NotConnectedError("Not connected to the MQTT broker")
+                self.unpublished[topic] = payload
+                return
+
+            if retain:
+                self.unpublished.pop(topic, None)
+            if info.mid in self.early_acks:
+                self.early_acks.discard(info.mid)
+                return
+            if self.qos == 0:
+                return
+            self.unacked[info.mid] = (topic, payload)
+            if timeout is None:
+                return
+
+            deadline = time.time() + timeout
+            while info.mid in self.unacked and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+            if info.mid in self.unacked:
+                raise AlertError("MQTT broker didn't acknowledge message %d within %s seconds" %
+                                 (info.mid, timeout))
+
     def publish(self, topic, msg):
-	if (self.connected == False):
-	    self.connect()
-	    time.sleep(1)
+        """Publish an alert to the specified topic, and wait for the broker
+        to acknowledge it"""
+        self.logger.info("Sending MQTT message to %s: %r", topic, msg)
+        self.send(topic, msg, False, alert_timeout('Mqtt'))
+
+    def door_changed(self, name, state, when, time_in_previous_state):
+        """Publish the new state of a door to its retained state topic"""
+        # pylint: disable=unused-argument
+        if self.state_topic:
+            self.send(self.state_topic % name, state, True)
+
+    def alert_sent(self, name, state, alert_index, when):
+        """Alerts are published through publish()"""
+        pass
+
+    def wait_for_acks(self, timeout):
+        """Wait until the broker has acknowledged every message
+
+        Args:
+            timeout: Maximum number of seconds to wait.
+
+        Returns:
+            True if every message was acknowledged.
+        """
+        deadline = time.time() + timeout
+        with self.lock:
+            while self.unacked and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+            return not self.unacked
+
+    def status(self):
+        """Return string summarizing the MQTT connection"""
+        with self.lock:
+            return "MQTT: %s, %d unacked, %d states waiting" % (
+                'connected' if self.connected else 'disconnected',
+                len(self.unacked), len(self.unpublished))
+
+    def terminate(self):
+        """Wait briefly for outstanding acks, then disconnect"""
+        if not self.host:
+            return
+        if not self.wait_for_acks(getattr(cfg, 'MQTT_DRAIN_TIMEOUT', 5)):
+            self.logger.error("%d MQTT messages were not acknowledged", len(self.unacked))
+        self.client.disconnect()
+        self.client.loop_stop()
 
-        self.logger.info("Sending MQTT message to %s: %s", topic, msg)
-        self.client.publish(topic, msg)
-    
 ##############################################################################
 # Sensor support
 ##############################################################################
 
+def level_to_state(level):
+    """Convert a sensor pin level to a door state string
+
+    Args:
+        level: Pin level. The sensors pull the pin low when the door is closed.
+    """
+    if level:
+        return 'open'
+    return 'closed'
+
 def get_garage_door_state(pin):
     """Returns the state of the garage door on the specified pin as a string
 
     Args:
         pin: GPIO pin number.
     """
-    if GPIO.input(pin):
-        state = 'open'
-    else:
-        state = 'closed'
+    return level_to_state(GPIO.input(pin))
 
-    return state
+class SensorBackend(object):
+    """Base class for door sensor backends.
 
-def get_uptime():
-    """Returns the uptime of the RPi as a string
+    Backends report transitions by calling notify(). The main loop sleeps in
+    wait() until a transition is reported or the timeout it asked for expires.
     """
-    with open('/proc/uptime', 'r') as uptime_file:
-        uptime_seconds = int(float(uptime_file.readline().split()[0]))
-        uptime_string = str(timedelta(seconds=uptime_seconds))
-    return uptime_string
 
-def get_gpu_temp():
-    """Return the GPU temperature as a Celsius float
-    """
-    cmd = ['vcgencmd', 'measure_temp']
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.events = queue.Queue()
 
-    measure_temp_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    output = measure_temp_proc.communicate()[0]
+        # Seconds between reads of every sensor: 0 to read them all on every
+        # wakeup, None to only read sensors that reported a transition
+        self.resync_interval = None
 
-    gpu_temp = 'unknown'
-    gpu_search = re.search('([0-9.]+)', output)
+    def setup(self, pins):
+        """Configure the specified pins as door sensor inputs"""
+        pass
 
-    if gpu_search:
-        gpu_temp = gpu_search.group(1)
+    def read(self, pin):
+        """Return the current state of the door on pin as a string"""
+        raise NotImplementedError
 
-    return float(gpu_temp)
+    def read_all(self, pins):
+        """Return a dictionary mapping each of pins to the state of its door"""
+        return dict((pin, self.read(pin)) for pin in pins)
 
-def get_cpu_temp():
-    """Return the CPU temperature as a Celsius float
-    """
-    cpu_temp = 'unknown'
-    with open("/sys/class/thermal/thermal_zone0/temp", "r") as temp_file:
-        cpu_temp = float(temp_file.read()) / 1000.0
+    def add_pins(self, pins):
+        """Configure more pins after setup(), e.g. on a configuration reload"""
+        self.setup(pins)
 
-    return cpu_temp
+    def notify(self, pin, stamp=None):
+        """Report a transition on pin, which may have happened at time stamp"""
+        if stamp is None:
+            stamp = time.time()
+        self.events.put((pin, stamp))
 
-def rpi_status():
-    """Return string summarizing RPi status
-    """
-    return "CPU temp: %.1f, GPU temp: %.1f, Uptime: %s" % (get_gpu_temp(), get_cpu_temp(), get_uptime())
+    def wake(self):
+        """Make wait() return early without reporting a transition"""
+        self.events.put((None, None))
 
-##############################################################################
-# Logging and alerts
-##############################################################################
+    def max_wait(self):
+        """Longest time wait() may sleep, or None for no limit"""
+        return None
 
-import demjson
+    def wait(self, timeout):
+        """Block until a transition is reported or timeout seconds pass.
 
-def create_event(door, state, time_in_state):
-    stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime())
+        Args:
+            timeout: Maximum number of seconds to wait.
 
-    event = { 
-        'timestamp': stamp,
-        'door': door,
-        'state': state,
-        'time': time_in_state,
-    }
+        Returns:
+            Dictionary mapping pin to the time.time() of its last reported
+            transition. Empty if the timeout expired.
+        """
+        limit = self.max_wait()
+        if limit is not None:
+            timeout = min(timeout, limit)
 
-    return str(demjson.encode(event))
+        changes = dict()
+        try:
+            pin, stamp = self.events.get(timeout=max(timeout, 0))
+            while True:
+                if pin is not None:
+                    changes[pin] = stamp
+                pin, stamp = self.events.get_nowait()
+        except queue.Empty:
+            pass
 
+        return changes
 
-def send_alerts(logger, alert_senders, recipients, subject, msg):
-    """Send subject and msg to specified recipients
+    def cleanup(self):
+        """Release any resources held by the backend"""
+        pass
 
-    Args:
-        recipients: An array of strings of the form type:address
-        subject: Subject of the alert
-        msg: Body of the alert
-    """
-    for recipient in recipients:
-        if recipient[:6] == 'email:':
-            alert_senders['Email'].send_email(recipient[6:], subject, msg)
-        elif recipient[:11] == 'twitter_dm:':
-            alert_senders['Twitter'].direct_msg(recipient[11:], msg)
-        elif recipient == 'tweet':
-            alert_senders['Twitter'].update_status(msg)
-        elif recipient[:4] == 'sms:':
-            alert_senders['Twilio'].send_sms(recipient[4:], msg)
-        elif recipient[:7] == 'jabber:':
-            alert_senders['Jabber'].send_msg(recipient[7:], msg)
-        elif recipient[:5] == 'mqtt:':
-            alert_senders['Mqtt'].publish(recipient[5:], msg)
-        else:
-            logger.error("Unrecognized recipient type: %s", recipient)
+class PollingSensor(SensorBackend):
+    """Reads every sensor with RPi.GPIO once per poll interval"""
 
-##############################################################################
-# Misc support
-##############################################################################
+    def __init__(self):
+        SensorBackend.__init__(self)
+        self.poll_interval = getattr(cfg, 'SENSOR_POLL_INTERVAL', 1)
+        self.resync_interval = 0
 
-def truncate(input_str, length):
-    """Truncate string to specified length
+    def setup(self, pins):
+        # Use Raspberry Pi board pin numbers
+        GPIO.setmode(GPIO.BOARD)
 
-    Args:
-        input_str: String to truncate
-        length: Maximum length of output string
-    """
-    if len(input_str) < (length - 3):
-        return input_str
+        # Configure the sensor pins as inputs with pull up resistors
+        for pin in pins:
+            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
-    return input_str[:(length - 3)] + '...'
+    def read(self, pin):
+        return get_garage_door_state(pin)
 
-def format_duration(duration_sec):
-    """Format a duration into a human friendly string"""
-    days, remainder = divmod(duration_sec, 86400)
-    hours, remainder = divmod(remainder, 3600)
-    minutes, seconds = divmod(remainder, 60)
+    def max_wait(self):
+        return self.poll_interval
 
-    ret = ''
-    if days > 1:
-        ret += "%d days " % (days)
-    elif days == 1:
-        ret += "%d day " % (days)
+    def cleanup(self):
+        GPIO.cleanup()
 
-    if hours > 1:
-        ret += "%d hours " % (hours)
-    elif hours == 1:
-        ret += "%d hour " % (hours)
+class GpioEdgeSensor(PollingSensor):
+    """Sleeps until RPi.GPIO reports an edge on one of the sensor pins"""
 
-    if minutes > 1:
-        ret += "%d minutes" % (minutes)
-    if minutes == 1:
-        ret += "%d minute" % (minutes)
+    def __init__(self):
+        PollingSensor.__init__(self)
+        self.bounce_ms = getattr(cfg, 'SENSOR_BOUNCE_MS', 50)
 
-    if ret == '':
-        ret += "%d seconds" % (seconds)
+        # Pins are still read periodically in case an edge is missed
+        self.resync_interval = getattr(cfg, 'SENSOR_RESYNC_INTERVAL', 60)
 
-    return ret
+    def setup(self, pins):
+        PollingSensor.setup(self, pins)
 
+        for pin in pins:
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.handle_edge,
+                                  bouncetime=self.bounce_ms)
 
-##############################################################################
-# Main functionality
-##############################################################################
-class PiGarageAlert(object):
-    """Class with main function of Pi Garage Alert"""
+    def handle_edge(self, pin):
+        """Called from the RPi.GPIO callback thread on every edge"""
+        self.notify(pin)
 
-    def __init__(self):
-        self.logger = logging.getLogger(__name__)
+    def max_wait(self):
+        return None
 
-    def main(self):
-        """Main functionality
-        """
+class SimulatedSensor(SensorBackend):
+    """Sensor backend for testing without Raspberry Pi hardware.
 
-        try:
-            # Set up logging
-            log_fmt = '%(asctime)-15s %(levelname)-8s %(message)s'
-            log_level = logging.INFO
+    Pin levels are changed with set_level(), or by writing lines of the form
+    "<pin> <level>" to the FIFO named by SENSOR_SIM_FIFO.
+    """
 
-            if sys.stdout.isatty():
-                # Connected to a real terminal - log to stdout
-                logging.basicConfig(format=log_fmt, level=log_level)
-            else:
-                # Background mode - log to file
-                logging.basicConfig(format=log_fmt, level=log_level, filename=cfg.LOG_FILENAME)
+    def __init__(self):
+        SensorBackend.__init__(self)
+        self.levels = dict()
+        self.lock = threading.Lock()
+        self.fifo_path = getattr(cfg, 'SENSOR_SIM_FIFO', None)
 
-            # Banner
-            self.logger.info("==========================================================")
-            self.logger.info("Pi Garage Alert starting")
+    def setup(self, pins):
+        for pin in pins:
+            self.levels.setdefault(pin, 0)
 
-            # Use Raspberry Pi board pin numbers
-            self.logger.info("Configuring global settings")
-            GPIO.setmode(GPIO.BOARD)
+        if self.fifo_path:
+            if not os.path.exists(self.fifo_path):
+                os.mkfifo(self.fifo_path)
+            reader = threading.Thread(target=self.read_fifo, name="sensor-sim")
+            reader.daemon = True
+            reader.start()
 
-            # Configure the sensor pins as inputs with pull up resistors
-            for door in cfg.GARAGE_DOORS:
-                self.logger.info("Configuring pin %d for \"%s\"", door['pin'], door['name'])
-                GPIO.setup(door['pin'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    def read(self, pin):
+        return level_to_state(self.levels.get(pin, 0))
 
-            # Last state of each garage door
-            door_states = dict()
+    def add_pins(self, pins):
+        for pin in pins:
+            self.levels.setdefault(pin, 0)
 
-            # time.time() of the last time the garage door changed state
-            time_of_last_state_change = dict()
+    def set_level(self, pin, level, stamp=None):
+        """Change the level of a simulated pin
 
-            # Index of the next alert to send for each garage door
-            alert_states = dict()
+        Args:
+            pin: Pin number.
+            level: New pin level (0 = closed, 1 = open).
+            stamp: time.time() of the transition. Defaults to now.
+        """
+        with self.lock:
+            changed = self.levels.get(pin, 0) != level
+            self.levels[pin] = level
+
+        if changed:
+            self.notify(pin, stamp)
+
+    def read_fifo(self):
+        """Apply pin level changes written to the simulation FIFO"""
+        while True:
+            # Opening blocks until a writer appears, and reads hit EOF
+            # when the last writer goes away, so reopen each time
+            with open(self.fifo_path, 'r') as fifo:
+                for line in fifo:
+                    try:
+                        pin, level = line.split()
+                        self.set_level(int(pin), int(level))
+                    except ValueError:
+                        self.logger.error("Ignoring bad simulated sensor input: %s", line.strip())
+
+# Broadcom GPIO number of each GPIO pin on the Raspberry Pi 40 pin header
+BOARD_TO_BCM = {
+    3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23,
+    18: 24, 19: 10, 21: 9, 22: 25, 23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5,
+    31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26, 38: 20, 40: 21,
+}
+
+class RegisterFile(object):
+    """Read only view of 32 bit little endian registers in a memory mapped
+    file such as /dev/gpiomem. Any file can stand in for testing."""
+
+    def __init__(self, path, size=4096):
+        """
+        Args:
+            path: Path of the file to map.
+            size: Number of bytes to map.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_SYNC)
+        try:
+            self.mem = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+    def read(self, offset):
+        """Return the register at byte offset"""
+        return struct.unpack_from('<I', self.mem, offset)[0]
+
+    def close(self):
+        """Unmap the file"""
+        self.mem.close()
+
+class MmapGpioSensor(SensorBackend):
+    """Reads every door sensor at once from the GPIO pin level register,
+    which is memory mapped from /dev/gpiomem.
+
+    A background thread reads the register every SENSOR_POLL_INTERVAL
+    seconds and reports the pins whose bits changed, so the main loop only
+    wakes for transitions. Each read is one memory access however many
+    doors there are, so short intervals are cheap. RPi.GPIO is only used,
+    if installed, to configure the pins as inputs with pull ups.
+
+    This works on the BCM2835, BCM2836, BCM2837 and BCM2711 (Raspberry Pi 1
+    to 4), where GPLEV0 holds the level of GPIO 0-31 at offset 0x34. All the
+    header pins are in that bank.
+    """
 
-            # Create alert sending objects
-            alert_senders = {
-                "Jabber": Jabber(door_states, time_of_last_state_change),
-                "Twitter": Twitter(),
-                "Twilio": Twilio(),
-                "Email": Email(),
-                "Mqtt": Mqtt()
-            }
+    def __init__(self, registers=None):
+        """
+        Args:
+            registers: RegisterFile to read. Defaults to SENSOR_GPIOMEM.
+        """
+        SensorBackend.__init__(self)
+        self.registers = registers
+        self.offset = getattr(cfg, 'SENSOR_GPIO_LEVEL_OFFSET', 0x34)
+        self.poll_interval = getattr(cfg, 'SENSOR_POLL_INTERVAL', 1)
+
+        # Pins are still all read periodically, like the edge backend
+        self.resync_interval = getattr(cfg, 'SENSOR_RESYNC_INTERVAL', 60)
+
+        # Pin number -> bit of the pin in the level register
+        self.masks = dict()
+        self.mask = 0
+        self.level = 0
+        self.stopping = False
+        self.sampler = None
+
+    def setup(self, pins):
+        if self.registers is None:
+            self.registers = RegisterFile(getattr(cfg, 'SENSOR_GPIOMEM', '/dev/gpiomem'))
+        if GPIO is not None:
+            GPIO.setmode(GPIO.BOARD)
+        else:
+            self.logger.warning("RPi.GPIO is not installed - pins must already be inputs with pull ups")
+
+        self.add_pins(pins)
+        self.level = self.registers.read(self.offset)
+
+        self.sampler = threading.Thread(target=self.sample, name="sensor-mmap")
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def add_pins(self, pins):
+        # The sampler thread may be using the masks, so they are replaced
+        # rather than changed
+        masks = dict(self.masks)
+        for pin in pins:
+            if pin not in BOARD_TO_BCM:
+                raise ValueError("Pin %d is not a GPIO pin" % pin)
+            if GPIO is not None:
+                GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            masks[pin] = 1 << BOARD_TO_BCM[pin]
+        combined = 0
+        for mask in masks.values():
+            combined |= mask
+        self.masks = masks
+        self.mask = combined
+
+    def sample(self):
+        """Sampler thread main loop"""
+        # time.sleep() rather than Event.wait(), which polls on Python 2
+        while not self.stopping:
+            time.sleep(self.poll_interval)
+            level = self.registers.read(self.offset)
+            changed = (level ^ self.level) & self.mask
+            self.level = level
+            if changed:
+                now = time.time()
+                for pin, mask in self.masks.items():
+                    if changed & mask:
+                        self.notify(pin, now)
+
+    def read(self, pin):
+        return level_to_state(self.registers.read(self.offset) & self.masks[pin])
+
+    def read_all(self, pins):
+        level = self.registers.read(self.offset)
+        return dict((pin, level_to_state(level & self.masks[pin])) for pin in pins)
+
+    def cleanup(self):
+        self.stopping = True
+        if self.sampler is not None:
+            self.sampler.join()
+        if GPIO is not None:
+            GPIO.cleanup()
+        self.registers.close()
+
+SENSOR_BACKENDS = {
+    'poll': PollingSensor,
+    'edge': GpioEdgeSensor,
+    'simulated': SimulatedSensor,
+    'mmap': MmapGpioSensor,
+}
+
+def create_sensor_backend(name):
+    """Instantiate the named sensor backend
 
-            # Read initial states
-            for door in cfg.GARAGE_DOORS:
-                name = door['name']
-                state = get_garage_door_state(door['pin'])
+    Args:
+        name: Key into SENSOR_BACKENDS.
+    """
+    if name not in SENSOR_BACKENDS:
+        raise ValueError("Unknown sensor backend: %s" % name)
 
-                door_states[name] = state
-                time_of_last_state_change[name] = time.time()
-                alert_states[name] = 0
+    if name in ('poll', 'edge') and GPIO is None:
+        raise ImportError("RPi.GPIO is required for the %s sensor backend" % name)
 
-                self.logger.info("Initial state of \"%s\" is %s", name, state)
+    return SENSOR_BACKENDS[name]()
 
-            status_report_countdown = 5
-            while True:
-                for door in cfg.GARAGE_DOORS:
-                    name = door['name']
-                    state = get_garage_door_state(door['pin'])
-                    time_in_state = time.time() - time_of_last_state_change[name]
-
-                    # Check if the door has changed state
-                    if door_states[name] != state:
-                        door_states[name] = state
-                        time_of_last_state_change[name] = time.time()
-                        self.logger.info("State of \"%s\" changed to %s after %.0f sec", name, state, time_in_state)
-
-                        # Reset alert when door changes state
-                        if alert_states[name] > 0:
-                            # Use the recipients of the last alert
-                            recipients = door['alerts'][alert_states[name] - 1]['recipients']
-                            event = create_event(name, state, round(time_in_state));
-                            send_alerts(self.logger, alert_senders, recipients, name, event)
-                            #send_alerts(self.logger, alert_senders, recipients, name, "%s is now %s" % (name, state))
-                            alert_states[name] = 0
-
-                        # Reset time_in_state
-                        time_in_state = 0
-
-                    # See if there are more alerts
-                    if len(door['alerts']) > alert_states[name]:
-                        # Get info about alert
-                        alert = door['alerts'][alert_states[name]]
-
-                        # Has the time elapsed and is this the state to trigger the alert?
-                        if time_in_state > alert['time'] and state == alert['state']:
-                            event = create_event(name, state, round(time_in_state));
-                            send_alerts(self.logger, alert_senders, alert['recipients'], name, event)
-                            #send_alerts(self.logger, alert_senders, alert['recipients'], name, "%s has been %s for %d seconds!" % (name, state, time_in_state))
-                            alert_states[name] += 1
+def next_alert_deadline(door, state, alert_index, time_of_change):
+    """Return the time.time() when the next alert for a door is due, or None
 
-                # Periodically log the status for debug and ensuring RPi doesn't get too hot
-                status_report_countdown -= 1
-                if status_report_countdown <= 0:
-                    status_msg = rpi_status()
+    Args:
+        door: Door entry from GARAGE_DOORS.
+        state: Current state of the door.
+        alert_index: Index of the next alert to send for the door.
+        time_of_change: time.time() of the door's last state change.
+    """
+    if alert_index < len(door['alerts']):
+        alert = door['alerts'][alert_index]
+        if alert['state'] == state:
+            return time_of_change + alert['time']
 
-                    for name in door_states:
-                        status_msg += ", %s: %s/%d/%d" % (name, door_states[name], alert_states[name], (time.time() - time_of_last_state_change[name]))
+    return None
 
-                    self.logger.info(status_msg)
+##############################################################################
+# Telemetry
+##############################################################################
+
+class TelemetrySampler(object):
+    """Samples the RPi's temperatures and uptime on a background thread.
+
+    The sysfs/procfs files and /dev/vcio stay open and are re-read with
+    pread, so a sample costs a few system calls and no fork. The last
+    TELEMETRY_HISTORY samples are kept in a ring buffer.
+    """
+
+    UPTIME_PATH = '/proc/uptime'
+    CPU_TEMP_PATH = '/sys/class/thermal/thermal_zone0/temp'
+    VCIO_PATH = '/dev/vcio'
+
+    # Mailbox property interface: _IOWR(100, 0, char *)
+    IOCTL_MBOX_PROPERTY = 0xc0006400 | (struct.calcsize('P') << 16)
+
+    # Mailbox property tag to read the SoC temperature
+    TAG_GET_TEMPERATURE = 0x00030006
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.interval = getattr(cfg, 'TELEMETRY_INTERVAL', 60)
+        self.samples = collections.deque(maxlen=getattr(cfg, 'TELEMETRY_HISTORY', 60))
+        self.fds = dict()
+        self.lock = threading.Lock()
+        self.use_vcgencmd = True
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def open(self, path):
+        """Return a file descriptor for path, keeping it open for reuse"""
+        if path not in self.fds:
+            try:
+                self.fds[path] = os.open(path, os.O_RDONLY)
+            except OSError:
+                self.fds[path] = None
+        return self.fds[path]
+
+    def pread(self, path):
+        """Read the whole of a small sysfs/procfs file, or None"""
+        fd = self.open(path)
+        if fd is None:
+            return None
+        if hasattr(os, 'pread'):
+            return os.pread(fd, 256, 0).decode('ascii')
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, 256).decode('ascii')
+
+    def read_uptime(self):
+        """Return the uptime in seconds, or None"""
+        data = self.pread(self.UPTIME_PATH)
+        if data is None:
+            return None
+        return int(float(data.split()[0]))
+
+    def read_cpu_temp(self):
+        """Return the CPU temperature as a Celsius float, or None"""
+        data = self.pread(self.CPU_TEMP_PATH)
+        if data is None:
+            return None
+        return float(data) / 1000.0
+
+    def read_gpu_temp(self):
+        """Return the GPU temperature as a Celsius float, or None.
+
+        Asks the VideoCore firmware through the /dev/vcio mailbox, falling
+        back to running vcgencmd if the mailbox is unavailable.
+        """
+        fd = self.open(self.VCIO_PATH)
+        if fd is not None:
+            buf = array.array('I', [8 * 4, 0, self.TAG_GET_TEMPERATURE, 8, 4, 0, 0, 0])
+            try:
+                fcntl.ioctl(fd, self.IOCTL_MBOX_PROPERTY, buf, True)
+                if buf[1] == 0x80000000:
+                    return buf[6] / 1000.0
+            except IOError:
+                pass
+
+        if not self.use_vcgencmd:
+            return None
+
+        try:
+            measure_temp_proc = subprocess.Popen(['vcgencmd', 'measure_temp'], stdout=subprocess.PIPE)
+            output = measure_temp_proc.communicate()[0].decode('ascii', 'replace')
+        except OSError:
+            # Not worth retrying on every sample
+            self.use_vcgencmd = False
+            return None
+
+        gpu_search = re.search('([0-9.]+)', output)
+        if gpu_search:
+            return float(gpu_search.group(1))
+        return None
+
+    def sample(self):
+        """Take a sample and add it to the history"""
+        with self.lock:
+            sample = {
+                'time': time.time(),
+                'uptime': self.read_uptime(),
+                'cpu_temp': self.read_cpu_temp(),
+                'gpu_temp': self.read_gpu_temp(),
+            }
+            self.samples.append(sample)
+        return sample
+
+    def latest(self):
+        """Return the most recent sample, taking one if the last is stale"""
+        if self.samples:
+            sample = self.samples[-1]
+            if time.time() - sample['time'] < 2 * self.interval:
+                return sample
+        return self.sample()
+
+    def reading(self, name):
+        """Return one reading from the most recent sample, or None if there
+        isn't a recent one. Never takes a sample, so it is safe to call
+        from threads that mustn't wait for vcgencmd."""
+        samples = self.history()
+        if samples and time.time() - samples[-1]['time'] < 2 * self.interval:
+            return samples[-1][name]
+        return None
+
+    def history(self):
+        """Return the samples in the history, oldest first"""
+        return list(self.samples)
+
+    def run(self):
+        """Sampler thread main loop"""
+        while True:
+            try:
+                self.sample()
+            except:
+                self.logger.error("Exception sampling telemetry: %s", sys.exc_info()[0])
+            if self.stopping.wait(self.interval):
+                return
+
+    def start(self):
+        """Start sampling in the background"""
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="telemetry")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and close the files"""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        for fd in self.fds.values():
+            if fd is not None:
+                os.close(fd)
+        self.fds = dict()
+
+# Shared by the status report and anything else that wants telemetry
+TELEMETRY = TelemetrySampler()
+
+def format_reading(value, fmt):
+    """Format a telemetry reading that may be missing"""
+    if value is None:
+        return 'unknown'
+    return fmt % value
+
+def rpi_status():
+    """Return string summarizing RPi status
+    """
+    sample = TELEMETRY.latest()
+    uptime = None
+    if sample['uptime'] is not None:
+        uptime = str(timedelta(seconds=sample['uptime']))
+
+    return "CPU temp: %s, GPU temp: %s, Uptime: %s" % (
+        format_reading(sample['cpu_temp'], '%.1f'),
+        format_reading(sample['gpu_temp'], '%.1f'),
+        format_reading(uptime, '%s'))
+
+##############################################################################
+# Metrics
+##############################################################################
+
+class ThreadShards(object):
+    """Per-thread copies of a list of numbers.
+
+    Each thread only ever updates its own copy, so updates take no lock.
+    Readers add the copies together. Once a thread has exited, its copy is
+    added to a shared base and dropped, so short-lived threads such as
+    HTTP request handlers don't make the list grow.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.base = [0] * size
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Return the calling thread's copy"""
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = [0] * self.size
+            with self.lock:
+                self.merge_finished()
+                self.shards.append((threading.current_thread(), shard))
+            self.local.shard = shard
+            return shard
+
+    def merge_finished(self):
+        """Add the copies of exited threads to the base. Called with the
+        lock held."""
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                for index, value in enumerate(shard):
+                    self.base[index] += value
+        self.shards = live
+
+    def total(self):
+        """Return the sum of every thread's copy"""
+        with self.lock:
+            self.merge_finished()
+            shards = [shard for _, shard in self.shards]
+            totals = list(self.base)
+        for shard in shards:
+            for index, value in enumerate(shard):
+                totals[index] += value
+        return totals
+
+def format_labels(names, values, extra=''):
+    """Return a Prometheus label set such as {channel="Email"}"""
+    labels = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(labels) + '}'
+
+class Metric(object):
+    """Base class for metrics. Labelled metrics keep one set of shards for
+    each combination of label values."""
+
+    TYPE = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.children = dict()
+        self.lock = threading.Lock()
+
+    def shards(self, labels):
+        """Return the shards for a tuple of label values"""
+        shards = self.children.get(labels)
+        if shards is None:
+            with self.lock:
+                shards = self.children.setdefault(labels, ThreadShards(self.size()))
+        return shards
+
+    def size(self):
+        """Number of values kept in each shard"""
+        return 1
+
+    def samples(self):
+        """Return the metric's exposition lines"""
+        raise NotImplementedError
+
+    def render(self):
+        """Return the metric in Prometheus text format"""
+        lines = ["# HELP %s %s" % (self.name, self.doc), "# TYPE %s %s" % (self.name, self.TYPE)]
+        return '\n'.join(lines + self.samples())
+
+class Counter(Metric):
+    """Count that only goes up"""
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        """Add amount to the count for the label values"""
+        self.shards(labels).get()[0] += amount
+
+    def samples(self):
+        return ["%s%s %s" % (self.name, format_labels(self.labelnames, labels), shards.total()[0])
+                for labels, shards in sorted(self.children.items())]
+
+class Histogram(Metric):
+    """Counts of observations in fixed buckets, plus their sum"""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, doc, buckets, labelnames=()):
+        """
+        Args:
+            name: Metric name.
+            doc: Help text.
+            buckets: Upper bounds of the buckets, in increasing order. A
+                     bucket for larger values is added.
+            labelnames: Names of the metric's labels.
+        """
+        self.buckets = list(buckets)
+        Metric.__init__(self, name, doc, labelnames)
+
+    def size(self):
+        # One count per bucket, the overflow bucket, and the sum
+        return len(self.buckets) + 2
+
+    def observe(self, value, labels=()):
+        """Record an observation for the label values"""
+        shard = self.shards(labels).get()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def samples(self):
+        lines = []
+        for labels, shards in sorted(self.children.items()):
+            totals = shards.total()
+            count = 0
+            for bound, value in zip(self.buckets + ['+Inf'], totals):
+                count += value
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(self.labelnames, labels,
+                                                                           'le="%s"' % bound), count))
+            lines.append("%s_sum%s %r" % (self.name, format_labels(self.labelnames, labels), totals[-1]))
+            lines.append("%s_count%s %d" % (self.name, format_labels(self.labelnames, labels), count))
+        return lines
+
+class Gauge(Metric):
+    """Value read from a function each time the metrics are collected"""
+
+    TYPE = 'gauge'
+
+    def __init__(self, name, doc, read, labelnames=()):
+        """
+        Args:
+            name: Metric name.
+            doc: Help text.
+            read: Function returning a list of (label values, value)
+                  tuples. Values of None are left out.
+            labelnames: Names of the metric's labels.
+        """
+        Metric.__init__(self, name, doc, labelnames)
+        self.read = read
+
+    def samples(self):
+        return ["%s%s %r" % (self.name, format_labels(self.labelnames, labels), value)
+                for labels, value in self.read() if value is not None]
+
+class MetricsRegistry(object):
+    """Collection of metrics served in Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = collections.OrderedDict()
+
+    def register(self, metric):
+        """Add a metric, replacing any with the same name"""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labelnames=()):
+        """Create and register a Counter"""
+        return self.register(Counter(name, doc, labelnames))
+
+    def histogram(self, name, doc, buckets, labelnames=()):
+        """Create and register a Histogram"""
+        return self.register(Histogram(name, doc, buckets, labelnames))
+
+    def gauge(self, name, doc, read, labelnames=()):
+        """Create and register a Gauge"""
+        return self.register(Gauge(name, doc, read, labelnames))
+
+    def render(self):
+        """Return every metric in Prometheus text format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+METRICS = MetricsRegistry()
+
+# Bucket bounds in seconds
+FAST_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+SEND_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LOOP_SECONDS = METRICS.histogram(
+    'pi_garage_loop_duration_seconds', "Time spent on each pass of the main loop, excluding sleep",
+    FAST_BUCKETS)
+GPIO_READ_SECONDS = METRICS.histogram(
+    'pi_garage_gpio_read_seconds', "Time taken to read the door sensors on a pass of the main loop",
+    FAST_BUCKETS)
+SEND_SECONDS = METRICS.histogram(
+    'pi_garage_alert_send_seconds', "Time taken to send an alert", SEND_BUCKETS, ('channel',))
+ALERTS_SENT = METRICS.counter(
+    'pi_garage_alerts_sent_total', "Alerts sent", ('channel',))
+ALERT_ERRORS = METRICS.counter(
+    'pi_garage_alert_errors_total', "Alerts that failed to send", ('channel',))
+
+METRICS.gauge('pi_garage_cpu_temperature_celsius', "CPU temperature",
+              lambda: [((), TELEMETRY.reading('cpu_temp'))])
+METRICS.gauge('pi_garage_gpu_temperature_celsius', "GPU temperature",
+              lambda: [((), TELEMETRY.reading('gpu_temp'))])
+METRICS.gauge('pi_garage_uptime_seconds', "System uptime",
+              lambda: [((), TELEMETRY.reading('uptime'))])
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request on its own thread"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+class HttpEndpoint(object):
+    """Small HTTP server for local monitoring.
+
+    Pages are registered with add_route() and served from a background
+    thread. A page handler is called with the BaseHTTPRequestHandler and
+    returns a (status, content type, body) tuple. If body is an iterator
+    rather than a string, each string it yields is sent as soon as it is
+    produced, until the iterator ends or the client disconnects.
+    """
+
+    def __init__(self, address, port):
+        self.logger = logging.getLogger(__name__)
+        self.routes = dict()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Passes requests to the endpoint"""
+
+            def do_GET(self):
+                # pylint: disable=invalid-name
+                endpoint.handle(self)
+
+            def log_message(self, format, *args):
+                # pylint: disable=redefined-builtin
+                endpoint.logger.debug("HTTP %s - %s", self.client_address[0], format % args)
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.thread = None
+
+    def add_route(self, path, handler):
+        """Serve the page returned by handler(request) at path"""
+        self.routes[path] = handler
+
+    def handle(self, request):
+        """Serve one request"""
+        handler = self.routes.get(request.path.split('?')[0])
+        if handler is None:
+            status, content_type, body = 404, 'text/plain', "Not found\n"
+        else:
+            try:
+                status, content_type, body = handler(request)
+            except:
+                self.logger.error("Exception serving %s: %s", request.path, sys.exc_info()[0])
+                status, content_type, body = 500, 'text/plain', "Internal error\n"
+
+        if not hasattr(body, 'encode'):
+            self.stream(request, status, content_type, body)
+            return
+
+        body = body.encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def stream(self, request, status, content_type, chunks):
+        """Send each string yielded by chunks as it is produced"""
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Cache-Control', 'no-cache')
+        request.end_headers()
+        try:
+            for chunk in chunks:
+                request.wfile.write(chunk.encode('utf-8'))
+                request.wfile.flush()
+        except (IOError, OSError):
+            # The client went away
+            pass
+        finally:
+            chunks.close()
+
+    def start(self):
+        """Start serving in the background"""
+        self.logger.info("Serving HTTP on %s:%d", *self.server.server_address[:2])
+        self.thread = threading.Thread(target=self.server.serve_forever, name="http")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving"""
+        if self.thread is not None:
+            self.server.shutdown()
+        self.server.server_close()
+
+##############################################################################
+# Status API
+##############################################################################
+
+def iso_time(stamp):
+    """Return a time.time() value as a local ISO 8601 string"""
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(stamp))
+
+class StatusFeed(object):
+    """DoorMonitor listener serving door states over HTTP.
+
+    /status returns the state of every door as JSON. The document is only
+    rendered again after a door changes, so polling it is cheap. /events
+    is a Server-Sent Events stream of transitions and alerts; a client
+    that reconnects with a Last-Event-ID header is sent the events it
+    missed, if they are among the last `backlog` events.
+    """
+
+    def __init__(self, backlog=100, keepalive=30):
+        """
+        Args:
+            backlog: Number of recent events kept for reconnecting clients.
+            keepalive: Seconds between keep-alive comments on idle streams.
+        """
+        self.keepalive = keepalive
+        self.doors = collections.OrderedDict()
+        self.events = collections.deque(maxlen=backlog)
+        self.last_id = 0
+        self.cond = threading.Condition()
+        self.snapshot = None
+        self.stopping = False
+
+    def sync(self, monitor):
+        """Copy the state of every door from a DoorMonitor. Called at
+        startup and after a configuration reload, from the main loop."""
+        doors = collections.OrderedDict()
+        for door in cfg.GARAGE_DOORS:
+            name = door['name']
+            doors[name] = (monitor.door_states[name], monitor.time_of_last_state_change[name],
+                           monitor.alert_states[name])
+        with self.cond:
+            self.doors = doors
+            self.snapshot = None
+
+    def add_event(self, event_type, data):
+        """Record an event and wake the streams"""
+        self.last_id += 1
+        self.events.append((self.last_id, "id: %d\nevent: %s\ndata: %s\n\n" % (self.last_id, event_type, data)))
+        self.snapshot = None
+        self.cond.notify_all()
+
+    def door_changed(self, name, state, when, time_in_previous_state):
+        """Record a transition"""
+        event = EVENT_ENCODER.create(name, state, time_in_previous_state, when)
+        with self.cond:
+            self.doors[name] = (state, when, 0)
+            self.add_event('door', event.payload('json'))
+
+    def alert_sent(self, name, state, alert_index, when):
+        """Record an alert"""
+        with self.cond:
+            if name in self.doors:
+                self.doors[name] = (state, self.doors[name][1], alert_index + 1)
+            self.add_event('alert', json.dumps({'door': name, 'state': state, 'alert': alert_index,
+                                                'timestamp': iso_time(when)}, sort_keys=True))
+
+    def status_page(self, request):
+        """Serve /status"""
+        # pylint: disable=unused-argument
+        with self.cond:
+            if self.snapshot is None:
+                self.snapshot = json.dumps({
+                    'event_id': self.last_id,
+                    'doors': [{'name': name, 'state': state, 'since': iso_time(since),
+                               'since_epoch': round(since, 3), 'alerts_sent': alerts_sent}
+                              for name, (state, since, alerts_sent) in self.doors.items()],
+                }, sort_keys=True) + '\n'
+            return 200, 'application/json', self.snapshot
+
+    def events_page(self, request):
+        """Serve /events"""
+        try:
+            last_id = int(request.headers.get('Last-Event-ID', self.last_id))
+        except ValueError:
+            last_id = self.last_id
+        return 200, 'text/event-stream', self.stream(last_id)
+
+    def stream(self, last_id):
+        """Yield the events after last_id as they happen"""
+        yield "retry: 5000\n\n"
+        while True:
+            with self.cond:
+                pending = [text for event_id, text in self.events if event_id > last_id]
+                if not pending and not self.stopping:
+                    self.cond.wait(self.keepalive)
+                    pending = [text for event_id, text in self.events if event_id > last_id]
+                last_id = self.last_id
+                stopping = self.stopping
+
+            if stopping:
+                return
+            yield ''.join(pending) if pending else ": keep-alive\n\n"
+
+    def stop(self):
+        """End the streams"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+
+##############################################################################
+# Sensor filtering
+##############################################################################
+
+class MajorityFilter(object):
+    """N-of-M filter: the output follows the input once at least `required`
+    of the last `samples` readings agree"""
+
+    def __init__(self, samples=5, required=None):
+        self.window = collections.deque(maxlen=samples)
+        self.required = required or (samples // 2 + 1)
+        self.level = 0
+
+    def reset(self, level):
+        """Set the output level without filtering"""
+        self.window.clear()
+        self.level = level
+
+    def update(self, level, now):
+        """Feed one reading and return the filtered level
+
+        Args:
+            level: Raw pin level, 0 or 1.
+            now: time.time() of the reading.
+        """
+        # pylint: disable=unused-argument
+        self.window.append(level)
+        ones = sum(self.window)
+        if ones >= self.required:
+            self.level = 1
+        elif len(self.window) - ones >= self.required:
+            self.level = 0
+        return self.level
+
+class StableTimeFilter(object):
+    """The output follows the input once it has been stable for `time` seconds"""
+
+    def __init__(self, time=0.2):
+        # pylint: disable=redefined-outer-name
+        self.stable_time = time
+        self.level = 0
+        self.candidate = 0
+        self.since = None
+
+    def reset(self, level):
+        """Set the output level without filtering"""
+        self.level = self.candidate = level
+        self.since = None
+
+    def update(self, level, now):
+        """Feed one reading and return the filtered level"""
+        if level != self.candidate or self.since is None:
+            self.candidate = level
+            self.since = now
+        if level != self.level and now - self.since >= self.stable_time:
+            self.level = level
+        return self.level
+
+class SchmittFilter(object):
+    """Counts up on high readings and down on low readings. The output goes
+    high when the count reaches `threshold` and low when it reaches 0."""
+
+    def __init__(self, threshold=3):
+        self.threshold = threshold
+        self.count = 0
+        self.level = 0
+
+    def reset(self, level):
+        """Set the output level without filtering"""
+        self.level = level
+        self.count = self.threshold if level else 0
+
+    def update(self, level, now):
+        """Feed one reading and return the filtered level"""
+        # pylint: disable=unused-argument
+        if level:
+            self.count = min(self.count + 1, self.threshold)
+        else:
+            self.count = max(self.count - 1, 0)
+
+        if self.count == self.threshold:
+            self.level = 1
+        elif self.count == 0:
+            self.level = 0
+        return self.level
+
+DOOR_FILTERS = {
+    'majority': MajorityFilter,
+    'stable': StableTimeFilter,
+    'schmitt': SchmittFilter,
+}
+
+def create_door_filter(spec):
+    """Create a filter from the 'filter' entry of a door in GARAGE_DOORS
+
+    Args:
+        spec: Dictionary with a 'type' key naming the filter in DOOR_FILTERS.
+              The other keys are passed to the filter's constructor.
+    """
+    args = dict(spec)
+    filter_type = args.pop('type')
+    if filter_type not in DOOR_FILTERS:
+        raise ValueError("Unknown sensor filter: %s" % filter_type)
+    return DOOR_FILTERS[filter_type](**args)
+
+def replay_trace(door_filter, trace):
+    """Run a recorded sensor trace through a filter
+
+    Args:
+        door_filter: Filter object, e.g. from create_door_filter().
+        trace: List of (time, level) readings, starting with the settled level.
+
+    Returns:
+        List of (time, level) transitions of the filtered output.
+    """
+    door_filter.reset(trace[0][1])
+    level = trace[0][1]
+    transitions = []
+    for stamp, raw in trace[1:]:
+        filtered = door_filter.update(raw, stamp)
+        if filtered != level:
+            level = filtered
+            transitions.append((stamp, level))
+    return transitions
+
+class FilteredSensor(SensorBackend):
+    """Debounces another sensor backend.
+
+    Pins with a filter are sampled every SENSOR_SAMPLE_INTERVAL seconds on a
+    background thread, and a transition is only reported when the filtered
+    level changes. Other pins are passed straight through.
+    """
+
+    def __init__(self, backend, filters):
+        """
+        Args:
+            backend: SensorBackend that reads the raw pin levels.
+            filters: Dictionary mapping pin number to filter object.
+        """
+        SensorBackend.__init__(self)
+        self.backend = backend
+        self.filters = filters
+        self.levels = dict()
+        self.sample_interval = getattr(cfg, 'SENSOR_SAMPLE_INTERVAL', 0.02)
+        self.stopping = threading.Event()
+        self.sampler = None
+
+        # Raw transitions from the backend still wake the main loop
+        self.events = backend.events
+        self.resync_interval = backend.resync_interval
+
+    def setup(self, pins):
+        self.backend.setup(pins)
+
+        for pin, door_filter in self.filters.items():
+            level = int(self.backend.read(pin) == 'open')
+            door_filter.reset(level)
+            self.levels[pin] = level
+
+        self.sampler = threading.Thread(target=self.sample, name="sensor-filter")
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def sample(self):
+        """Sampler thread main loop"""
+        while not self.stopping.wait(self.sample_interval):
+            now = time.time()
+            states = self.backend.read_all(self.filters)
+            for pin, door_filter in self.filters.items():
+                level = door_filter.update(int(states[pin] == 'open'), now)
+                if level != self.levels[pin]:
+                    self.levels[pin] = level
+                    self.notify(pin, now)
+
+    def read(self, pin):
+        if pin in self.levels:
+            return level_to_state(self.levels[pin])
+        return self.backend.read(pin)
+
+    def read_all(self, pins):
+        states = self.backend.read_all([pin for pin in pins if pin not in self.levels])
+        for pin in pins:
+            if pin in self.levels:
+                states[pin] = level_to_state(self.levels[pin])
+        return states
+
+    def add_pins(self, pins):
+        # Pins added later are not filtered
+        self.backend.add_pins(pins)
+
+    def max_wait(self):
+        return self.backend.max_wait()
+
+    def cleanup(self):
+        self.stopping.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        self.backend.cleanup()
+
+##############################################################################
+# Alert scheduling
+##############################################################################
+
+class AlertScheduler(object):
+    """Priority queue of the time each door's next alert is due.
+
+    Rescheduling a door does not search the heap; older entries for the door
+    are recognized as stale by their generation number and skipped when they
+    reach the top.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.generation = dict()
+
+    def schedule(self, name, deadline):
+        """Set the time the next alert for a door is due
+
+        Args:
+            name: Name of the door.
+            deadline: time.time() the alert is due, or None to cancel.
+        """
+        generation = self.generation.get(name, 0) + 1
+        self.generation[name] = generation
+
+        if deadline is not None:
+            heapq.heappush(self.heap, (deadline, generation, name))
+
+            # Rebuild the heap if stale entries start to dominate it
+            if len(self.heap) > 2 * len(self.generation) + 64:
+                self.heap = [entry for entry in self.heap
+                             if self.generation.get(entry[2]) == entry[1]]
+                heapq.heapify(self.heap)
+
+    def remove(self, name):
+        """Forget a door entirely"""
+        self.generation.pop(name, None)
+
+    def next_deadline(self):
+        """Return the earliest pending deadline, or None"""
+        while self.heap:
+            deadline, generation, name = self.heap[0]
+            if self.generation.get(name) == generation:
+                return deadline
+            heapq.heappop(self.heap)
+
+        return None
+
+    def pop_due(self, now):
+        """Remove and return the names of doors whose deadline is <= now"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, generation, name = heapq.heappop(self.heap)
+            if self.generation.get(name) == generation:
+                due.append(name)
+
+        return due
+
+class DoorMonitor(object):
+    """Tracks the state of each door and sends alerts when they fall due.
+
+    Work per tick is proportional to the number of doors that changed state
+    plus the number of alerts due, not the number of doors.
+    """
+
+    def __init__(self, send):
+        """
+        Args:
+            send: Function called as send(recipients, subject, msg) to
+                  deliver an alert.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.send = send
+        self.doors = dict()
+        self.scheduler = AlertScheduler()
+
+        # Objects notified of every transition and alert. Each has methods
+        # door_changed(name, state, when, time_in_previous_state) and
+        # alert_sent(name, state, alert_index, when).
+        self.listeners = []
+
+        # Last state of each garage door
+        self.door_states = dict()
+
+        # time.time() of the last time the garage door changed state
+        self.time_of_last_state_change = dict()
+
+        # Index of the next alert to send for each garage door
+        self.alert_states = dict()
+
+        # Time of the last run_due() call
+        self.last_run = None
+
+    def add_door(self, door, state, now, alert_index=0):
+        """Start monitoring a door
+
+        Args:
+            door: Door entry from GARAGE_DOORS.
+            state: Current state of the door.
+            now: time.time() the door entered this state.
+            alert_index: Index of the next alert to send for the door.
+        """
+        name = door['name']
+        self.doors[name] = door
+        self.door_states[name] = state
+        self.time_of_last_state_change[name] = now
+        self.alert_states[name] = min(alert_index, len(door['alerts']))
+        self.reschedule(name)
+
+    def remove_door(self, name):
+        """Stop monitoring a door"""
+        self.scheduler.remove(name)
+        for states in (self.doors, self.door_states, self.time_of_last_state_change, self.alert_states):
+            del states[name]
+
+    def replace_door(self, door):
+        """Change the configuration of a door, keeping its state and alert progress
+
+        Args:
+            door: New door entry from GARAGE_DOORS.
+        """
+        name = door['name']
+        self.doors[name] = door
+        self.alert_states[name] = min(self.alert_states[name], len(door['alerts']))
+        self.reschedule(name)
+
+    def save(self):
+        """Return a copy of the doors and their states, for restore()"""
+        return tuple(dict(states) for states in (self.doors, self.door_states,
+                                                 self.time_of_last_state_change, self.alert_states))
+
+    def restore(self, saved):
+        """Put the doors and their states back as they were when save() was
+        called, e.g. after a failed configuration reload.
+
+        The dictionaries are updated in place, as other objects hold
+        references to them.
+
+        Args:
+            saved: Value returned by save().
+        """
+        for states, old in zip((self.doors, self.door_states,
+                                self.time_of_last_state_change, self.alert_states), saved):
+            states.clear()
+            states.update(old)
+        self.scheduler = AlertScheduler()
+        for name in self.doors:
+            self.reschedule(name)
+
+    def reschedule(self, name):
+        """Recompute when the next alert for a door is due"""
+        self.scheduler.schedule(name, next_alert_deadline(
+            self.doors[name], self.door_states[name], self.alert_states[name],
+            self.time_of_last_state_change[name]))
+
+    def update(self, name, state, when, now):
+        """Record the latest state of a door
+
+        Args:
+            name: Name of the door.
+            state: State read from the sensor.
+            when: time.time() the door changed to this state.
+            now: Current time.time().
+
+        Returns:
+            True if the door changed state.
+        """
+        # pylint: disable=unused-argument
+        if self.door_states[name] == state:
+            return False
+
+        # The previous state ended at the transition, not when the loop
+        # got round to it
+        time_in_state = when - self.time_of_last_state_change[name]
+        self.door_states[name] = state
+        self.time_of_last_state_change[name] = when
+        self.logger.info("State of \"%s\" changed to %s after %.0f sec", name, state, time_in_state)
+
+        # Reset alert when door changes state
+        if self.alert_states[name] > 0:
+            # Use the recipients of the last alert
+            door = self.doors[name]
+            recipients = door['alerts'][self.alert_states[name] - 1]['recipients']
+            event = create_event(name, state, round(time_in_state))
+            self.send(recipients, name, event)
+            #self.send(recipients, name, "%s is now %s" % (name, state))
+            self.alert_states[name] = 0
+
+        self.notify('door_changed', name, state, when, time_in_state)
+
+        self.reschedule(name)
+        return True
+
+    def notify(self, method, *args):
+        """Call a method of every listener. A failing listener is logged
+        and skipped, so it can't stop the alerts."""
+        for listener in self.listeners:
+            try:
+                getattr(listener, method)(*args)
+            except Exception:
+                self.logger.error("Exception in %s.%s: %s", type(listener).__name__, method, sys.exc_info()[0])
+                self.logger.debug("%s", traceback.format_exc())
+
+    def run_due(self, now):
+        """Send every alert that is due at time now
+
+        An alert that fell due since the last call is reported at its
+        deadline, so the loop's latency doesn't add to the time in state.
+        One that was already due, e.g. while the daemon was stopped, is
+        reported at time now.
+        """
+        last_run, self.last_run = self.last_run, now
+        for name in self.scheduler.pop_due(now):
+            alert = self.doors[name]['alerts'][self.alert_states[name]]
+            state = self.door_states[name]
+            when = self.time_of_last_state_change[name] + alert['time']
+            if last_run is None or when <= last_run:
+                when = now
+            time_in_state = when - self.time_of_last_state_change[name]
+
+            event = create_event(name, state, round(time_in_state))
+            self.send(alert['recipients'], name, event)
+            #self.send(alert['recipients'], name, "%s has been %s for %d seconds!" % (name, state, time_in_state))
+            self.notify('alert_sent', name, state, self.alert_states[name], when)
+            self.alert_states[name] += 1
+            self.reschedule(name)
+
+    def next_deadline(self):
+        """Return the time.time() the next alert is due, or None"""
+        return self.scheduler.next_deadline()
+
+    def status(self, now):
+        """Return string summarizing the state of each door"""
+        return ', '.join("%s: %s/%d/%d" % (name, self.door_states[name], self.alert_states[name],
+                                           (now - self.time_of_last_state_change[name]))
+                         for name in self.door_states)
+
+##############################################################################
+# State journal
+##############################################################################
+
+class StateJournal(object):
+    """Append-only journal of door states and alert progress.
+
+    Records are short text lines, buffered and written with one fsync every
+    JOURNAL_SYNC_INTERVAL seconds by a background thread. Every
+    JOURNAL_COMPACT_RECORDS records the current state is written to a
+    snapshot and the journal is started afresh.
+
+    Record formats (tab separated, each followed by the CRC32 of the
+    preceding fields, so torn records are skipped):
+        G <generation>          - first record of the snapshot and of the
+                                  journal that follows it
+        D <id> <door name>      - assign a short id to a door
+        S <id> <o|c> <time>     - door changed state at time, no alerts sent
+        A <id> <alert index>    - index of the next alert to send
+
+    A journal is only replayed over a snapshot of the same generation, so a
+    crash between writing a snapshot and emptying the journal can't replay
+    old records over the new snapshot.
+    """
+
+    STATE_CODES = {'open': 'o', 'closed': 'c'}
+    STATES = {'o': 'open', 'c': 'closed'}
+
+    def __init__(self, directory):
+        self.logger = logging.getLogger(__name__)
+        self.journal_path = os.path.join(directory, 'journal')
+        self.snapshot_path = os.path.join(directory, 'snapshot')
+        self.sync_interval = getattr(cfg, 'JOURNAL_SYNC_INTERVAL', 5)
+        self.compact_records = getattr(cfg, 'JOURNAL_COMPACT_RECORDS', 1000)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Door name -> [state, time of last change, alert index]
+        self.state = dict()
+        self.ids = dict()
+        self.generation = 0
+
+        self.lock = threading.Lock()
+        self.pending = []
+        self.records = 0
+        self.journal = None
+        self.stopping = threading.Event()
+        self.writer = None
+
+        # Set after a failed snapshot, so the next sync writes one, and
+        # after a failed journal write, which may have left a torn record
+        self.snapshot_due = False
+        self.torn = False
+
+    def load(self):
+        """Replay the snapshot and journal, then start the writer thread.
+
+        Returns:
+            Dictionary mapping door name to a (state, time of last change,
+            alert index) tuple.
+        """
+        snapshot = self.read_records(self.snapshot_path)
+        journal = self.read_records(self.journal_path)
+        if journal and journal[:1] != snapshot[:1]:
+            self.logger.warning("Ignoring journal written before the last snapshot")
+            journal = []
+
+        names = dict()
+        for fields in snapshot + journal:
+            self.replay(fields, names)
+
+        self.logger.info("Restored state of %d doors from journal", len(self.state))
+
+        # Start a fresh journal from a snapshot of what was restored
+        self.write_snapshot()
+
+        self.writer = threading.Thread(target=self.run, name="state-journal")
+        self.writer.daemon = True
+        self.writer.start()
+
+        return dict((name, tuple(entry)) for name, entry in self.state.items())
+
+    @staticmethod
+    def checksum(text):
+        """Return the CRC32 of text as 8 hex digits"""
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        return "%08x" % (zlib.crc32(text) & 0xffffffff)
+
+    def record(self, *fields):
+        """Return a journal line holding fields and their checksum"""
+        text = '\t'.join(fields)
+        return "%s\t%s\n" % (text, self.checksum(text))
+
+    def read_records(self, path):
+        """Return the fields of each intact record in a snapshot or journal"""
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path, 'r') as journal_file:
+            for line in journal_file:
+                text, _, crc = line.rstrip('\n').rpartition('\t')
+                if text and crc == self.checksum(text):
+                    records.append(text.split('\t'))
+                else:
+                    self.logger.error("Ignoring bad journal record: %r", line)
+        return records
+
+    def replay(self, fields, names):
+        """Apply one journal record, ignoring malformed ones"""
+        try:
+            if fields[0] == 'G':
+                self.generation = int(fields[1])
+            elif fields[0] == 'D':
+                names[fields[1]] = fields[2]
+            elif fields[0] == 'S':
+                self.state[names[fields[1]]] = [self.STATES[fields[2]], float(fields[3]), 0]
+            elif fields[0] == 'A':
+                self.state[names[fields[1]]][2] = int(fields[2])
+        except (IndexError, KeyError, ValueError):
+            self.logger.error("Ignoring bad journal record: %r", '\t'.join(fields))
+
+    def door_id(self, name, lines):
+        """Return the short id for a door, adding a D record if it is new"""
+        if name not in self.ids:
+            self.ids[name] = str(len(self.ids))
+            lines.append(self.record('D', self.ids[name], name))
+        return self.ids[name]
+
+    def door_changed(self, name, state, when, time_in_previous_state):
+        """Record that a door changed state"""
+        # pylint: disable=unused-argument
+        with self.lock:
+            self.state[name] = [state, when, 0]
+            lines = self.pending
+            door = self.door_id(name, lines)
+            lines.append(self.record('S', door, self.STATE_CODES[state], "%.3f" % when))
+
+    def alert_sent(self, name, state, alert_index, when):
+        """Record that an alert was sent for a door"""
+        # pylint: disable=unused-argument
+        with self.lock:
+            self.state[name][2] = alert_index + 1
+            lines = self.pending
+            door = self.door_id(name, lines)
+            lines.append(self.record('A', door, str(alert_index + 1)))
+
+    def run(self):
+        """Writer thread main loop"""
+        while not self.stopping.wait(self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """Write and fsync pending records, compacting if the journal is long
+
+        If writing fails, the records are put back to be tried again at the
+        next sync. Once JOURNAL_COMPACT_RECORDS are waiting, a snapshot of
+        the current state is written instead, so they can't pile up.
+        """
+        with self.lock:
+            lines, self.pending = self.pending, []
+            compact = self.snapshot_due or self.records + len(lines) >= self.compact_records
+
+        try:
+            if compact:
+                self.write_snapshot()
+            elif lines:
+                # A newline ends any record torn by a failed write, so that
+                # load() skips it rather than the first record written here
+                self.journal.write(('\n' if self.torn else '') + ''.join(lines))
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self.torn = False
+                self.records += len(lines)
+        except (IOError, OSError) as ex:
+            self.logger.error("Unable to write state journal: %s", ex)
+            with self.lock:
+                if compact:
+                    # The snapshot covers every queued record
+                    self.snapshot_due = True
+                else:
+                    self.torn = True
+                    self.pending = lines + self.pending
+
+    def write_snapshot(self):
+        """Atomically replace the snapshot with the current state and start
+        an empty journal"""
+        with self.lock:
+            self.ids = dict()
+            self.generation += 1
+            header = self.record('G', str(self.generation))
+            lines = [header]
+            for name, (state, when, alert_index) in self.state.items():
+                door = self.door_id(name, lines)
+                lines.append(self.record('S', door, self.STATE_CODES[state], "%.3f" % when))
+                if alert_index:
+                    lines.append(self.record('A', door, str(alert_index)))
+
+            # Records queued since the snapshot was taken use the old ids
+            self.pending = []
+
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'w') as snapshot:
+                snapshot.write(''.join(lines))
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.rename(tmp_path, self.snapshot_path)
+
+            # Until the new journal's header is written, the old journal
+            # has an older generation and is ignored by load()
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = open(self.journal_path, 'w')
+            self.journal.write(header)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.records = 0
+            self.snapshot_due = False
+            self.torn = False
+
+    def close(self):
+        """Write any pending records and stop the writer thread"""
+        self.stopping.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.sync()
+            try:
+                self.journal.close()
+            except (IOError, OSError) as ex:
+                self.logger.error("Unable to close state journal: %s", ex)
+
+##############################################################################
+# Event history
+##############################################################################
+
+class HistorySegment(object):
+    """One file of the event history, with an index of record offsets.
+
+    The index maps door name (and None for all doors) to parallel lists of
+    record times and file offsets. Sealed segments keep their index in a
+    .idx file next to the data, so it never has to be rebuilt by scanning.
+    """
+
+    def __init__(self, path, start):
+        self.path = path
+        self.start = start
+        self.index = None
+
+    def size(self):
+        """Return the size of the segment file in bytes"""
+        return os.path.getsize(self.path)
+
+    def add(self, door, stamp, offset):
+        """Add a record to the index"""
+        for key in (None, door):
+            times, offsets = self.index.setdefault(key, ([], []))
+            times.append(stamp)
+            offsets.append(offset)
+
+    def load_index(self):
+        """Return the index, loading or rebuilding it if necessary"""
+        if self.index is None:
+            self.index = dict()
+            if os.path.exists(self.path + '.idx'):
+                with open(self.path + '.idx', 'r') as index_file:
+                    for door, times, offsets in json.load(index_file):
+                        self.index[door] = (times, offsets)
+            else:
+                offset = 0
+                with open(self.path, 'rb') as segment_file:
+                    for line in segment_file:
+                        fields = line.decode('utf-8').split('\t')
+                        if len(fields) == 5:
+                            self.add(fields[2], float(fields[0]), offset)
+                        offset += len(line)
+        return self.index
+
+    def seal(self):
+        """Write the index next to the segment"""
+        index = self.load_index()
+        tmp_path = self.path + '.idx.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump([[door, times, offsets] for door, (times, offsets) in index.items()], index_file)
+        os.rename(tmp_path, self.path + '.idx')
+
+    def read(self, offsets):
+        """Return the records at the specified offsets"""
+        records = []
+        with open(self.path, 'rb') as segment_file:
+            for offset in offsets:
+                segment_file.seek(offset)
+                records.append(parse_history_record(segment_file.readline().decode('utf-8')))
+        return records
+
+    def delete(self):
+        """Remove the segment and its index from disk"""
+        for path in (self.path, self.path + '.idx'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def parse_history_record(line):
+    """Parse an event history line into a dictionary"""
+    stamp, kind, door, state, value = line.rstrip('\n').split('\t')
+    return {
+        'time': float(stamp),
+        'kind': kind,
+        'door': door,
+        'state': state,
+        'value': int(value),
+    }
+
+def format_history_record(record):
+    """Format an event history record for people to read"""
+    stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record['time']))
+    if record['kind'] == 'alert':
+        return "%s %s: alert %d sent (%s)" % (stamp, record['door'], record['value'] + 1, record['state'])
+    return "%s %s: %s after %s" % (stamp, record['door'], record['state'], format_duration(record['value']))
+
+class EventHistory(object):
+    """Segmented, append-only history of every door transition and alert.
+
+    Records are tab-separated lines:
+        <time> <'state'|'alert'> <door> <state> <value>
+    where value is the seconds spent in the previous state for a transition,
+    or the index of the alert that was sent.
+
+    A new segment is started when the current one reaches
+    EVENT_SEGMENT_BYTES. Adjacent small segments are merged, and segments
+    older than EVENT_RETENTION_DAYS are deleted.
+
+    Transitions and alerts are queued and written by a background thread,
+    so the sensor loop never waits for the SD card and a failed write is
+    only logged. At most EVENT_QUEUE_SIZE records wait to be written; more
+    are dropped.
+    """
+
+    def __init__(self, directory):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.segment_bytes = getattr(cfg, 'EVENT_SEGMENT_BYTES', 1024 * 1024)
+        self.retention = getattr(cfg, 'EVENT_RETENTION_DAYS', 365) * 86400
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.segments = []
+        for filename in sorted(os.listdir(directory)):
+            match = re.match(r'^(\d+)\.log$', filename)
+            if match:
+                self.segments.append(HistorySegment(os.path.join(directory, filename), int(match.group(1))))
+        self.segments.sort(key=lambda segment: segment.start)
+
+        # Append to the newest segment if there is room left in it
+        self.active = None
+        self.active_file = None
+        if self.segments and self.segments[-1].size() < self.segment_bytes:
+            self.open_segment(self.segments[-1])
+
+        self.expire(time.time())
+
+        self.records = queue.Queue(getattr(cfg, 'EVENT_QUEUE_SIZE', 1000))
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.run, name="event-history")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def open_segment(self, segment):
+        """Make segment the one new records are appended to"""
+        self.active_file = open(segment.path, 'ab')
+        self.active_file.seek(0, os.SEEK_END)
+        self.active = segment
+
+        # The index of the active segment lives in memory until it is sealed
+        if os.path.exists(segment.path + '.idx'):
+            os.remove(segment.path + '.idx')
+        segment.index = None
+        segment.load_index()
+
+    def append(self, stamp, kind, door, state, value):
+        """Add a record to the history"""
+        line = ("%.3f\t%s\t%s\t%s\t%d\n" % (stamp, kind, door, state, value)).encode('utf-8')
+
+        with self.lock:
+            if self.active is None or self.active_file.tell() >= self.segment_bytes:
+                self.roll(stamp)
+
+            offset = self.active_file.tell()
+            self.active_file.write(line)
+            self.active_file.flush()
+            self.active.add(door, stamp, offset)
+
+    def roll(self, stamp):
+        """Seal the active segment and start a new one"""
+        if self.active is not None:
+            self.active_file.close()
+            self.active.seal()
+            self.compact()
+            self.expire(stamp)
+
+        start = int(stamp)
+        if self.segments and start <= self.segments[-1].start:
+            start = self.segments[-1].start + 1
+        segment = HistorySegment(os.path.join(self.directory, "%d.log" % start), start)
+        self.segments.append(segment)
+        self.open_segment(segment)
+
+    def compact(self):
+        """Merge adjacent sealed segments that together fit in one segment"""
+        index = 0
+        while index + 1 < len(self.segments):
+            first, second = self.segments[index], self.segments[index + 1]
+            if second is self.active or first.size() + second.size() > self.segment_bytes:
+                index += 1
+                continue
+
+            self.logger.info("Merging event history segments %d and %d", first.start, second.start)
+            with open(first.path, 'ab') as first_file:
+                with open(second.path, 'rb') as second_file:
+                    first_file.write(second_file.read())
+            first.index = None
+            if os.path.exists(first.path + '.idx'):
+                os.remove(first.path + '.idx')
+            first.seal()
+            second.delete()
+            del self.segments[index + 1]
+
+    def expire(self, now):
+        """Delete segments that only hold records older than the retention period"""
+        while len(self.segments) > 1 and self.segments[1].start < now - self.retention:
+            if self.segments[0] is self.active:
+                break
+            self.logger.info("Deleting expired event history segment %d", self.segments[0].start)
+            self.segments.pop(0).delete()
+
+    def put(self, *record):
+        """Queue a record for the writer thread without blocking"""
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.logger.error("Event history queue is full - dropping %s record for %s", record[1], record[2])
+
+    def run(self):
+        """Writer thread main loop"""
+        while True:
+            record = self.records.get()
+            if record is None:
+                return
+            try:
+                self.append(*record)
+            except (IOError, OSError) as ex:
+                self.logger.error("Unable to write event history: %s", ex)
+
+    def door_changed(self, name, state, when, time_in_previous_state):
+        """Record a door transition"""
+        self.put(when, 'state', name, state, time_in_previous_state)
+
+    def alert_sent(self, name, state, alert_index, when):
+        """Record an alert"""
+        self.put(when, 'alert', name, state, alert_index)
+
+    def query(self, door=None, start=None, end=None, limit=None):
+        """Return history records, oldest first
+
+        Args:
+            door: Only return records for this door. Defaults to all doors.
+            start: Only return records at or after this time.time().
+            end: Only return records at or before this time.time().
+            limit: Only return this many of the most recent matching records.
+        """
+        results = []
+        with self.lock:
+            for position in range(len(self.segments) - 1, -1, -1):
+                segment = self.segments[position]
+                if end is not None and segment.start > end:
+                    continue
+
+                times, offsets = segment.load_index().get(door, ([], []))
+                low = 0
+                if start is not None:
+                    low = bisect.bisect_left(times, start)
+                high = len(times)
+                if end is not None:
+                    high = bisect.bisect_right(times, end)
+                if limit is not None:
+                    low = max(low, high - (limit - len(results)))
+
+                results = segment.read(offsets[low:high]) + results
+
+                if limit is not None and len(results) >= limit:
+                    break
+                if start is not None and segment.start <= start:
+                    break
+
+        return results
+
+    def close(self):
+        """Write the queued records, stop the writer thread and close the
+        active segment"""
+        self.records.put(None)
+        self.writer.join(5)
+        with self.lock:
+            if self.active_file is not None:
+                self.active_file.close()
+
+##############################################################################
+# Door analytics
+##############################################################################
+
+class P2Quantile(object):
+    """Streaming estimate of one quantile in constant memory, using the P^2
+    algorithm (Jain and Chlamtac, 1985). Five markers track the minimum,
+    the quantile, the maximum and points half way between, and are moved
+    along a parabola fitted through their neighbours as values arrive.
+    """
+
+    def __init__(self, quantile):
+        """
+        Args:
+            quantile: Quantile to estimate, between 0 and 1.
+        """
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2.0, quantile, (1 + quantile) / 2.0, 1]
+
+    def add(self, value):
+        """Add one observation"""
+        heights = self.heights
+        if len(heights) < 5:
+            bisect.insort(heights, value)
+            return
+
+        # Find the cell the value falls in, stretching the ends if needed
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect.bisect_right(heights, value) - 1
+
+        positions = self.positions
+        for index in range(cell + 1, 5):
+            positions[index] += 1
+        for index in range(5):
+            self.desired[index] += self.increments[index]
+
+        # Move the middle markers towards their desired positions
+        for index in (1, 2, 3):
+            offset = self.desired[index] - positions[index]
+            if ((offset >= 1 and positions[index + 1] - positions[index] > 1) or
+                    (offset <= -1 and positions[index - 1] - positions[index] < -1)):
+                step = 1 if offset > 0 else -1
+                height = self.parabolic(index, step)
+                if not heights[index - 1] < height < heights[index + 1]:
+                    height = self.linear(index, step)
+                heights[index] = height
+                positions[index] += step
+
+    def parabolic(self, index, step):
+        """Piecewise parabolic prediction of a marker moved by step"""
+        heights, positions = self.heights, self.positions
+        below = positions[index] - positions[index - 1]
+        above = positions[index + 1] - positions[index]
+        return heights[index] + float(step) / (positions[index + 1] - positions[index - 1]) * (
+            (below + step) * (heights[index + 1] - heights[index]) / above +
+            (above - step) * (heights[index] - heights[index - 1]) / below)
+
+    def linear(self, index, step):
+        """Linear prediction of a marker moved by step"""
+        heights, positions = self.heights, self.positions
+        return heights[index] + step * (heights[index + step] - heights[index]) / float(
+            positions[index + step] - positions[index])
+
+    def value(self):
+        """Return the estimated quantile, or None before any observations"""
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return self.heights[int(round(self.quantile * (len(self.heights) - 1)))]
+        return self.heights[2]
+
+    def to_dict(self):
+        """Return the state as a JSON serializable dictionary"""
+        return {'heights': self.heights, 'positions': self.positions, 'desired': self.desired}
+
+    def load(self, state):
+        """Restore the state returned by to_dict()"""
+        self.heights = [float(height) for height in state['heights']]
+        self.positions = [int(position) for position in state['positions']]
+        self.desired = [float(position) for position in state['desired']]
+
+class DoorStats(object):
+    """Usage statistics for one door"""
+
+    # Quantiles of the time a door is left open
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self):
+        self.opens = 0
+        self.closes = 0
+        self.open_seconds = 0.0
+        self.longest_open = 0.0
+        self.open_quantiles = [P2Quantile(quantile) for quantile in self.QUANTILES]
+
+        # Number of times the door was opened in each hour of the day
+        self.hours = [0] * 24
+
+    def opened(self, when):
+        """Count an opening at time.time() when"""
+        self.opens += 1
+        self.hours[time.localtime(when).tm_hour] += 1
+
+    def closed(self, open_seconds):
+        """Count a closing after the door was open for open_seconds"""
+        self.closes += 1
+        self.open_seconds += open_seconds
+        self.longest_open = max(self.longest_open, open_seconds)
+        for sketch in self.open_quantiles:
+            sketch.add(open_seconds)
+
+    def percentiles(self):
+        """Return a dictionary of the open time percentiles, e.g. 'p95'"""
+        return dict(('p%d' % round(sketch.quantile * 100), sketch.value()) for sketch in self.open_quantiles)
+
+    def to_dict(self):
+        """Return the statistics as a JSON serializable dictionary"""
+        return {
+            'opens': self.opens,
+            'closes': self.closes,
+            'open_seconds': self.open_seconds,
+            'longest_open': self.longest_open,
+            'open_percentiles': self.percentiles(),
+            'hours': self.hours,
+            'sketches': [sketch.to_dict() for sketch in self.open_quantiles],
+        }
+
+    def load(self, state):
+        """Restore the statistics returned by to_dict()"""
+        self.opens = state['opens']
+        self.closes = state['closes']
+        self.open_seconds = state['open_seconds']
+        self.longest_open = state['longest_open']
+        self.hours = list(state['hours'])
+        for sketch, sketch_state in zip(self.open_quantiles, state['sketches']):
+            sketch.load(sketch_state)
+
+class DoorAnalytics(object):
+    """DoorMonitor listener keeping usage statistics for every door in
+    fixed memory: open and close counts, percentiles of how long each door
+    is left open, and how often it is opened in each hour of the day.
+
+    The statistics are kept in STATE_DIR/analytics.json, if set, so they
+    survive restarts. They are saved with the status report and on exit.
+    """
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path: File to keep the statistics in, or None.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.doors = collections.OrderedDict()
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as saved:
+                    for name, state in json.load(saved).items():
+                        self.stats(name).load(state)
+            except (ValueError, KeyError, TypeError) as ex:
+                self.logger.error("Ignoring unreadable door analytics in %s: %s", path, ex)
+                self.doors.clear()
+
+    def stats(self, name):
+        """Return the DoorStats of a door, creating them if needed"""
+        if name not in self.doors:
+            self.doors[name] = DoorStats()
+        return self.doors[name]
+
+    def door_changed(self, name, state, when, time_in_previous_state):
+        """Count a transition"""
+        with self.lock:
+            stats = self.stats(name)
+            if state == 'open':
+                stats.opened(when)
+            else:
+                stats.closed(time_in_previous_state)
+
+    def alert_sent(self, name, state, alert_index, when):
+        """Alerts are not counted"""
+        pass
+
+    def to_dict(self):
+        """Return the statistics of every door"""
+        with self.lock:
+            return collections.OrderedDict((name, stats.to_dict()) for name, stats in self.doors.items())
+
+    def analytics_page(self, request):
+        """Serve /analytics"""
+        # pylint: disable=unused-argument
+        doors = self.to_dict()
+        for stats in doors.values():
+            del stats['sketches']
+        return 200, 'application/json', json.dumps(doors, sort_keys=True) + '\n'
+
+    def door_report(self, name):
+        """Return a one line summary of a door's usage"""
+        with self.lock:
+            stats = self.doors.get(name)
+            if stats is None or not stats.opens:
+                return "%s: not opened yet" % name
+
+            busiest = max(range(24), key=lambda hour: stats.hours[hour])
+            report = "%s: opened %d times, busiest %02d:00-%02d:59" % (name, stats.opens, busiest, busiest)
+            if stats.closes:
+                percentiles = stats.percentiles()
+                report += ", open for %s median, %s p95, %s p99, %s longest" % (
+                    format_duration(percentiles['p50']), format_duration(percentiles['p95']),
+                    format_duration(percentiles['p99']), format_duration(stats.longest_open))
+            return report
+
+    def report(self, names):
+        """Return a summary of the usage of the named doors"""
+        return ' / '.join(self.door_report(name) for name in names)
+
+    def status(self):
+        """Return string summarizing the statistics of every door"""
+        summaries = []
+        with self.lock:
+            for name, stats in self.doors.items():
+                percentiles = stats.percentiles()
+                seconds = '/'.join('-' if percentiles[key] is None else "%.0f" % percentiles[key]
+                                   for key in ('p50', 'p95', 'p99'))
+                summaries.append("%s: %d opens, open p50/p95/p99 %ss" % (name, stats.opens, seconds))
+        return "usage: " + ', '.join(summaries)
+
+    def save(self):
+        """Write the statistics to the file"""
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as saved:
+                json.dump(self.to_dict(), saved)
+                saved.flush()
+                os.fsync(saved.fileno())
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as ex:
+            self.logger.error("Unable to save door analytics to %s: %s", self.path, ex)
+
+##############################################################################
+# Alert backends
+##############################################################################
+
+def alert_timeout(channel):
+    """Return the network timeout in seconds for a channel's requests"""
+    return getattr(cfg, 'ALERT_TIMEOUTS', {}).get(channel, 10)
+
+# A recipient resolved to the sender method that delivers to it. address is
+# None for recipients without one, and a tuple of addresses for grouped
+# recipients. payload is 'text', or 'event' for the MQTT_EVENT_FORMAT
+# encoding of events.
+AlertTarget = collections.namedtuple('AlertTarget', 'channel method address payload')
+
+class RecipientType(object):
+    """A kind of recipient string, such as "sms:<phone number>"
+
+    Args:
+        prefix: Start of the recipient string, or the whole string if the
+                type has no address.
+        channel: Channel (key into ALERT_CHANNELS) that delivers the alerts.
+        method: Name of the sender method to call.
+        pattern: Regular expression the address must match, or None for a
+                 type without an address.
+        grouped: True if all addresses of this type in a recipients list
+                 are sent one alert together.
+        payload: 'text' or 'event'.
+    """
+
+    def __init__(self, prefix, channel, method, pattern=None, grouped=False, payload='text'):
+        self.prefix = prefix
+        self.channel = channel
+        self.method = method
+        self.pattern = re.compile(pattern + '$') if pattern is not None else None
+        self.grouped = grouped
+        self.payload = payload
+
+    def match(self, recipient):
+        """Return the address in recipient, '' if it has none, or None if
+        recipient isn't of this type"""
+        if self.pattern is None:
+            return '' if recipient == self.prefix else None
+        if recipient.startswith(self.prefix):
+            return recipient[len(self.prefix):]
+        return None
+
+# Recipient types in GARAGE_DOORS alerts, added by register_channel()
+RECIPIENT_TYPES = []
+
+# An alert channel. load imports the modules the channel needs, and
+# create(context) returns its alert sending object. context is a dictionary
+# that may hold 'door_states', 'time_of_last_state_change', 'history' and
+# 'analytics', for channels that answer queries. settings are the prefixes
+# of the config settings the channel uses; a channel is recreated on a
+# reload only if one of them changed. required are the settings that must
+# not be empty for the channel to send anything. max_length is the longest
+# message the channel sends without truncating it, or None.
+AlertChannel = collections.namedtuple('AlertChannel', 'name load create settings required max_length')
+
+# Alert channels by name. Channels are only imported and created when the
+# configuration uses them.
+ALERT_CHANNELS = collections.OrderedDict()
+
+def register_channel(name, load, create, settings, required, recipient_types, max_length=None):
+    """Add an alert channel and the kinds of recipient string it delivers to
+
+    Args:
+        name: Name of the channel.
+        load: Function that imports the modules the channel needs.
+        create: Function called as create(context) to create the channel's
+                alert sending object.
+        settings: Config setting name prefixes used by the channel.
+        required: Names of the config settings the channel can't send
+                  without.
+        recipient_types: List of dictionaries of RecipientType arguments,
+                         without the channel.
+        max_length: Longest message the channel can send in one piece.
+    """
+    ALERT_CHANNELS[name] = AlertChannel(name, load, create, tuple(settings), tuple(required), max_length)
+    for recipient_type in recipient_types:
+        RECIPIENT_TYPES.append(RecipientType(channel=name, **recipient_type))
+
+register_channel('Email', import_email, lambda context: Email(), ('SMTP_', 'EMAIL_'),
+                 ('SMTP_SERVER', 'EMAIL_FROM'), [
+    {'prefix': 'email:', 'method': 'send_email', 'pattern': r'[^@\s]+@[^@\s]+', 'grouped': True},
+])
+register_channel('Twitter', import_twitter, lambda context: Twitter(), ('TWITTER_',),
+                 ('TWITTER_CONSUMER_KEY', 'TWITTER_CONSUMER_SECRET', 'TWITTER_ACCESS_KEY',
+                  'TWITTER_ACCESS_SECRET'), [
+    {'prefix': 'twitter_dm:', 'method': 'direct_msg', 'pattern': r'@?\w{1,15}'},
+    {'prefix': 'tweet', 'method': 'update_status'},
+], max_length=140 - len("YYYY-MM-DD HH:MM:SS: "))
+register_channel('Twilio', import_twilio, lambda context: Twilio(), ('TWILIO_',),
+                 ('TWILIO_ACCOUNT', 'TWILIO_TOKEN', 'TWILIO_PHONE_NUMBER'), [
+    {'prefix': 'sms:', 'method': 'send_sms', 'pattern': r'\+?[0-9]{3,15}'},
+], max_length=140)
+register_channel('Jabber', import_jabber,
+                 lambda context: Jabber(context.get('door_states', {}),
+                                        context.get('time_of_last_state_change', {}),
+                                        context.get('history'), context.get('analytics')),
+                 ('JABBER_',), ('JABBER_ID', 'JABBER_PASSWORD'), [
+    {'prefix': 'jabber:', 'method': 'send_msg', 'pattern': r'[^@\s]+@[^@\s/]+(/.*)?'},
+])
+register_channel('Mqtt', import_mqtt, lambda context: Mqtt(), ('MQTT_',), ('MQTT_HOST',), [
+    {'prefix': 'mqtt:', 'method': 'publish', 'pattern': r'[^#+\x00]+', 'payload': 'event'},
+])
+
+def compile_recipients(recipients):
+    """Resolve a list of recipient strings into AlertTargets
+
+    Duplicate recipients are dropped, and grouped recipients (email) are
+    merged into one target.
+
+    Args:
+        recipients: List of strings of the form type:address.
+
+    Returns:
+        Tuple of AlertTargets.
+
+    Raises:
+        ValueError naming every recipient that is unknown or malformed.
+    """
+    targets = []
+    groups = collections.OrderedDict()
+    errors = []
+
+    for recipient in recipients:
+        for recipient_type in RECIPIENT_TYPES:
+            address = recipient_type.match(recipient)
+            if address is not None:
+                break
+        else:
+            errors.append("unrecognized recipient type: %s" % recipient)
+            continue
+
+        if recipient_type.pattern is None:
+            address = None
+        elif not recipient_type.pattern.match(address):
+            errors.append("bad address: %s" % recipient)
+            continue
+
+        if recipient_type.grouped:
+            addresses = groups.setdefault(recipient_type, [])
+            if address not in addresses:
+                addresses.append(address)
+            continue
+
+        target = AlertTarget(recipient_type.channel, recipient_type.method, address, recipient_type.payload)
+        if target not in targets:
+            targets.append(target)
+
+    if errors:
+        raise ValueError(', '.join(errors))
+
+    for recipient_type, addresses in groups.items():
+        targets.append(AlertTarget(recipient_type.channel, recipient_type.method, tuple(addresses),
+                                   recipient_type.payload))
+    return tuple(targets)
+
+class RecipientTable(object):
+    """Recipient lists of every alert, compiled once at startup"""
+
+    def __init__(self):
+        self.targets = dict()
+
+    def compile(self, doors):
+        """Compile the recipients of every alert
+
+        Args:
+            doors: GARAGE_DOORS list.
+
+        Raises:
+            ValueError describing every bad recipient.
+        """
+        errors = []
+        for door in doors:
+            for alert in door['alerts']:
+                try:
+                    self.resolve(alert['recipients'])
+                except ValueError as ex:
+                    errors.append("%s: %s" % (door.get('name'), ex))
+        if errors:
+            raise ValueError("Bad alert recipients: " + '; '.join(errors))
+
+    def resolve(self, recipients):
+        """Return the AlertTargets for a recipients list, compiling it if needed"""
+        key = tuple(recipients)
+        targets = self.targets.get(key)
+        if targets is None:
+            targets = self.targets[key] = compile_recipients(recipients)
+        return targets
+
+    def channels(self):
+        """Return the set of channels used by any compiled recipient"""
+        return set(target.channel for targets in self.targets.values() for target in targets)
+
+# Shared by every alert. main() compiles the recipients at startup.
+RECIPIENTS = RecipientTable()
+
+def referenced_channels(doors):
+    """Return the set of channels used by any alert
+
+    Args:
+        doors: GARAGE_DOORS list.
+    """
+    channels = set()
+    for door in doors:
+        for alert in door['alerts']:
+            channels.update(target.channel for target in RECIPIENTS.resolve(alert['recipients']))
+    return channels
+
+def enabled_channels(doors):
+    """Return the set of channels needed by the configuration
+
+    Args:
+        doors: GARAGE_DOORS list.
+    """
+    channels = referenced_channels(doors)
+    # Jabber is also needed to answer status queries
+    if getattr(cfg, 'JABBER_ID', ''):
+        channels.add('Jabber')
+    if getattr(cfg, 'MQTT_STATE_TOPIC', None) or getattr(cfg, 'HUB_FORWARD_TOPIC', None):
+        channels.add('Mqtt')
+    return channels
+
+def unconfigured_channels(channels, settings):
+    """Return a description of each channel that is missing a setting it
+    can't send without, so alerts are never queued for it
+
+    Args:
+        channels: Names of the channels.
+        settings: Dictionary mapping setting name to value.
+    """
+    errors = []
+    for name in sorted(channels):
+        missing = [setting for setting in ALERT_CHANNELS[name].required if not settings.get(setting)]
+        if missing:
+            errors.append("%s alerts need %s" % (name, ', '.join(missing)))
+    return errors
+
+def get_rss():
+    """Return the resident set size of this process in bytes, or 0"""
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return 0
+
+def load_alert_senders(channels, context, factories=None):
+    """Import and create the alert sending objects for the specified channels
+
+    Args:
+        channels: Names of the channels to load.
+        context: Dictionary passed to each channel's create function.
+        factories: Dictionary mapping channel name to a function that
+                   creates the channel's alert sending object instead of
+                   the registered one.
+
+    Returns:
+        Dictionary mapping channel name to alert sending object.
+    """
+    logger = logging.getLogger(__name__)
+    alert_senders = dict()
+    factories = factories or {}
+
+    for name in sorted(channels):
+        channel = ALERT_CHANNELS[name]
+        rss = get_rss()
+        start = time.time()
+        channel.load()
+        imported = time.time()
+        if name in factories:
+            alert_senders[name] = factories[name]()
+        else:
+            alert_senders[name] = channel.create(context)
+
+        logger.info("Loaded %s backend: import %.0f ms, setup %.0f ms, %+d KB resident",
+                    name, (imported - start) * 1000, (time.time() - imported) * 1000,
+                    (get_rss() - rss) // 1024)
+
+    return alert_senders
+
+##############################################################################
+# Alert dispatch
+##############################################################################
+
+class CircuitBreaker(object):
+    """Stops calling an alert sender that keeps failing.
+
+    The breaker starts closed. After BREAKER_FAILURES failures in a row it
+    opens, and alerts fail straight away without calling the sender. After
+    BREAKER_COOLDOWN seconds it goes half-open and lets one alert through
+    as a probe: if that succeeds the breaker closes, otherwise it opens
+    again for another cooldown.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threshold = getattr(cfg, 'BREAKER_FAILURES', 3)
+        self.cooldown = getattr(cfg, 'BREAKER_COOLDOWN', 60)
+        self.state = 'closed'
+        self.failures = 0
+        self.open_until = 0
+        self.rejected = 0
+
+    def allow(self, now):
+        """Return True if the sender may be called now"""
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and now >= self.open_until:
+                self.state = 'half-open'
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_time(self, now):
+        """Return the time.time() a rejected alert should be tried again"""
+        with self.lock:
+            return max(self.open_until, now + 1)
+
+    def success(self):
+        """Record a successful call"""
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def failure(self, now):
+        """Record a failed call
+
+        Returns:
+            True if the breaker has just opened.
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                opened = self.state != 'open'
+                self.state = 'open'
+                self.open_until = now + self.cooldown
+                return opened
+            return False
+
+class DispatchChannel(object):
+    """Queue and pool of worker threads delivering alerts for one channel"""
+
+    def __init__(self, name, sender, workers, queue_size, done=None):
+        """
+        Args:
+            name: Name of the channel.
+            sender: Alert sending object.
+            workers: Number of worker threads.
+            queue_size: Maximum number of queued alerts.
+            done: Function called as done(row_id, ok, retry_at, permanent,
+                  channel) after each alert that was submitted with a row id.
+                  retry_at is set if the alert wasn't tried because the
+                  breaker is open or the channel is disconnected, and
+                  permanent if it failed in a way that retrying can't fix.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.sender = sender
+        self.done = done
+        self.breaker = CircuitBreaker()
+        self.jobs = queue.Queue(queue_size)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.threads = []
+
+        for index in range(workers):
+            thread = threading.Thread(target=self.run, name="%s-%d" % (name, index))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, method, args, row_id=None):
+        """Queue a call to a method of the sender without blocking
+
+        Args:
+            method: Name of the sender method to call.
+            args: Tuple of arguments for the method.
+            row_id: Outbox row of the alert, if any.
+
+        Returns:
+            False if the queue was full.
+        """
+        try:
+            self.jobs.put_nowait((method, args, row_id))
+        except queue.Full:
+            self.dropped += 1
+            self.logger.error("%s alert queue is full - dropping alert", self.name)
+            return False
+        return True
+
+    def room(self):
+        """Return the number of alerts that can be queued without blocking"""
+        if self.jobs.maxsize <= 0:
+            return sys.maxsize
+        return self.jobs.maxsize - self.jobs.qsize()
+
+    def run(self):
+        """Worker thread main loop"""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            method, args, row_id = job
+            retry_at = None
+            permanent = False
+            if not self.breaker.allow(time.time()):
+                ok = False
+                retry_at = self.breaker.retry_time(time.time())
+            else:
+                start = time.time()
+                try:
+                    getattr(self.sender, method)(*args)
+                    self.sent += 1
+                    self.breaker.success()
+                    ok = True
+                    ALERTS_SENT.inc(labels=(self.name,))
+                except PermanentAlertError as ex:
+                    # The channel answered, so it is working even though
+                    # this alert can't be delivered
+                    self.failed += 1
+                    ok = False
+                    permanent = True
+                    ALERT_ERRORS.inc(labels=(self.name,))
+                    self.logger.error("%s alert can't be delivered: %s", self.name, ex)
+                    self.breaker.success()
+                except NotConnectedError as ex:
+                    # Not an attempt: the alert is tried again when the
+                    # channel reconnects, or when the breaker lets a probe
+                    # through, whichever comes first
+                    self.failed += 1
+                    ok = False
+                    ALERT_ERRORS.inc(labels=(self.name,))
+                    self.logger.info("%s alert waiting for the connection: %s", self.name, ex)
+                    if self.breaker.failure(time.time()):
+                        self.logger.error("%s circuit breaker open for %d seconds",
+                                          self.name, self.breaker.cooldown)
+                    retry_at = self.breaker.retry_time(time.time())
+                except:
+                    self.failed += 1
+                    ok = False
+                    ALERT_ERRORS.inc(labels=(self.name,))
+                    self.logger.error("Exception in %s alert sender: %s", self.name, sys.exc_info()[0])
+                    self.logger.debug("%s", traceback.format_exc())
+                    if self.breaker.failure(time.time()):
+                        self.logger.error("%s circuit breaker open for %d seconds",
+                                          self.name, self.breaker.cooldown)
+                SEND_SECONDS.observe(time.time() - start, (self.name,))
+
+            if row_id is not None and self.done is not None:
+                self.done(row_id, ok, retry_at, permanent, self.name)
+
+    def stop(self):
+        """Tell the workers to exit once the queue has been emptied"""
+        for _ in self.threads:
+            self.jobs.put(None)
+
+class TokenBucket(object):
+    """Allows bursts of up to `burst` messages, refilled at `per_hour`
+    messages an hour"""
+
+    def __init__(self, burst, per_hour):
+        self.capacity = float(burst)
+        self.rate = per_hour / 3600.0
+        self.tokens = self.capacity
+        self.stamp = None
+
+    def refill(self, now):
+        """Add the tokens earned since the last call"""
+        if self.stamp is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def available(self, now):
+        """Return True if a message may be sent now"""
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self):
+        """Use up a token. Only call after available() returned True."""
+        self.tokens -= 1
+
+    def next_token(self, now):
+        """Return the time.time() the next token will be available"""
+        self.refill(now)
+        if self.tokens >= 1 or self.rate <= 0:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+def digest_entries(msgs):
+    """Return a short description of the latest state of each door in a
+    list of alert bodies, e.g. "Door 1 open 10m". Bodies that aren't JSON
+    events are used as they are."""
+    latest = collections.OrderedDict()
+    for msg in msgs:
+        try:
+            event = json.loads(msg)
+            latest[event['door']] = "%s %s %s" % (event['door'], event['state'],
+                                                  format_short_duration(event['time']))
+        except (ValueError, TypeError, KeyError):
+            latest[msg] = msg
+    return list(latest.values())
+
+def split_message(entries, limit):
+    """Join entries with commas into as few messages of at most limit
+    characters as possible. Messages are numbered if there are several."""
+    text = ', '.join(entries)
+    if len(text) <= limit:
+        return [text]
+
+    budget = limit - len("(99/99) ")
+    parts = []
+    for entry in entries:
+        entry = truncate(entry, budget)
+        if parts and len(parts[-1]) + len(', ') + len(entry) <= budget:
+            parts[-1] += ', ' + entry
+        else:
+            parts.append(entry)
+    return ["(%d/%d) %s" % (index + 1, len(parts), part) for index, part in enumerate(parts)]
+
+def make_digest(subjects, msgs, limit=None):
+    """Merge several alerts for one recipient
+
+    Args:
+        subjects: Subjects of the alerts, without duplicates.
+        msgs: Bodies of the alerts, oldest first.
+        limit: Longest message the channel can send, or None. Digests for
+               such channels list the latest state of each door rather than
+               every alert, split over several messages if need be.
+
+    Returns:
+        List of (subject, msg) tuples to send.
+    """
+    if len(msgs) == 1:
+        return [(subjects[0], msgs[0])]
+
+    subject = subjects[0]
+    if len(subjects) > 1:
+        subject += " and %d more" % (len(subjects) - 1)
+    subject = "%s (%d alerts)" % (subject, len(msgs))
+    if limit is None:
+        return [(subject, '\n'.join(msgs))]
+    return [(subject, msg) for msg in split_message(digest_entries(msgs), limit)]
+
+class AlertThrottle(object):
+    """Rate limits alerts and merges alerts that arrive close together.
+
+    ALERT_RATE_LIMITS gives each recipient of a channel a token bucket, and
+    optionally the channel as a whole a second one. ALERT_DIGEST_WINDOW is
+    the number of seconds after an alert to a recipient during which further
+    alerts to that recipient are held and then sent together as one digest.
+    An alert that finds the bucket empty is held the same way until a token
+    is available, so a burst of alerts turns into a few digests rather than
+    being dropped.
+
+    Machine readable alerts, such as MQTT_EVENT_FORMAT events, can't be
+    merged into a digest, so they are sent straight away.
+    """
+
+    def __init__(self, deliver, hold=None):
+        """
+        Args:
+            deliver: Function called as deliver(channel, method, address,
+                     subject, msg, held, key) to send an alert. held lists
+                     the ids returned by hold() for the alerts merged into
+                     it, and key is the digest_key() of a digest of held
+                     alerts, or None.
+            hold: Function called as hold(channel, method, address, subject,
+                  msg) to store an alert that is being held, so it isn't
+                  lost if the process stops. Returns an id for the alert.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.deliver = deliver
+        self.hold = hold
+        self.limits = getattr(cfg, 'ALERT_RATE_LIMITS', {})
+        self.windows = getattr(cfg, 'ALERT_DIGEST_WINDOW', {})
+
+        self.buckets = dict()
+        self.last_sent = dict()
+
+        # (channel, method, address) -> ([subjects], [msgs], [hold ids])
+        # held for a digest
+        self.pending = dict()
+        self.timers = []
+
+        self.digests = 0
+        self.held = 0
+        self.cond = threading.Condition()
+        self.stopping = False
+
+        self.thread = threading.Thread(target=self.run, name="alert-throttle")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def configure(self, limits, windows):
+        """Change the rate limits and digest windows. Buckets of channels
+        whose limits changed start again full.
+
+        Args:
+            limits: ALERT_RATE_LIMITS dictionary.
+            windows: ALERT_DIGEST_WINDOW dictionary.
+        """
+        with self.cond:
+            changed = set(channel for channel in set(self.limits) | set(limits)
+                          if self.limits.get(channel) != limits.get(channel))
+            for key in list(self.buckets):
+                if (key[0] if isinstance(key, tuple) else key) in changed:
+                    del self.buckets[key]
+            self.limits = limits
+            self.windows = windows
+
+    def get_buckets(self, key):
+        """Return the token buckets that apply to a recipient"""
+        channel = key[0]
+        limit = self.limits.get(channel)
+        if limit is None:
+            return []
+
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(limit['burst'], limit['per_hour'])
+        buckets = [self.buckets[key]]
+
+        if 'channel_burst' in limit:
+            if channel not in self.buckets:
+                self.buckets[channel] = TokenBucket(limit['channel_burst'], limit['channel_per_hour'])
+            buckets.append(self.buckets[channel])
+        return buckets
+
+    def take(self, key, now):
+        """Use a token from each bucket of a recipient if they all have one"""
+        buckets = self.get_buckets(key)
+        if not all(bucket.available(now) for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.take()
+        return True
+
+    def submit(self, channel, method, address, subject, msg, digest=True):
+        """Send an alert now, or hold it for a digest
+
+        Args:
+            digest: False if msg can't be merged with other alerts.
+        """
+        if not digest or (channel not in self.limits and not self.windows.get(channel)):
+            self.deliver(channel, method, address, subject, msg)
+            return
+
+        key = (channel, method, address)
+        window = self.windows.get(channel, 0)
+        with self.cond:
+            now = time.time()
+            if (key not in self.pending and now - self.last_sent.get(key, 0) >= window
+                    and self.take(key, now)):
+                self.last_sent[key] = now
+                self.deliver(channel, method, address, subject, msg)
+                return
+
+            self.held += 1
+            if key not in self.pending:
+                self.pending[key] = ([], [], [])
+                self.schedule(key, max(now, self.last_sent.get(key, 0) + window))
+
+            subjects, msgs, held = self.pending[key]
+            if subject not in subjects:
+                subjects.append(subject)
+            msgs.append(msg)
+            if self.hold is not None:
+                held.append(self.hold(channel, method, address, subject, msg))
+
+    def schedule(self, key, when):
+        """Arrange for the digest of a recipient to be sent at time when"""
+        heapq.heappush(self.timers, (when, key))
+        self.cond.notify()
+
+    def flush(self, key, now, force=False):
+        """Send the digest held for a recipient if the rate limit allows"""
+        if not force and not self.take(key, now):
+            self.schedule(key, max(bucket.next_token(now) for bucket in self.get_buckets(key)))
+            return
+
+        subjects, msgs, held = self.pending.pop(key)
+        self.last_sent[key] = now
+        if len(msgs) > 1:
+            self.digests += 1
+        channel, method, address = key
+        try:
+            parts = make_digest(subjects, msgs, ALERT_CHANNELS[channel].max_length)
+            # The held alerts are only replaced once every part is queued
+            for index, (subject, msg) in enumerate(parts):
+                self.deliver(channel, method, address, subject, msg, held if index == len(parts) - 1 else (),
+                             digest_key(held, index) if held else None)
+        except:
+            # Don't let one bad digest stop the alerts held for everyone else
+            self.logger.error("Dropped %d %s alerts held for %s: %s",
+                              len(msgs), channel, address, sys.exc_info()[0])
+            self.logger.debug("%s", traceback.format_exc())
+
+    def run(self):
+        """Timer thread main loop"""
+        with self.cond:
+            while not self.stopping:
+                now = time.time()
+                if self.timers and self.timers[0][0] <= now:
+                    _, key = heapq.heappop(self.timers)
+                    if key in self.pending:
+                        self.flush(key, now)
+                elif self.timers:
+                    self.cond.wait(self.timers[0][0] - now)
+                else:
+                    self.cond.wait()
+
+    def status(self):
+        """Return string summarizing the throttle"""
+        with self.cond:
+            return "throttle: %d held, %d waiting, %d digests" % (self.held, len(self.pending), self.digests)
+
+    def shutdown(self):
+        """Send every held alert immediately and stop the timer thread"""
+        with self.cond:
+            self.stopping = True
+            for key in list(self.pending):
+                self.flush(key, time.time(), force=True)
+            self.cond.notify()
+        self.thread.join()
+
+def digest_key(held, index):
+    """Return the outbox key of one part of the digest of held alerts, the
+    same each time the digest is built from the same alerts"""
+    return 'digest:%s:%d' % (','.join(str(row_id) for row_id in held), index)
+
+def alert_args(method, address, subject, msg):
+    """Return the arguments for the alert sender method"""
+    if method == 'send_email':
+        return (list(address), subject, msg)
+    if address is None:
+        return (msg,)
+    return (address, msg)
+
+def encode_outbox_args(args):
+    """Serialize sender arguments to JSON. Byte strings that aren't text,
+    such as binary MQTT payloads, are stored base64 encoded."""
+    values = []
+    for arg in args:
+        if isinstance(arg, bytes) and bytes is not str:
+            arg = {'base64': base64.b64encode(arg).decode('ascii')}
+        elif isinstance(arg, bytes):
+            try:
+                arg.decode('utf-8')
+            except UnicodeDecodeError:
+                arg = {'base64': base64.b64encode(arg)}
+        values.append(arg)
+    return json.dumps(values, sort_keys=True)
+
+def decode_outbox_args(text):
+    """Inverse of encode_outbox_args(). Returns a tuple."""
+    values = []
+    for arg in json.loads(text):
+        if isinstance(arg, dict) and 'base64' in arg:
+            arg = base64.b64decode(arg['base64'])
+        values.append(arg)
+    return tuple(values)
+
+class AlertOutbox(object):
+    """Durable queue of alerts, kept in an SQLite database.
+
+    Every alert is written to the outbox before it is handed to a channel,
+    and marked as sent once the sender returns without raising. Failed
+    alerts are retried up to OUTBOX_MAX_ATTEMPTS times with jittered
+    exponential backoff, unless the sender raised PermanentAlertError.
+    Alerts still pending when the daemon stops are
+    sent after the next start; sent alerts are never sent again.
+
+    Each alert is identified by an idempotency key, new for every alert
+    unless the caller gives one, so re-submitting the same alert, such as
+    a digest of held alerts rebuilt after a restart, has no effect.
+    A row handed to a channel is leased for LEASE seconds; if the process
+    dies mid-send, the alert is sent again after the restart.
+
+    Alerts held by the AlertThrottle are stored too, as 'held' rows, and
+    replaced by their digest when it is queued. Held alerts left over from
+    before a restart are returned by take_held().
+    """
+
+    LEASE = 600
+
+    def __init__(self, path):
+        """
+        Args:
+            path: Database file, or ':memory:' to keep the outbox in memory.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+
+        self.max_attempts = getattr(cfg, 'OUTBOX_MAX_ATTEMPTS', 8)
+        self.retry_base = getattr(cfg, 'OUTBOX_RETRY_BASE', 30)
+        self.retry_max = getattr(cfg, 'OUTBOX_RETRY_MAX', 1800)
+        self.retention = getattr(cfg, 'OUTBOX_RETENTION_DAYS', 7) * 86400
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                        "id INTEGER PRIMARY KEY, key TEXT UNIQUE, channel TEXT, method TEXT, "
+                        "args TEXT, state TEXT, attempts INTEGER, next_try REAL, created REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_try)")
+        self.db.commit()
+
+    def add(self, channel, method, args, now, replaces=(), key=None):
+        """Store an alert that is about to be handed to a channel
+
+        Args:
+            replaces: Ids of held alerts merged into this one, which are
+                      deleted in the same transaction.
+            key: Idempotency key of the alert. Defaults to a new key, so
+                 the alert is always stored.
+
+        Returns:
+            Row id of the alert, or None if it was already in the outbox.
+        """
+        encoded = encode_outbox_args(args)
+        if key is None:
+            key = uuid.uuid4().hex
+
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO outbox (key, channel, method, args, state, attempts, next_try, created) "
+                "VALUES (?, ?, ?, ?, 'pending', 0, ?, ?)",
+                (key, channel, method, encoded, now + self.LEASE, now))
+            row_id = cursor.lastrowid if cursor.rowcount else None
+            self.db.executemany("DELETE FROM outbox WHERE id = ? AND state = 'held'",
+                                [(held_id,) for held_id in replaces])
+            self.db.commit()
+            return row_id
+
+    def hold(self, channel, method, address, subject, msg, now):
+        """Store an alert held by the throttle
+
+        Returns:
+            Row id of the held alert.
+        """
+        if isinstance(address, tuple):
+            address = list(address)
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO outbox (channel, method, args, state, attempts, next_try, created) "
+                "VALUES (?, ?, ?, 'held', 0, NULL, ?)",
+                (channel, method, encode_outbox_args([address, subject, msg]), now))
+            self.db.commit()
+            return cursor.lastrowid
+
+    def take_held(self):
+        """Return the held alerts left over from before a restart, oldest
+        first, as (row_id, channel, method, address, subject, msg) tuples"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, channel, method, args FROM outbox WHERE state = 'held' ORDER BY id").fetchall()
+
+        held = []
+        for row_id, channel, method, args in rows:
+            address, subject, msg = decode_outbox_args(args)
+            if isinstance(address, list):
+                address = tuple(address)
+            held.append((row_id, channel, method, address, subject, msg))
+        return held
+
+    def sent(self, row_id):
+        """Record that an alert was delivered"""
+        with self.lock:
+            self.db.execute("UPDATE outbox SET state = 'sent' WHERE id = ?", (row_id,))
+            self.db.commit()
+
+    def failed(self, row_id, now):
+        """Record a failed attempt and schedule the next one
+
+        Returns:
+            Seconds until the next attempt, or None if the alert has used up
+            its attempts.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT attempts FROM outbox WHERE id = ?", (row_id,)).fetchone()
+            attempts = row[0] + 1
+
+            if attempts >= self.max_attempts:
+                self.db.execute("UPDATE outbox SET state = 'failed', attempts = ? WHERE id = ?",
+                                (attempts, row_id))
+                self.db.commit()
+                return None
+
+            # Jitter keeps a batch of failed alerts from retrying in lockstep
+            delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+            delay = random.uniform(delay / 2.0, delay)
+            self.db.execute("UPDATE outbox SET attempts = ?, next_try = ? WHERE id = ?",
+                            (attempts, now + delay, row_id))
+            self.db.commit()
+            return delay
+
+    def rejected(self, row_id):
+        """Record that an alert can never be delivered"""
+        with self.lock:
+            self.db.execute("UPDATE outbox SET state = 'failed', attempts = attempts + 1 WHERE id = ?",
+                            (row_id,))
+            self.db.commit()
+
+    def defer(self, row_id, when):
+        """Try an alert again at time when without counting an attempt"""
+        with self.lock:
+            self.db.execute("UPDATE outbox SET next_try = ? WHERE id = ?", (when, row_id))
+            self.db.commit()
+
+    def resume(self, now):
+        """Make every pending alert due now. Called at startup."""
+        with self.lock:
+            count = self.db.execute("UPDATE outbox SET next_try = ? WHERE state = 'pending'", (now,)).rowcount
+            self.db.commit()
+        if count:
+            self.logger.info("Resuming delivery of %d alerts from the outbox", count)
+
+    def claim(self, channels, now, limit):
+        """Lease up to limit alerts that are due for another attempt
+
+        Args:
+            channels: Names of the channels that are loaded.
+            now: Current time.time().
+            limit: Maximum number of alerts to return.
+
+        Returns:
+            List of (row_id, channel, method, args) tuples.
+        """
+        if not channels:
+            return []
+        marks = ', '.join('?' * len(channels))
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, channel, method, args FROM outbox WHERE state = 'pending' AND next_try <= ? "
+                "AND channel IN (%s) ORDER BY next_try LIMIT ?" % marks,
+                [now] + list(channels) + [limit]).fetchall()
+            self.db.executemany("UPDATE outbox SET next_try = ? WHERE id = ?",
+                                [(now + self.LEASE, row[0]) for row in rows])
+            self.db.commit()
+        return [(row_id, channel, method, decode_outbox_args(args)) for row_id, channel, method, args in rows]
+
+    def next_retry(self, channels):
+        """Return the time.time() the next pending alert is due, or None"""
+        if not channels:
+            return None
+        marks = ', '.join('?' * len(channels))
+        with self.lock:
+            return self.db.execute(
+                "SELECT MIN(next_try) FROM outbox WHERE state = 'pending' AND channel IN (%s)" % marks,
+                list(channels)).fetchone()[0]
+
+    def expire(self, now):
+        """Delete sent and failed alerts older than OUTBOX_RETENTION_DAYS"""
+        with self.lock:
+            self.db.execute("DELETE FROM outbox WHERE state IN ('sent', 'failed') AND created < ?",
+                            (now - self.retention,))
+            self.db.commit()
+
+    def status(self):
+        """Return string summarizing the outbox"""
+        with self.lock:
+            counts = dict(self.db.execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall())
+        return "outbox: %d pending, %d held, %d failed" % (
+            counts.get('pending', 0), counts.get('held', 0), counts.get('failed', 0))
+
+    def close(self):
+        """Close the database"""
+        with self.lock:
+            self.db.close()
+
+class AlertDispatcher(object):
+    """Delivers alerts on per-channel worker threads so that slow network
+    calls never stall the sensor loop.
+
+    The number of workers for each channel is taken from ALERT_WORKERS
+    (default 1) and each channel queues at most ALERT_QUEUE_SIZE alerts.
+    Alerts go through an AlertOutbox, so failed alerts are retried and
+    nothing is lost if a channel's queue fills up. Alerts held by the
+    throttle are kept in the outbox too. When a sender with an on_reconnect
+    attribute reconnects, its channel's alerts waiting for a retry are sent
+    straight away.
+    """
+
+    def __init__(self, alert_senders, outbox=None):
+        """
+        Args:
+            alert_senders: Dictionary mapping channel name to alert sending object.
+            outbox: AlertOutbox to use. Defaults to one kept in memory.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.senders = alert_senders
+        self.channels = dict()
+
+        workers = getattr(cfg, 'ALERT_WORKERS', {})
+        queue_size = getattr(cfg, 'ALERT_QUEUE_SIZE', 100)
+
+        # Channel -> outbox rows waiting for a retry, and channels that
+        # have reconnected since the outbox thread last looked
+        self.retrying = dict()
+        self.reconnects = set()
+        self.retry_lock = threading.Lock()
+
+        for name, sender in alert_senders.items():
+            self.channels[name] = DispatchChannel(name, sender, workers.get(name, 1), queue_size, self.finished)
+            self.watch_reconnects(name, sender)
+
+        # Retries and alerts left over from before a restart are handed to
+        # the channels in batches by the outbox thread
+        self.outbox = outbox if outbox is not None else AlertOutbox(':memory:')
+        self.queue_held()
+        self.outbox.resume(time.time())
+
+        self.throttle = AlertThrottle(self.deliver, lambda channel, method, address, subject, msg:
+                                      self.outbox.hold(channel, method, address, subject, msg, time.time()))
+        self.batch = getattr(cfg, 'OUTBOX_BATCH', 20)
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.outbox_thread = threading.Thread(target=self.run_outbox, name="alert-outbox")
+        self.outbox_thread.daemon = True
+        self.outbox_thread.start()
+
+    def watch_reconnects(self, name, sender):
+        """Have a sender tell the dispatcher when it reconnects"""
+        if hasattr(sender, 'on_reconnect'):
+            sender.on_reconnect = lambda: self.reconnected(name)
+
+    def reconnected(self, name):
+        """Retry a channel's waiting alerts now that its connection is back.
+        Called on the sender's own threads."""
+        with self.retry_lock:
+            self.reconnects.add(name)
+        self.wakeup.set()
+
+    def set_sender(self, name, sender):
+        """Deliver a channel's alerts with a new sender, adding the channel
+        if it is new. Alerts already queued go to the new sender."""
+        self.senders[name] = sender
+        self.watch_reconnects(name, sender)
+        if name in self.channels:
+            self.channels[name].sender = sender
+            return
+
+        # Other threads read self.channels without a lock, so it is replaced
+        # rather than changed
+        channels = dict(self.channels)
+        channels[name] = DispatchChannel(name, sender, getattr(cfg, 'ALERT_WORKERS', {}).get(name, 1),
+                                         getattr(cfg, 'ALERT_QUEUE_SIZE', 100), self.finished)
+        self.channels = channels
+        self.wakeup.set()
+
+    def remove_channel(self, name):
+        """Stop delivering a channel's alerts. Alerts still in the outbox
+        are sent if the channel is added again."""
+        channels = dict(self.channels)
+        channel = channels.pop(name)
+        self.channels = channels
+        self.senders.pop(name, None)
+        channel.stop()
+
+    def send_alert(self, channel, method, address, subject, msg, digest=True):
+        """Queue an alert, subject to the channel's rate limit and digest window
+
+        Args:
+            channel: Name of the channel (key into alert_senders).
+            method: Name of the sender method to call.
+            address: Recipient address, a tuple of addresses for email, or
+                     None for channels without one.
+            subject: Subject of the alert.
+            msg: Body of the alert.
+            digest: False if msg is machine readable and can't be merged
+                    with other alerts. Such alerts are not throttled.
+        """
+        self.throttle.submit(channel, method, address, subject, msg, digest)
+
+    def queue_held(self):
+        """Queue the alerts the throttle was holding when the daemon last
+        stopped, merging each recipient's alerts into one digest"""
+        digests = collections.OrderedDict()
+        for row_id, channel, method, address, subject, msg in self.outbox.take_held():
+            subjects, msgs, held = digests.setdefault((channel, method, address), ([], [], []))
+            if subject not in subjects:
+                subjects.append(subject)
+            msgs.append(msg)
+            held.append(row_id)
+
+        for (channel, method, address), (subjects, msgs, held) in digests.items():
+            self.logger.info("Queueing %d %s alerts held before the restart", len(msgs), channel)
+            parts = make_digest(subjects, msgs, ALERT_CHANNELS[channel].max_length)
+            for index, (subject, msg) in enumerate(parts):
+                self.outbox.add(channel, method, alert_args(method, address, subject, msg), time.time(),
+                                held if index == len(parts) - 1 else (), digest_key(held, index))
+
+    def deliver(self, channel, method, address, subject, msg, held=(), key=None):
+        """Queue an alert that has passed the throttle"""
+        self.queue(channel, method, alert_args(method, address, subject, msg), held, key)
+
+    def submit(self, channel, method, *args):
+        """Queue an alert for delivery
+
+        Args:
+            channel: Name of the channel (key into alert_senders).
+            method: Name of the sender method to call.
+            args: Arguments for the method.
+        """
+        self.queue(channel, method, args)
+
+    def queue(self, channel, method, args, held=(), key=None):
+        """Store an alert in the outbox, replacing the held alerts merged
+        into it, and hand it to its channel"""
+        if channel not in self.channels:
+            self.logger.error("%s alerts are not enabled", channel)
+            return
+
+        row_id = self.outbox.add(channel, method, args, time.time(), held, key)
+        if row_id is None:
+            self.logger.info("Ignoring duplicate %s alert", channel)
+            return
+        self.dispatch(row_id, channel, method, args)
+
+    def dispatch(self, row_id, channel, method, args):
+        """Hand an alert from the outbox to its channel"""
+        with self.retry_lock:
+            self.retrying.get(channel, set()).discard(row_id)
+        # The channel may have been removed by a reload since it was claimed
+        target = self.channels.get(channel)
+        if target is None or not target.submit(method, args, row_id):
+            self.finished(row_id, False, time.time() + self.outbox.retry_base, channel=channel)
+
+    def finished(self, row_id, ok, retry_at=None, permanent=False, channel=None):
+        """Record the result of sending an alert. Called by the workers."""
+        if ok:
+            self.outbox.sent(row_id)
+        elif permanent:
+            self.outbox.rejected(row_id)
+        if ok or permanent:
+            # There is room in the channel's queue again
+            self.wakeup.set()
+            return
+
+        if retry_at is not None:
+            # Not tried because the channel's breaker is open, or its
+            # connection is down
+            self.outbox.defer(row_id, retry_at)
+        else:
+            delay = self.outbox.failed(row_id, time.time())
+            if delay is None:
+                self.logger.error("Giving up on alert after %d attempts", self.outbox.max_attempts)
+                return
+            self.logger.info("Retrying alert in %.0f seconds", delay)
+
+        if channel is not None:
+            with self.retry_lock:
+                self.retrying.setdefault(channel, set()).add(row_id)
+        self.wakeup.set()
+
+    def retry_reconnected(self, now):
+        """Make the waiting alerts of reconnected channels due now, and
+        close their breakers"""
+        with self.retry_lock:
+            names, self.reconnects = self.reconnects, set()
+            rows = [(name, self.retrying.pop(name, set())) for name in names]
+
+        for name, row_ids in rows:
+            channel = self.channels.get(name)
+            if channel is not None:
+                channel.breaker.success()
+            if row_ids:
+                self.logger.info("%s reconnected - retrying %d alerts", name, len(row_ids))
+            for row_id in row_ids:
+                self.outbox.defer(row_id, now)
+
+    def run_outbox(self):
+        """Outbox thread main loop"""
+        while not self.stopping:
+            now = time.time()
+            channels = self.channels
+            names = sorted(channels)
+            self.retry_reconnected(now)
+
+            # Only claim what each queue has room for, so that a backlog
+            # made due at once isn't pushed back a retry period when the
+            # queue fills. A full queue is woken again by the workers.
+            for name in names:
+                room = min(self.batch, channels[name].room())
+                if room > 0:
+                    for row_id, channel, method, args in self.outbox.claim([name], now, room):
+                        self.dispatch(row_id, channel, method, args)
+            self.outbox.expire(now)
+
+            timeout = 60
+            next_retry = self.outbox.next_retry([name for name in names if channels[name].room() > 0])
+            if next_retry is not None:
+                timeout = min(timeout, max(next_retry - time.time(), 0))
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def queue_depth(self):
+        """Return the total number of alerts waiting to be sent"""
+        return sum(channel.jobs.qsize() for channel in self.channels.values())
+
+    def status(self):
+        """Return string summarizing the dispatch queues"""
+        queues = ["%s queue: %d/%d/%d %s" % (name, channel.jobs.qsize(), channel.sent, channel.failed,
+                                             channel.breaker.state)
+                  for name, channel in sorted(self.channels.items())]
+        return ', '.join(queues + [self.throttle.status(), self.outbox.status()])
+
+    def shutdown(self, timeout):
+        """Send queued alerts, waiting at most timeout seconds in total
+
+        Args:
+            timeout: Maximum number of seconds to wait for the queues to drain.
+        """
+        # Alerts held for digests are sent straight away
+        self.throttle.shutdown()
+
+        # Retries that aren't due yet stay in the outbox for the next start
+        self.stopping = True
+        self.wakeup.set()
+        self.outbox_thread.join()
+
+        self.logger.info("Draining alert queues (%d alerts pending)", self.queue_depth())
+
+        for channel in self.channels.values():
+            channel.stop()
+
+        deadline = time.time() + timeout
+        for channel in self.channels.values():
+            for thread in channel.threads:
+                thread.join(max(deadline - time.time(), 0))
+
+        if self.queue_depth() > 0:
+            self.logger.error("Gave up with %d alerts still queued", self.queue_depth())
+
+        if not any(thread.is_alive() for channel in self.channels.values() for thread in channel.threads):
+            self.outbox.close()
 
-                    status_report_countdown = 600
+##############################################################################
+# Logging and alerts
+##############################################################################
+
+def msgpack_str(value):
+    """Return value encoded as a MessagePack string"""
+    data = value.encode('utf-8')
+    if len(data) < 32:
+        return struct.pack('!B', 0xa0 | len(data)) + data
+    if len(data) < 256:
+        return struct.pack('!BB', 0xd9, len(data)) + data
+    return struct.pack('!BH', 0xda, len(data)) + data
+
+def msgpack_uint(value):
+    """Return an integer encoded as a MessagePack unsigned integer, clamped
+    to 0..2**32-1"""
+    if value < 128:
+        return struct.pack('!B', max(value, 0))
+    return struct.pack('!BI', 0xce, min(value, 0xffffffff))
+
+class Event(object):
+    """A door event, encoded at most once per format and shared by every
+    recipient of the alert"""
+
+    __slots__ = ('encoder', 'door', 'state', 'time', 'stamp', 'payloads')
+
+    def __init__(self, encoder, door, state, time_in_state, stamp):
+        self.encoder = encoder
+        self.door = door
+        self.state = state
+        self.time = time_in_state
+        self.stamp = stamp
+        self.payloads = dict()
+
+    def payload(self, event_format='json'):
+        """Return the event encoded in the specified format"""
+        if event_format not in self.payloads:
+            self.payloads[event_format] = self.encoder.encode(self, event_format)
+        return self.payloads[event_format]
+
+    def __str__(self):
+        return self.payload('json')
+
+class EventEncoder(object):
+    """Encodes door events from per-door templates compiled in advance.
+
+    Formats:
+        json    - {"door":...,"state":...,"time":...,"timestamp":...}
+        msgpack - MessagePack map with the same keys
+        binary  - fixed 11 byte layout for MQTT: timestamp (uint32),
+                  door index (uint16), state (uint8, 1 = open), seconds
+                  in state (uint32), network byte order
+
+    The door index is the door's position in the list last passed to
+    compile(): GARAGE_DOORS, or HUB_DOORS in hub mode. Doors that aren't
+    in the list, such as hub doors covered by HUB_DEFAULT_ALERTS, have
+    index UNKNOWN_DOOR.
+    """
+
+    FORMATS = ('json', 'msgpack', 'binary')
+    BINARY = struct.Struct('!IHBI')
+    UNKNOWN_DOOR = 0xffff
+    MSGPACK_TIMESTAMP = msgpack_str('timestamp')
+
+    def __init__(self):
+        self.templates = dict()
+
+        # (second, formatted second), replaced as a whole so threads
+        # encoding at the same time never see a mismatched pair
+        self.last_stamp = (None, None)
+
+    def compile(self, doors):
+        """Build the templates for every door, replacing those of doors
+        compiled before
+
+        Args:
+            doors: GARAGE_DOORS list.
+        """
+        templates = dict()
+        for door_index, door in enumerate(doors):
+            templates[door['name']] = self.build(door['name'], door_index)
+        self.templates = templates
+
+    @staticmethod
+    def build(door, door_index):
+        """Return the templates for a door"""
+        json_door = json.dumps(door)
+        templates = dict()
+        for state in ('open', 'closed'):
+            templates[state] = {
+                'json': '{"door":%s,"state":"%s","time":' % (json_door, state),
+                'msgpack': (b'\x84' + msgpack_str('door') + msgpack_str(door) +
+                            msgpack_str('state') + msgpack_str(state) + msgpack_str('time')),
+                'binary': (door_index, int(state == 'open')),
+            }
+        return templates
+
+    def template(self, door):
+        """Return the templates for a door, compiling them if it wasn't
+        passed to compile()"""
+        templates = self.templates
+        if door not in templates:
+            templates[door] = self.build(door, self.UNKNOWN_DOOR)
+        return templates[door]
+
+    def timestamp(self, now):
+        """Return now as a local ISO 8601 string, formatting each second once"""
+        second = int(now)
+        last_second, stamp = self.last_stamp
+        if second != last_second:
+            stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(second))
+            self.last_stamp = (second, stamp)
+        return stamp
+
+    def create(self, door, state, time_in_state, now=None):
+        """Return a new Event. A negative time_in_state, e.g. after the
+        clock was stepped back, is reported as 0."""
+        if now is None:
+            now = time.time()
+        return Event(self, door, state, max(int(time_in_state), 0), now)
+
+    def encode(self, event, event_format):
+        """Encode an event in the specified format"""
+        template = self.template(event.door)[event.state]
+        if event_format == 'json':
+            return '%s%d,"timestamp":"%s"}' % (template['json'], event.time, self.timestamp(event.stamp))
+        if event_format == 'msgpack':
+            return (template['msgpack'] + msgpack_uint(event.time) +
+                    self.MSGPACK_TIMESTAMP + msgpack_str(self.timestamp(event.stamp)))
+        if event_format == 'binary':
+            door_index, state = template['binary']
+            return self.BINARY.pack(int(event.stamp), door_index, state, min(event.time, 0xffffffff))
+        raise ValueError("Unknown event format: %s" % event_format)
+
+# Shared by every alert. main() compiles the door templates at startup.
+EVENT_ENCODER = EventEncoder()
+
+def create_event(door, state, time_in_state):
+    """Return an Event describing a door
+
+    Args:
+        door: Name of the door.
+        state: State of the door.
+        time_in_state: Seconds the door has been in the state.
+    """
+    return EVENT_ENCODER.create(door, state, time_in_state)
+
+def send_alerts(logger, dispatcher, recipients, subject, msg):
+    """Queue subject and msg for delivery to specified recipients
+
+    Args:
+        dispatcher: AlertDispatcher that delivers the alerts
+        recipients: An array of strings of the form type:address
+        subject: Subject of the alert
+        msg: Body of the alert, either a string or an Event
+    """
+    try:
+        targets = RECIPIENTS.resolve(recipients)
+    except ValueError as ex:
+        logger.error("Unable to send alert: %s", ex)
+        return
+
+    # Events are encoded once per format and shared by every recipient
+    payloads = {'text': str(msg)}
+    if isinstance(msg, Event):
+        payloads['event'] = msg.payload(getattr(cfg, 'MQTT_EVENT_FORMAT', 'json'))
+    else:
+        payloads['event'] = payloads['text']
+
+    # Encoded events can't be merged into digests
+    for target in targets:
+        dispatcher.send_alert(target.channel, target.method, target.address, subject,
+                              payloads[target.payload], target.payload == 'text' or not isinstance(msg, Event))
+
+##############################################################################
+# Log writing
+##############################################################################
+
+LOG_RECORDS_DROPPED = METRICS.counter(
+    'pi_garage_log_records_dropped_total', "Log records dropped because the log queue was full", ('level',))
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats each record as a JSON object on one line"""
+
+    def format(self, record):
+        entry = {
+            'time': "%s.%03d" % (time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+                                 record.msecs),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, sort_keys=True)
+
+class LogStream(object):
+    """Log sink writing formatted records to a stream such as stdout"""
+
+    def __init__(self, stream, formatter):
+        self.stream = stream
+        self.formatter = formatter
+
+    def write(self, records):
+        """Write a batch of records"""
+        self.stream.write(''.join(self.formatter.format(record) + '\n' for record in records))
+        self.stream.flush()
+
+class LogFile(LogStream):
+    """Log sink writing formatted records to a file.
+
+    Once the file is max_bytes long it is renamed to path.1, path.1 to
+    path.2 and so on, keeping `backups` old files. Old files are gzipped if
+    compress is set.
+    """
+
+    def __init__(self, path, formatter, max_bytes=0, backups=5, compress=False):
+        """
+        Args:
+            path: Path of the log file.
+            formatter: logging.Formatter for the records.
+            max_bytes: Size at which the file is rotated, or 0 to never rotate.
+            backups: Number of old files to keep.
+            compress: True to gzip old files.
+        """
+        LogStream.__init__(self, None, formatter)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.size = 0
+        self.open()
+
+    def open(self):
+        """Open the log file for appending"""
+        self.stream = open(self.path, 'ab')
+        self.stream.seek(0, os.SEEK_END)
+        self.size = self.stream.tell()
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            line = self.formatter.format(record) + '\n'
+            if not isinstance(line, bytes):
+                line = line.encode('utf-8')
+            lines.append(line)
+        data = b''.join(lines)
+        self.stream.write(data)
+        self.stream.flush()
+
+        self.size += len(data)
+        if self.max_bytes and self.size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        """Start a new log file, keeping the old one as path.1"""
+        self.stream.close()
+        try:
+            suffix = '.gz' if self.compress else ''
+            for index in range(self.backups - 1, 0, -1):
+                older = "%s.%d%s" % (self.path, index, suffix)
+                if os.path.exists(older):
+                    os.rename(older, "%s.%d%s" % (self.path, index + 1, suffix))
+
+            if self.backups > 0:
+                rotated = self.path + '.1'
+                os.rename(self.path, rotated)
+                if self.compress:
+                    with open(rotated, 'rb') as source:
+                        with gzip.open(rotated + '.gz', 'wb') as target:
+                            shutil.copyfileobj(source, target)
+                    os.remove(rotated)
+            else:
+                os.remove(self.path)
+        finally:
+            # Hub shards share the file and may have rotated it first, so
+            # keep logging even if a rename fails
+            self.open()
+
+class LogWriter(object):
+    """Writes log records to the sinks on a background thread, so a slow SD
+    card never stalls the thread that logged.
+
+    Records are queued without blocking and written in batches, at most
+    once every flush_interval seconds. When the queue is full, records are
+    dropped and counted, and the number dropped is logged once there is
+    room again.
+    """
+
+    def __init__(self, sinks, queue_size=1000, flush_interval=1):
+        """
+        Args:
+            sinks: List of LogStream objects to write to.
+            queue_size: Maximum number of records waiting to be written.
+            flush_interval: Seconds to collect records for before writing.
+        """
+        self.sinks = sinks
+        self.records = queue.Queue(queue_size)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.stopped = False
+        self.written = 0
+        self.dropped = 0
+        self.reported = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self.run, name="log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, record):
+        """Queue a record to be written, without blocking"""
+        if os.getpid() != self.pid:
+            # A forked hub shard doesn't have the writer thread, and the
+            # lock may have been copied while held
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+            self.stopped = True
+
+        if self.stopped:
+            # Nothing would write queued records
+            self.write([record])
+            return
+
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            LOG_RECORDS_DROPPED.inc(labels=(record.levelname,))
+
+    def write(self, records):
+        """Write records to every sink"""
+        with self.lock:
+            if self.dropped != self.reported:
+                records.append(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': "%d log records dropped because the log queue was full" % (self.dropped - self.reported)}))
+                self.reported = self.dropped
+
+            for sink in self.sinks:
+                try:
+                    sink.write(records)
+                except (IOError, OSError):
+                    # There is nowhere left to log this
+                    self.errors += 1
+            self.written += len(records)
+
+    def run(self):
+        """Writer thread main loop"""
+        while True:
+            batch = [self.records.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                self.write(batch)
+            if stopping:
+                return
+
+            # Let records collect so the card is written less often
+            time.sleep(self.flush_interval)
+
+    def stop(self, timeout=5):
+        """Write the queued records and stop the thread. Records logged
+        afterwards are written straight away."""
+        self.records.put(None)
+        self.thread.join(timeout)
+        self.stopped = True
+
+    def status(self):
+        """Return string summarizing the log writer"""
+        return "log: %d written/%d dropped/%d errors" % (self.written, self.dropped, self.errors)
+
+class LogQueueHandler(logging.Handler):
+    """Logging handler that hands records to a LogWriter"""
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        # The message is formatted now, in case its arguments change before
+        # the writer gets to it
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+        self.writer.put(record)
+
+##############################################################################
+# Misc support
+##############################################################################
+
+def truncate(input_str, length):
+    """Truncate string to specified length
+
+    Args:
+        input_str: String to truncate
+        length: Maximum length of output string
+    """
+    if len(input_str) <= length:
+        return input_str
+
+    return input_str[:(length - 3)] + '...'
+
+def format_duration(duration_sec):
+    """Format a duration into a human friendly string"""
+    days, remainder = divmod(duration_sec, 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+
+    ret = ''
+    if days > 1:
+        ret += "%d days " % (days)
+    elif days == 1:
+        ret += "%d day " % (days)
+
+    if hours > 1:
+        ret += "%d hours " % (hours)
+    elif hours == 1:
+        ret += "%d hour " % (hours)
+
+    if minutes > 1:
+        ret += "%d minutes" % (minutes)
+    if minutes == 1:
+        ret += "%d minute" % (minutes)
+
+    if ret == '':
+        ret += "%d seconds" % (seconds)
+
+    return ret
+
+def format_short_duration(duration_sec):
+    """Format a duration compactly, e.g. 45s, 10m, 2h5m or 3d4h"""
+    minutes, seconds = divmod(int(duration_sec), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return "%dd%dh" % (days, hours) if hours else "%dd" % days
+    if hours:
+        return "%dh%dm" % (hours, minutes) if minutes else "%dh" % hours
+    if minutes:
+        return "%dm" % minutes
+    return "%ds" % seconds
+
+def config_path():
+    """Return the path of the configuration file"""
+    path = cfg.__file__
+    if path.endswith('.pyc') or path.endswith('.pyo'):
+        path = path[:-1]
+    return path
+
+def read_config(path):
+    """Run a configuration file and return its settings
+
+    Args:
+        path: Path of the configuration file.
+
+    Returns:
+        Dictionary mapping setting name to value.
+    """
+    namespace = dict()
+    with open(path, 'r') as config_file:
+        exec(compile(config_file.read(), path, 'exec'), namespace)
+    return dict((name, value) for name, value in namespace.items() if name.isupper())
+
+def validate_config(settings):
+    """Check the settings that would otherwise only fail once in use, such
+    as when an alert is sent
+
+    Args:
+        settings: Dictionary mapping setting name to value.
+
+    Raises:
+        ValueError describing every problem found.
+    """
+    errors = []
+    doors = settings.get('GARAGE_DOORS')
+    if not isinstance(doors, list):
+        raise ValueError("GARAGE_DOORS must be a list")
+
+    names = set()
+    channels = set()
+    for index, door in enumerate(doors):
+        if not isinstance(door, dict):
+            errors.append("door %d is not a dictionary" % index)
+            continue
+        name = door.get('name')
+        label = name if name is not None else "door %d" % index
+        missing = [key for key in ('name', 'pin', 'alerts') if key not in door]
+        if missing:
+            errors.append("%s: missing %s" % (label, ', '.join(missing)))
+            continue
+
+        if name in names:
+            errors.append("%s: duplicate name" % label)
+        names.add(name)
+
+        pin = door['pin']
+        if not isinstance(pin, int) or isinstance(pin, bool) or pin <= 0:
+            errors.append("%s: bad pin %r" % (label, pin))
+        elif settings.get('SENSOR_BACKEND', 'poll') == 'mmap' and pin not in BOARD_TO_BCM:
+            errors.append("%s: pin %d is not a GPIO pin" % (label, pin))
+
+        if 'filter' in door:
+            try:
+                create_door_filter(door['filter'])
+            except Exception as ex:
+                errors.append("%s: bad filter: %s" % (label, ex))
+
+        if not isinstance(door['alerts'], list):
+            errors.append("%s: alerts must be a list" % label)
+            continue
+        for alert in door['alerts']:
+            if not isinstance(alert, dict) or set(('state', 'time', 'recipients')) - set(alert):
+                errors.append("%s: alerts need a state, time and recipients" % label)
+            elif alert['state'] not in ('open', 'closed'):
+                errors.append("%s: bad alert state %r" % (label, alert['state']))
+            elif not isinstance(alert['time'], (int, float)):
+                errors.append("%s: bad alert time %r" % (label, alert['time']))
+            elif not isinstance(alert['recipients'], list):
+                errors.append("%s: alert recipients must be a list" % label)
+            else:
+                try:
+                    channels.update(target.channel for target in compile_recipients(alert['recipients']))
+                except ValueError as ex:
+                    errors.append("%s: %s" % (label, ex))
+    errors.extend(unconfigured_channels(channels, settings))
+
+    event_format = settings.get('MQTT_EVENT_FORMAT', 'json')
+    if event_format not in EventEncoder.FORMATS:
+        errors.append("MQTT_EVENT_FORMAT must be one of %s, not %r" % (', '.join(EventEncoder.FORMATS),
+                                                                      event_format))
+
+    for channel, limit in settings.get('ALERT_RATE_LIMITS', {}).items():
+        keys = ('burst', 'per_hour') + (('channel_per_hour',) if 'channel_burst' in limit else ())
+        if set(keys) - set(limit):
+            errors.append("ALERT_RATE_LIMITS: %s needs %s" % (channel, ', '.join(keys)))
+
+    if errors:
+        raise ValueError("Bad configuration: " + '; '.join(errors))
+
+def config_snapshot():
+    """Return a copy of the current settings, to compare against on a reload"""
+    snapshot = dict()
+    for name in dir(cfg):
+        if name.isupper():
+            try:
+                snapshot[name] = copy.deepcopy(getattr(cfg, name))
+            except (TypeError, copy.Error):
+                snapshot[name] = getattr(cfg, name)
+    return snapshot
+
+def apply_config(settings):
+    """Replace the settings in the configuration module"""
+    for name in dir(cfg):
+        if name.isupper() and name not in settings:
+            delattr(cfg, name)
+    for name, value in settings.items():
+        setattr(cfg, name, value)
+
+def setup_logging():
+    """Log to stdout when connected to a terminal, otherwise to LOG_FILENAME,
+    and also to LOG_JSON_FILENAME if set. Does nothing if logging has
+    already been set up.
+
+    Returns:
+        The LogWriter, to be stopped on exit, or None.
+    """
+    log_fmt = '%(asctime)-15s %(levelname)-8s %(message)s'
+    log_level = logging.INFO
+
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+
+    max_bytes = getattr(cfg, 'LOG_MAX_BYTES', 0)
+    backups = getattr(cfg, 'LOG_BACKUPS', 5)
+    compress = getattr(cfg, 'LOG_COMPRESS', False)
+
+    if sys.stdout.isatty():
+        # Connected to a real terminal - log to stdout
+        sinks = [LogStream(sys.stdout, logging.Formatter(log_fmt))]
+    else:
+        # Background mode - log to file
+        sinks = [LogFile(cfg.LOG_FILENAME, logging.Formatter(log_fmt), max_bytes, backups, compress)]
+
+    if getattr(cfg, 'LOG_JSON_FILENAME', None):
+        sinks.append(LogFile(cfg.LOG_JSON_FILENAME, JsonLogFormatter(), max_bytes, backups, compress))
+
+    writer = LogWriter(sinks, getattr(cfg, 'LOG_QUEUE_SIZE', 1000), getattr(cfg, 'LOG_FLUSH_INTERVAL', 1))
+    root.addHandler(LogQueueHandler(writer))
+    root.setLevel(log_level)
+    return writer
+
+##############################################################################
+# Hub mode
+##############################################################################
+
+class HubForwarder(object):
+    """Forwards door transitions to a hub.
+
+    Transitions are sent as JSON events, in the same format as alerts, by
+    UDP to HUB_FORWARD_ADDRESS and/or by MQTT to HUB_FORWARD_TOPIC. Door
+    names are prefixed with HUB_SITE and a slash so that doors from
+    different sites don't clash. Each event also carries "epoch", the
+    time.time() of the transition, since the local "timestamp" has no time
+    zone and only whole seconds.
+    """
+
+    def __init__(self, mqtt_sender=None):
+        """
+        Args:
+            mqtt_sender: Mqtt object to publish through, if HUB_FORWARD_TOPIC
+                         is set.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.site = getattr(cfg, 'HUB_SITE', socket.gethostname())
+        self.address = getattr(cfg, 'HUB_FORWARD_ADDRESS', None)
+        self.topic = getattr(cfg, 'HUB_FORWARD_TOPIC', None)
+        self.mqtt = mqtt_sender
+        self.sock = None
+        if self.address:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def door_changed(self, name, state, when, time_in_previous_state):
+        """Send a transition to the hub"""
+        event = EVENT_ENCODER.create("%s/%s" % (self.site, name), state, time_in_previous_state, when)
+        payload = '%s,"epoch":%.3f}' % (event.payload('json')[:-1], when)
+
+        if self.sock is not None:
+            try:
+                self.sock.sendto(payload.encode('utf-8'), self.address)
+            except socket.error as ex:
+                self.logger.error("Unable to forward event to hub: %s", ex)
+        if self.mqtt is not None and self.topic:
+            try:
+                self.mqtt.send(self.topic, payload, False)
+            except AlertError as ex:
+                self.logger.error("Unable to forward event to hub: %s", ex)
+
+    def alert_sent(self, name, state, alert_index, when):
+        """Alerts are decided by the hub"""
+        pass
+
+def parse_hub_event(payload, timestamps):
+    """Parse a JSON event forwarded by HubForwarder
+
+    The time of the transition is taken from "epoch". Events from
+    forwarders that don't send it fall back to "timestamp", read as the
+    hub's local time.
+
+    Args:
+        payload: Event as bytes or text.
+        timestamps: Dictionary caching parsed timestamps.
+
+    Returns:
+        (door name, state, time.time() of the transition) tuple.
+
+    Raises:
+        ValueError if the event is malformed.
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    event = json.loads(payload)
+    state = event['state']
+    if state not in ('open', 'closed'):
+        raise ValueError("Bad state: %s" % state)
+
+    if 'epoch' in event:
+        return event['door'], state, float(event['epoch'])
+
+    # Event timestamps are local time with one second resolution, and most
+    # events arrive within the same few seconds
+    stamp = event['timestamp']
+    when = timestamps.get(stamp)
+    if when is None:
+        if len(timestamps) > 1000:
+            timestamps.clear()
+        when = time.mktime(time.strptime(stamp, "%Y-%m-%dT%H:%M:%S"))
+        timestamps[stamp] = when
+    return event['door'], state, when
+
+def run_hub_shard(doors, default_alerts, events, alerts, processed):
+    """Main loop of a hub shard process.
+
+    Each shard runs a DoorMonitor for its share of the doors. Alerts are
+    passed back to the hub process, which owns the alert senders.
+
+    Args:
+        doors: HUB_DOORS entries that may be routed to this shard.
+        default_alerts: Alerts for doors not in HUB_DOORS.
+        events: multiprocessing.Queue of lists of (door, state, time)
+                tuples, or None to exit.
+        alerts: multiprocessing.Queue to put (recipients, subject, door,
+                state, time in state, time) tuples on.
+        processed: multiprocessing.Value counting processed events.
+    """
+    # Ctrl-C is handled by the hub process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def send(recipients, subject, event):
+        alerts.put((recipients, subject, event.door, event.state, event.time, event.stamp))
+
+    monitor = DoorMonitor(send)
+    known = dict((door['name'], door) for door in doors)
+
+    while True:
+        timeout = None
+        deadline = monitor.next_deadline()
+        if deadline is not None:
+            timeout = max(deadline - time.time(), 0)
+
+        try:
+            batch = events.get(timeout=timeout)
+        except queue.Empty:
+            batch = []
+        if batch is None:
+            return
+
+        now = time.time()
+        for name, state, when in batch:
+            when = min(when, now)
+            if name not in monitor.door_states:
+                monitor.add_door(known.get(name, {'name': name, 'alerts': default_alerts}), state, when)
+            elif when >= monitor.time_of_last_state_change[name]:
+                # Late events (e.g. reordered UDP) are ignored
+                monitor.update(name, state, when, now)
+        processed.value += len(batch)
+
+        monitor.run_due(now)
+
+class HubIngest(object):
+    """Receives forwarded events and routes them to the shards.
+
+    Events are routed by a hash of the door name, so every event for a door
+    goes to the same shard. They are passed on in batches of HUB_BATCH, or
+    every HUB_FLUSH_INTERVAL seconds, to keep the cost of the process queues
+    down.
+    """
+
+    def __init__(self, shard_queues):
+        """
+        Args:
+            shard_queues: multiprocessing.Queue of each shard.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.shard_queues = shard_queues
+        self.batch_size = getattr(cfg, 'HUB_BATCH', 100)
+        self.flush_interval = getattr(cfg, 'HUB_FLUSH_INTERVAL', 0.005)
+
+        self.lock = threading.Lock()
+        self.buffers = [[] for _ in shard_queues]
+        self.last_flush = time.time()
+        self.timestamps = dict()
+        self.received = 0
+        self.rejected = 0
+
+        self.stopping = threading.Event()
+        self.sock = None
+        port = getattr(cfg, 'HUB_UDP_PORT', None)
+        if port:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, getattr(cfg, 'HUB_UDP_RCVBUF', 4194304))
+            self.sock.bind((getattr(cfg, 'HUB_UDP_ADDRESS', '127.0.0.1'), port))
+            self.sock.settimeout(self.flush_interval)
+            self.logger.info("Listening for events on UDP port %d", self.sock.getsockname()[1])
+
+        self.thread = None
+
+    def add_payload(self, payload):
+        """Parse an event and queue it for its shard"""
+        try:
+            name, state, when = parse_hub_event(payload, self.timestamps)
+        except (ValueError, KeyError, TypeError):
+            # The UDP and MQTT threads both count events
+            with self.lock:
+                self.rejected += 1
+            self.logger.debug("Ignoring bad event: %r", payload)
+            return
+
+        shard = (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % len(self.buffers)
+        with self.lock:
+            self.received += 1
+            buf = self.buffers[shard]
+            buf.append((name, state, when))
+            if len(buf) >= self.batch_size:
+                self.shard_queues[shard].put(buf)
+                self.buffers[shard] = []
+
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Pass every buffered event on to its shard"""
+        with self.lock:
+            for shard, buf in enumerate(self.buffers):
+                if buf:
+                    self.shard_queues[shard].put(buf)
+                    self.buffers[shard] = []
+            self.last_flush = time.time()
+
+    def run(self):
+        """Ingest thread main loop"""
+        while not self.stopping.is_set():
+            if self.sock is None:
+                self.stopping.wait(self.flush_interval)
+                self.flush()
+                continue
+            try:
+                payload = self.sock.recv(65535)
+            except socket.timeout:
+                self.flush()
+                continue
+            self.add_payload(payload)
+
+    def start(self):
+        """Start receiving in the background"""
+        self.thread = threading.Thread(target=self.run, name="hub-ingest")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop receiving and pass on anything still buffered"""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        if self.sock is not None:
+            self.sock.close()
+
+class PiGarageAlertHub(object):
+    """Hub mode: evaluates alerts for doors reported by many Pis.
+
+    Events forwarded by HubForwarder are received by HubIngest and spread
+    over HUB_SHARDS processes, each running a DoorMonitor for its share of
+    the doors. Alerts from every shard are sent by one AlertDispatcher.
+    """
+
+    def __init__(self, sender_factories=None):
+        """
+        Args:
+            sender_factories: Dictionary mapping channel name to a function
+                              that creates its alert sending object, to use
+                              instead of the real senders.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.sender_factories = sender_factories or {}
+        self.stopping = threading.Event()
+        self.ingest = None
+        self.processed = []
+
+    def stop(self):
+        """Make main() clean up and return. May be called from any thread."""
+        self.stopping.set()
+
+    def events_processed(self):
+        """Return the number of events processed by the shards"""
+        return sum(value.value for value in self.processed)
+
+    def relay_alerts(self, alerts, dispatcher):
+        """Send the alerts decided by the shards"""
+        while True:
+            item = alerts.get()
+            if item is None:
+                return
+            recipients, subject, door, state, time_in_state, stamp = item
+            event = EVENT_ENCODER.create(door, state, time_in_state, stamp)
+            send_alerts(self.logger, dispatcher, recipients, subject, event)
+
+    def main(self):
+        """Main functionality of hub mode"""
+        log_writer = None
+        alert_senders = dict()
+        dispatcher = None
+        shards = []
+        shard_queues = []
+        alerts = multiprocessing.Queue()
+        relay = None
+        try:
+            log_writer = setup_logging()
 
-                # Poll every 1 second
-                time.sleep(1)
+            self.logger.info("==========================================================")
+            self.logger.info("Pi Garage Alert hub starting")
+
+            doors = getattr(cfg, 'HUB_DOORS', [])
+            default_alerts = getattr(cfg, 'HUB_DEFAULT_ALERTS', [])
+            EVENT_ENCODER.compile(doors)
+            RECIPIENTS.compile(doors + [{'name': 'HUB_DEFAULT_ALERTS', 'alerts': default_alerts}])
+
+            channels = referenced_channels(doors + [{'alerts': default_alerts}])
+            errors = unconfigured_channels(channels, vars(cfg))
+            if errors:
+                raise ValueError("Bad configuration: " + '; '.join(errors))
+            alert_senders = load_alert_senders(channels, {}, self.sender_factories)
+
+            outbox = None
+            if getattr(cfg, 'STATE_DIR', None):
+                outbox = AlertOutbox(os.path.join(cfg.STATE_DIR, 'hub_outbox.db'))
+            dispatcher = AlertDispatcher(alert_senders, outbox)
+
+            shard_count = getattr(cfg, 'HUB_SHARDS', 0) or multiprocessing.cpu_count()
+            self.processed = [multiprocessing.Value('L', 0, lock=False) for _ in range(shard_count)]
+            for index in range(shard_count):
+                events = multiprocessing.Queue()
+                shard = multiprocessing.Process(target=run_hub_shard, name="hub-shard-%d" % index,
+                                                args=(doors, default_alerts, events, alerts,
+                                                      self.processed[index]))
+                shard.daemon = True
+                shard.start()
+                shards.append(shard)
+                shard_queues.append(events)
+            self.logger.info("Started %d hub shards", shard_count)
+
+            relay = threading.Thread(target=self.relay_alerts, args=(alerts, dispatcher), name="hub-relay")
+            relay.daemon = True
+            relay.start()
+
+            self.ingest = HubIngest(shard_queues)
+            self.ingest.start()
+
+            # Events can also arrive by MQTT
+            topic = getattr(cfg, 'HUB_MQTT_TOPIC', None)
+            if topic and getattr(cfg, 'MQTT_HOST', ''):
+                import_mqtt()
+                client = mqtt.Client()
+                client.on_connect = lambda client, userdata, flags, rc: client.subscribe(topic)
+                client.on_message = lambda client, userdata, msg: self.ingest.add_payload(msg.payload)
+                if getattr(cfg, 'MQTT_USER', ''):
+                    client.username_pw_set(cfg.MQTT_USER, cfg.MQTT_PASSWORD)
+                client.connect_async(cfg.MQTT_HOST, getattr(cfg, 'MQTT_PORT', 1883))
+                client.loop_start()
+
+            last_received = 0
+            last_report = time.time()
+            while not self.stopping.wait(600):
+                now = time.time()
+                self.logger.info("Hub: %d events received (%.1f/s), %d processed, %d rejected, %s",
+                                 self.ingest.received, (self.ingest.received - last_received) / (now - last_report),
+                                 self.events_processed(), self.ingest.rejected, dispatcher.status())
+                last_received = self.ingest.received
+                last_report = now
         except KeyboardInterrupt:
             logging.critical("Terminating due to keyboard interrupt")
         except:
             logging.critical("Terminating due to unexpected error: %s", sys.exc_info()[0])
             logging.critical("%s", traceback.format_exc())
 
-        GPIO.cleanup()
-        alert_senders['Jabber'].terminate()
+        if self.ingest is not None:
+            self.ingest.stop()
+        for events in shard_queues:
+            events.put(None)
+        for shard in shards:
+            shard.join()
+        if relay is not None:
+            alerts.put(None)
+            relay.join()
+        if dispatcher is not None:
+            dispatcher.shutdown(getattr(cfg, 'ALERT_DRAIN_TIMEOUT', 30))
+        for sender in alert_senders.values():
+            if hasattr(sender, 'terminate'):
+                sender.terminate()
+        if log_writer is not None:
+            log_writer.stop()
+
+##############################################################################
+# Main functionality
+##############################################################################
+
+# Settings that a reload doesn't apply
+RESTART_SETTINGS = ('LOG_', 'STATE_DIR', 'JOURNAL_', 'EVENT_', 'TELEMETRY_', 'SENSOR_', 'HTTP_',
+                    'ALERT_WORKERS', 'ALERT_QUEUE_SIZE', 'ALERT_TIMEOUTS', 'BREAKER_', 'OUTBOX_', 'HUB_')
+
+class PiGarageAlert(object):
+    """Class with main function of Pi Garage Alert"""
+
+    def __init__(self, sender_factories=None):
+        """
+        Args:
+            sender_factories: Dictionary mapping channel name to a function
+                              that creates its alert sending object, to use
+                              instead of the real senders, e.g. in-process
+                              stand-ins for testing.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.sender_factories = sender_factories or {}
+        self.stopping = threading.Event()
+        self.sensor = None
+
+        # Pins configured on the sensor. Pins of removed doors stay
+        # configured, but are no longer read.
+        self.sensor_pins = set()
+
+        # Number of passes through the main loop
+        self.ticks = 0
+
+        # Set when the configuration should be reloaded
+        self.reload_requested = False
+        self.reload_signal = threading.Event()
+        self.settings = dict()
+
+    def stop(self):
+        """Make main() clean up and return. May be called from any thread."""
+        self.stopping.set()
+        if self.sensor is not None:
+            self.sensor.wake()
+
+    def request_reload(self):
+        """Make the main loop reload the configuration. May be called from
+        any thread, but not from a signal handler."""
+        self.reload_requested = True
+        if self.sensor is not None:
+            self.sensor.wake()
+
+    def handle_sighup(self, signum, frame):
+        """SIGHUP handler"""
+        # pylint: disable=unused-argument
+        # The sensor queue's lock may be held by the interrupted main loop,
+        # so waking it is left to wait_for_sighup()
+        self.reload_requested = True
+        self.reload_signal.set()
+
+    def handle_sigterm(self, signum, frame):
+        """SIGTERM handler"""
+        # pylint: disable=unused-argument
+        self.stopping.set()
+        self.reload_signal.set()
+
+    def wait_for_sighup(self):
+        """Thread that wakes the main loop after a SIGHUP or SIGTERM"""
+        while True:
+            self.reload_signal.wait()
+            self.reload_signal.clear()
+            if self.sensor is not None:
+                self.sensor.wake()
+
+    def reload_config(self, monitor, sensor, dispatcher, alert_senders, context):
+        """Reload the configuration file, reconfiguring only what changed.
+
+        Doors keep their state, timers and alert progress, and channels
+        whose settings didn't change keep their connections. If the new
+        configuration is invalid, the old one stays in use.
+
+        Args:
+            monitor: DoorMonitor.
+            sensor: SensorBackend.
+            dispatcher: AlertDispatcher.
+            alert_senders: Dictionary of alert sending objects, updated in place.
+            context: Dictionary passed to the channels' create functions.
+        """
+        start = time.time()
+        try:
+            settings = read_config(config_path())
+            validate_config(settings)
+            recipients = RecipientTable()
+            recipients.compile(settings.get('GARAGE_DOORS', []))
+        except:
+            self.logger.error("Not reloading configuration: %s", sys.exc_info()[1])
+            return
+
+        old = self.settings
+        changed = set(name for name in set(old) | set(settings)
+                      if old.get(name, None) != settings.get(name, None))
+        if not changed:
+            self.logger.info("Configuration unchanged")
+            return
+
+        old_targets = RECIPIENTS.targets
+        old_doors = monitor.save()
+        apply_config(settings)
+        RECIPIENTS.targets = recipients.targets
+        try:
+            summary = self.apply_changes(monitor, sensor, dispatcher, alert_senders, context, changed)
+        except:
+            # Pins the failed reload configured stay configured, but only
+            # the monitor's doors are read
+            self.logger.error("Reload failed, keeping the previous configuration: %s", sys.exc_info()[1])
+            self.logger.debug("%s", traceback.format_exc())
+            apply_config(old)
+            RECIPIENTS.targets = old_targets
+            monitor.restore(old_doors)
+            EVENT_ENCODER.compile(cfg.GARAGE_DOORS)
+            for listener in monitor.listeners:
+                if isinstance(listener, StatusFeed):
+                    listener.sync(monitor)
+            return
+
+        self.settings = config_snapshot()
+        self.logger.info("Reloaded configuration in %.1f ms: %s", (time.time() - start) * 1000, summary)
+
+        later = sorted(name for name in changed if name.startswith(RESTART_SETTINGS))
+        if later:
+            self.logger.warning("Changes to %s take effect after a restart", ', '.join(later))
+
+    def apply_changes(self, monitor, sensor, dispatcher, alert_senders, context, changed):
+        """Bring the doors and channels in line with the configuration that
+        reload_config() has just applied
+
+        Args:
+            changed: Names of the settings that changed.
+
+        Returns:
+            String summarizing the changes.
+        """
+        now = time.time()
+
+        # Doors
+        old_doors = dict(monitor.doors)
+        new_doors = dict((door['name'], door) for door in cfg.GARAGE_DOORS)
+        for name in old_doors:
+            if name not in new_doors:
+                monitor.remove_door(name)
+
+        new_pins = set(door['pin'] for door in cfg.GARAGE_DOORS) - self.sensor_pins
+        if new_pins:
+            sensor.add_pins(sorted(new_pins))
+            self.sensor_pins |= new_pins
+
+        added = []
+        updated = 0
+        for door in cfg.GARAGE_DOORS:
+            name = door['name']
+            old_door = old_doors.get(name)
+            if old_door is None:
+                monitor.add_door(door, sensor.read(door['pin']), now)
+                added.append(name)
+            elif door != old_door:
+                monitor.replace_door(door)
+                if door['pin'] != old_door['pin']:
+                    monitor.update(name, sensor.read(door['pin']), now, now)
+                if door.get('filter') != old_door.get('filter'):
+                    self.logger.warning("Filter change for \"%s\" takes effect after a restart", name)
+                updated += 1
+        EVENT_ENCODER.compile(cfg.GARAGE_DOORS)
+
+        # As at startup, a new door's first state is only recorded, not
+        # reported as a transition. This waits until every door is in place,
+        # so a failed reload leaves nothing to undo in the recorders.
+        recorders = [listener for listener in monitor.listeners
+                     if isinstance(listener, (StateJournal, HubForwarder)) or listener is alert_senders.get('Mqtt')]
+        for name in added:
+            for listener in recorders:
+                listener.door_changed(name, monitor.door_states[name], now, 0)
+
+        # Channels
+        channels = enabled_channels(cfg.GARAGE_DOORS)
+        restart = set(name for name in alert_senders
+                      if name in channels and any(setting.startswith(ALERT_CHANNELS[name].settings)
+                                                  for setting in changed))
+        removed = set(alert_senders) - channels
+        try:
+            new_senders = load_alert_senders((channels - set(alert_senders)) | restart, context,
+                                             self.sender_factories)
+        except:
+            self.logger.error("Not changing alert channels: %s", sys.exc_info()[1])
+            new_senders = dict()
+            restart = removed = set()
+
+        stale = []
+        for name in removed | restart:
+            sender = alert_senders[name]
+            if sender in monitor.listeners:
+                monitor.listeners.remove(sender)
+            stale.append(sender)
+        # alert_senders is shared with the dispatcher, which updates it
+        for name in removed:
+            dispatcher.remove_channel(name)
+        for name, sender in new_senders.items():
+            dispatcher.set_sender(name, sender)
+        if 'Mqtt' in new_senders:
+            monitor.listeners.append(new_senders['Mqtt'])
+        for listener in monitor.listeners:
+            if isinstance(listener, HubForwarder):
+                listener.mqtt = alert_senders.get('Mqtt')
+            if isinstance(listener, StatusFeed):
+                listener.sync(monitor)
+
+        # Closing connections can be slow, so it is done in the background
+        if stale:
+            closer = threading.Thread(target=lambda: [sender.terminate() for sender in stale
+                                                      if hasattr(sender, 'terminate')],
+                                      name="reload-close")
+            closer.daemon = True
+            closer.start()
+
+        dispatcher.throttle.configure(getattr(cfg, 'ALERT_RATE_LIMITS', {}),
+                                      getattr(cfg, 'ALERT_DIGEST_WINDOW', {}))
+
+        return "%d doors added, %d removed, %d changed, channels started: %s, stopped: %s" % (
+            len(added), len(set(old_doors) - set(new_doors)), updated,
+            ', '.join(sorted(new_senders)) or 'none', ', '.join(sorted(removed)) or 'none')
+
+    def main(self):
+        """Main functionality
+        """
+
+        sensor = None
+        log_writer = None
+        alert_senders = dict()
+        dispatcher = None
+        journal = None
+        history = None
+        analytics = None
+        endpoint = None
+        feed = None
+        try:
+            log_writer = setup_logging()
+
+            # Banner
+            self.logger.info("==========================================================")
+            self.logger.info("Pi Garage Alert starting")
+
+            # Check the doors and settings before touching the hardware
+            validate_config(vars(cfg))
+
+            # Configure the sensor pins
+            sensor_backend = getattr(cfg, 'SENSOR_BACKEND', 'poll')
+            self.logger.info("Configuring %s sensor backend", sensor_backend)
+            sensor = create_sensor_backend(sensor_backend)
+
+            # Debounce the doors that have a filter configured
+            filters = dict()
+            for door in cfg.GARAGE_DOORS:
+                if 'filter' in door:
+                    filters[door['pin']] = create_door_filter(door['filter'])
+            if filters:
+                sensor = FilteredSensor(sensor, filters)
+
+            for door in cfg.GARAGE_DOORS:
+                self.logger.info("Configuring pin %d for \"%s\"", door['pin'], door['name'])
+            sensor.setup([door['pin'] for door in cfg.GARAGE_DOORS])
+            self.sensor = sensor
+            self.sensor_pins = set(door['pin'] for door in cfg.GARAGE_DOORS)
+
+            # Sample temperatures and uptime in the background
+            TELEMETRY.start()
+
+            # Compile the event templates for every door up front
+            EVENT_ENCODER.compile(cfg.GARAGE_DOORS)
+
+            # Check every alert recipient before monitoring starts
+            RECIPIENTS.compile(cfg.GARAGE_DOORS)
+
+            # Tracks door states and decides when alerts are due
+            monitor = DoorMonitor(lambda recipients, subject, msg:
+                                  send_alerts(self.logger, dispatcher, recipients, subject, msg))
+
+            # Restore door states and alert progress from before a restart
+            restored = dict()
+            if getattr(cfg, 'STATE_DIR', None):
+                journal = StateJournal(cfg.STATE_DIR)
+                restored = journal.load()
+                monitor.listeners.append(journal)
+
+                # Every transition and alert is also kept for history queries
+                history = EventHistory(os.path.join(cfg.STATE_DIR, 'events'))
+                monitor.listeners.append(history)
+
+            # Usage statistics for each door, kept across restarts if possible
+            analytics = DoorAnalytics(os.path.join(cfg.STATE_DIR, 'analytics.json')
+                                      if getattr(cfg, 'STATE_DIR', None) else None)
+            monitor.listeners.append(analytics)
+
+            # Create alert sending objects for the channels that are used.
+            # Jabber answers queries about the doors from the context.
+            channels = enabled_channels(cfg.GARAGE_DOORS)
+            context = {
+                'door_states': monitor.door_states,
+                'time_of_last_state_change': monitor.time_of_last_state_change,
+                'history': history,
+                'analytics': analytics,
+            }
+            alert_senders = load_alert_senders(channels, context, self.sender_factories)
+
+            # Alerts are sent on background threads so the sensor loop
+            # never waits on the network, and kept in the outbox until sent
+            outbox = None
+            if getattr(cfg, 'STATE_DIR', None):
+                outbox = AlertOutbox(os.path.join(cfg.STATE_DIR, 'outbox.db'))
+            dispatcher = AlertDispatcher(alert_senders, outbox)
+
+            # Door states are published to retained MQTT topics
+            if 'Mqtt' in alert_senders:
+                monitor.listeners.append(alert_senders['Mqtt'])
+
+            # Transitions are forwarded to a hub
+            forwarder = None
+            if getattr(cfg, 'HUB_FORWARD_ADDRESS', None) or getattr(cfg, 'HUB_FORWARD_TOPIC', None):
+                forwarder = HubForwarder(alert_senders.get('Mqtt'))
+                monitor.listeners.append(forwarder)
+
+            # Prometheus metrics for local monitoring
+            METRICS.gauge('pi_garage_alert_queue_depth', "Alerts waiting to be sent",
+                          lambda: [((name,), channel.jobs.qsize())
+                                   for name, channel in sorted(dispatcher.channels.items())],
+                          ('channel',))
+            METRICS.gauge('pi_garage_door_open', "1 if the door is open, 0 if it is closed",
+                          lambda: [((name,), int(state == 'open'))
+                                   for name, state in sorted(monitor.door_states.items())],
+                          ('door',))
+            METRICS.gauge('pi_garage_door_state_seconds', "Time since the door last changed state",
+                          lambda: [((name,), round(time.time() - when, 3))
+                                   for name, when in sorted(monitor.time_of_last_state_change.items())],
+                          ('door',))
+            if getattr(cfg, 'HTTP_PORT', None):
+                endpoint = HttpEndpoint(getattr(cfg, 'HTTP_ADDRESS', '127.0.0.1'), cfg.HTTP_PORT)
+                endpoint.add_route('/metrics', lambda request: (
+                    200, 'text/plain; version=0.0.4', METRICS.render()))
+
+                # Door states for dashboards
+                feed = StatusFeed(getattr(cfg, 'HTTP_EVENT_BACKLOG', 100), getattr(cfg, 'HTTP_KEEPALIVE', 30))
+                endpoint.add_route('/status', feed.status_page)
+                endpoint.add_route('/events', feed.events_page)
+                endpoint.add_route('/analytics', analytics.analytics_page)
+                endpoint.start()
+                monitor.listeners.append(feed)
+
+            # Read initial states
+            doors_by_pin = dict()
+            for door in cfg.GARAGE_DOORS:
+                name = door['name']
+                state = sensor.read(door['pin'])
+                now = time.time()
+
+                if name in restored:
+                    # Picks up where we left off. If the door changed while
+                    # we were down, update() handles it like any transition.
+                    old_state, when, alert_index = restored[name]
+                    monitor.add_door(door, old_state, when, alert_index)
+                    monitor.update(name, state, now, now)
+                else:
+                    monitor.add_door(door, state, now)
+                    if journal is not None:
+                        journal.door_changed(name, state, now, 0)
+                doors_by_pin.setdefault(door['pin'], []).append(door)
+
+                self.logger.info("Initial state of \"%s\" is %s", name, state)
+
+                if 'Mqtt' in alert_senders:
+                    alert_senders['Mqtt'].door_changed(name, state, now, 0)
+                if forwarder is not None:
+                    forwarder.door_changed(name, state, now, 0)
+
+            if feed is not None:
+                feed.sync(monitor)
+
+            next_status_report = time.time() + 5
+            next_resync = None
+            if sensor.resync_interval:
+                next_resync = time.time() + sensor.resync_interval
+
+            # Reload the configuration on SIGHUP, and stop cleanly on SIGTERM
+            self.settings = config_snapshot()
+            try:
+                signal.signal(signal.SIGHUP, self.handle_sighup)
+                signal.signal(signal.SIGTERM, self.handle_sigterm)
+                waker = threading.Thread(target=self.wait_for_sighup, name="sighup")
+                waker.daemon = True
+                waker.start()
+            except ValueError:
+                # Signals can only be handled by the main thread
+                self.logger.info("Not running in the main thread - SIGHUP and SIGTERM not handled")
+
+            changes = dict()
+            while not self.stopping.is_set():
+                self.ticks += 1
+
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload_config(monitor, sensor, dispatcher, alert_senders, context)
+                    doors_by_pin = dict()
+                    for door in monitor.doors.values():
+                        doors_by_pin.setdefault(door['pin'], []).append(door)
+
+                now = time.time()
+
+                # Only read the sensors that reported a transition, unless
+                # the backend needs every sensor read
+                pins = changes
+                if sensor.resync_interval == 0:
+                    pins = doors_by_pin
+                elif next_resync is not None and now >= next_resync:
+                    pins = doors_by_pin
+                    next_resync = now + sensor.resync_interval
+
+                if pins:
+                    read_start = time.time()
+                    states = sensor.read_all(pins)
+                    GPIO_READ_SECONDS.observe(time.time() - read_start)
+                    for pin, state in states.items():
+                        for door in doors_by_pin.get(pin, ()):
+                            # Edge driven backends report when the transition happened
+                            monitor.update(door['name'], state, changes.get(pin, now), now)
+
+                monitor.run_due(now)
+
+                # Periodically log the status for debug and ensuring RPi doesn't get too hot
+                if now >= next_status_report:
+                    status_msg = rpi_status()
+                    status_msg += ", " + monitor.status(time.time())
+                    status_msg += ", " + dispatcher.status()
+                    status_msg += ", " + analytics.status()
+                    if log_writer is not None:
+                        status_msg += ", " + log_writer.status()
+                    for _, sender in sorted(alert_senders.items()):
+                        if hasattr(sender, 'status'):
+                            status_msg += ", " + sender.status()
+
+                    self.logger.info(status_msg)
+                    analytics.save()
+
+                    next_status_report = now + 600
+
+                LOOP_SECONDS.observe(time.time() - now)
+
+                # Sleep until a door changes state, an alert is due or the
+                # backend's poll interval expires
+                next_deadline = next_status_report
+                for deadline in (monitor.next_deadline(), next_resync):
+                    if deadline is not None and deadline < next_deadline:
+                        next_deadline = deadline
+
+                changes = sensor.wait(next_deadline - time.time())
+        except KeyboardInterrupt:
+            logging.critical("Terminating due to keyboard interrupt")
+        except:
+            logging.critical("Terminating due to unexpected error: %s", sys.exc_info()[0])
+            logging.critical("%s", traceback.format_exc())
+
+        if feed is not None:
+            feed.stop()
+        if endpoint is not None:
+            endpoint.stop()
+        if sensor is not None:
+            sensor.cleanup()
+        TELEMETRY.stop()
+        if journal is not None:
+            journal.close()
+        if history is not None:
+            history.close()
+        if analytics is not None:
+            analytics.save()
+        if dispatcher is not None:
+            dispatcher.shutdown(getattr(cfg, 'ALERT_DRAIN_TIMEOUT', 30))
+        for sender in alert_senders.values():
+            if hasattr(sender, 'terminate'):
+                sender.terminate()
+        if log_writer is not None:
+            log_writer.stop()
 
 if __name__ == "__main__":
-    PiGarageAlert().main()
+    if '--hub' in sys.argv[1:]:
+        PiGarageAlertHub().main()
+    else:
+        PiGarageAlert().main()
@@ -4,11 +4,20 @@
 # Global settings
 ##############################################################################
 
+# Changes to this file are picked up without a restart by sending the daemon
+# a SIGHUP ("service pi_garage_alert reload"). Doors, alerts and the alert
+# channel settings are reloaded; doors keep their state and channels whose
+# settings are unchanged keep their connections. Other settings, and door
+# filters, need a restart; the log lists any that were changed. If the new
+# file is invalid, or applying it fails, the previous doors and settings stay
+# in use.
+
 # Describes all the garage doors being monitored
 GARAGE_DOORS = [
 #    {
 #        'pin': 16,
 #        'name': "Garage Door 1",
+#        'filter': { 'type': 'stable', 'time': 0.2 },
 #        'alerts': [
 #            {
 #                'state': 'open',
@@ -44,6 +53,261 @@ GARAGE_DOORS = [
 # All messages will be logged to stdout and this file
 LOG_FILENAME = "/var/log/pi_garage_alert.log"
 
+# Uncomment to also log to this file as JSON lines, one object per message
+#LOG_JSON_FILENAME = "/var/log/pi_garage_alert.json"
+
+# Log files are renamed to .1, .2 and so on once they are LOG_MAX_BYTES
+# long, keeping LOG_BACKUPS old files, which are gzipped if LOG_COMPRESS is
+# set. Set LOG_MAX_BYTES to 0 to leave rotation to logrotate.
+LOG_MAX_BYTES = 1048576
+LOG_BACKUPS = 5
+LOG_COMPRESS = True
+
+# Messages are written by a background thread, at most once every
+# LOG_FLUSH_INTERVAL seconds, so the SD card never holds up the door sensors.
+# If more than LOG_QUEUE_SIZE messages are waiting, messages are dropped and
+# the number dropped is logged.
+LOG_FLUSH_INTERVAL = 1
+LOG_QUEUE_SIZE = 1000
+
+# Door states and alert progress are kept here so they survive a restart.
+# Comment out to start from scratch on every restart.
+STATE_DIR = "/var/lib/pi_garage_alert"
+
+# Journal records are written to the SD card in batches this many seconds
+# apart. A crash loses at most this much state.
+JOURNAL_SYNC_INTERVAL = 5
+
+# The journal is compacted into a snapshot after this many records
+JOURNAL_COMPACT_RECORDS = 1000
+
+# Every transition and alert is also kept in STATE_DIR/events, and can be
+# queried over Jabber with "history". Files are EVENT_SEGMENT_BYTES long and
+# are deleted once they are older than EVENT_RETENTION_DAYS. Records are
+# written by a background thread; if more than EVENT_QUEUE_SIZE are waiting,
+# the rest are dropped.
+EVENT_SEGMENT_BYTES = 1048576
+EVENT_RETENTION_DAYS = 365
+EVENT_QUEUE_SIZE = 1000
+
+# Usage statistics for each door (open and close counts, how long it is left
+# open and when it is opened) are kept in STATE_DIR/analytics.json. They are
+# logged with the status report, can be queried over Jabber with "stats" and
+# are served as JSON on /analytics when HTTP_PORT is set.
+
+# CPU/GPU temperature and uptime are sampled this many seconds apart, and
+# the last TELEMETRY_HISTORY samples are kept in memory
+TELEMETRY_INTERVAL = 60
+TELEMETRY_HISTORY = 60
+
+##############################################################################
+# Sensor settings
+##############################################################################
+
+# How the door sensors are read:
+#   'poll'      - read every sensor once every SENSOR_POLL_INTERVAL seconds
+#   'edge'      - sleep until a sensor changes or an alert is due
+#   'simulated' - no hardware needed; pin levels are changed by writing
+#                 "<pin> <level>" lines to SENSOR_SIM_FIFO
+#   'mmap'      - read every sensor at once from the GPIO level register
+#                 through SENSOR_GPIOMEM every SENSOR_POLL_INTERVAL seconds,
+#                 waking only when a door changes. Cheap enough for
+#                 intervals of a few milliseconds. Raspberry Pi 1 to 4 only.
+SENSOR_BACKEND = 'poll'
+
+# Seconds between reads in 'poll' and 'mmap' mode
+SENSOR_POLL_INTERVAL = 1
+
+# Memory mapped GPIO registers for 'mmap' mode, and the byte offset of the
+# pin level register (GPLEV0) in them. Any file can be used for testing.
+SENSOR_GPIOMEM = '/dev/gpiomem'
+SENSOR_GPIO_LEVEL_OFFSET = 0x34
+
+# Edges closer together than this are ignored in 'edge' mode
+SENSOR_BOUNCE_MS = 50
+
+# In 'edge' and 'mmap' mode, sensors are still all read this often in case
+# a transition is missed
+SENSOR_RESYNC_INTERVAL = 60
+
+#SENSOR_SIM_FIFO = '/tmp/pi_garage_alert_sim'
+
+# A door can debounce its sensor by adding a 'filter' entry, which is one of:
+#   { 'type': 'majority', 'samples': 5, 'required': 4 }
+#       - change once 'required' of the last 'samples' readings agree
+#         ('required' defaults to a simple majority)
+#   { 'type': 'stable', 'time': 0.2 }
+#       - change once the reading has been steady for 'time' seconds
+#   { 'type': 'schmitt', 'threshold': 3 }
+#       - count up on open readings and down on closed readings, changing
+#         when the count reaches 'threshold' or 0
+# Filtered sensors are sampled every SENSOR_SAMPLE_INTERVAL seconds.
+# bench/check_filters.py shows what each filter makes of the bounce traces
+# in bench/traces/.
+SENSOR_SAMPLE_INTERVAL = 0.02
+
+##############################################################################
+# Alert dispatch settings
+##############################################################################
+
+# Number of threads sending alerts for each channel. Channels not listed
+# get one thread. This is also the number of recipients of an alert that
+# are sent to at once, e.g. the SMS recipients of an alert are sent up to
+# four at a time over connections kept open to Twilio.
+ALERT_WORKERS = {
+    'Email': 1,
+    'Twilio': 4,
+}
+
+# Maximum number of alerts waiting to be sent on each channel. Alerts are
+# dropped (and logged) once a channel's queue is full.
+ALERT_QUEUE_SIZE = 100
+
+# On shutdown, wait this many seconds for queued alerts to be sent
+ALERT_DRAIN_TIMEOUT = 30
+
+# Network timeout in seconds for each channel's requests. For MQTT this is
+# how long an alert waits for the broker's acknowledgement. Channels not
+# listed use 10 seconds.
+ALERT_TIMEOUTS = {
+    'Email': 10,
+    'Mqtt': 10,
+    'Twilio': 10,
+    'Twitter': 10,
+}
+
+# After BREAKER_FAILURES failed sends in a row, a channel's circuit breaker
+# opens and its alerts are held in the outbox without trying the network.
+# After BREAKER_COOLDOWN seconds one alert is let through to see whether the
+# channel has recovered.
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 60
+
+# A configuration that sends alerts to a channel whose settings below are
+# left blank, e.g. sms: recipients without TWILIO_ACCOUNT, is refused at
+# startup and on a reload. Alerts a channel rejects for good, such as an SMS
+# to a number Twilio won't accept or an email every recipient of which is
+# refused with a 5xx code, are not retried and don't trip the breaker.
+
+# Both of the following are off unless uncommented. They trade latency for
+# volume: with them, a burst of alerts turns into a few messages, but some
+# alerts are delayed, and several alerts are merged into one message.
+
+# Rate limits for each recipient of a channel: up to 'burst' messages at
+# once, refilled at 'per_hour' messages an hour. 'channel_burst' and
+# 'channel_per_hour' optionally limit the channel as a whole as well.
+# Alerts over the limit are not dropped; they are held and merged into a
+# digest that is sent as soon as the limit allows.
+#ALERT_RATE_LIMITS = {
+#    'Twilio': { 'burst': 5, 'per_hour': 20, 'channel_burst': 20, 'channel_per_hour': 100 },
+#    'Twitter': { 'burst': 5, 'per_hour': 30 },
+#}
+
+# After an alert is sent to a recipient, further alerts to the same
+# recipient within this many seconds are held and sent together as one
+# digest at the end of the window. A longer window means fewer messages,
+# but follow-up alerts may arrive up to this much later. The first alert is
+# never delayed.
+# An email digest lists every alert. SMS and Twitter digests list the
+# latest state of each door instead, e.g. "Door 1 open 10m, Door 2 open
+# 12m", split over several messages if they don't fit in one.
+# MQTT_EVENT_FORMAT events are never held or merged, and are not subject to
+# ALERT_RATE_LIMITS either.
+#ALERT_DIGEST_WINDOW = {
+#    'Twilio': 60,
+#    'Twitter': 60,
+#    'Email': 30,
+#}
+
+# Alerts are kept in STATE_DIR/outbox.db until they have been sent, so they
+# survive network outages and restarts. This includes alerts held for a
+# digest or by a rate limit. A failed alert is retried up to
+# OUTBOX_MAX_ATTEMPTS times, waiting OUTBOX_RETRY_BASE seconds after the
+# first failure and twice as long after each one after that, up to
+# OUTBOX_RETRY_MAX seconds. After a restart, waiting alerts are sent
+# OUTBOX_BATCH at a time.
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE = 30
+OUTBOX_RETRY_MAX = 1800
+OUTBOX_BATCH = 20
+
+# Sent and failed alerts are removed from the outbox after this many days
+OUTBOX_RETENTION_DAYS = 7
+
+##############################################################################
+# HTTP settings
+##############################################################################
+
+# Uncomment HTTP_PORT to serve Prometheus metrics at
+# http://HTTP_ADDRESS:HTTP_PORT/metrics. The HTTP server is off by default.
+# There is no authentication, so only listen on other addresses (e.g.
+# '0.0.0.0') on a trusted network.
+HTTP_ADDRESS = '127.0.0.1'
+#HTTP_PORT = 9787
+
+# /status returns the state of every door as JSON, and /events is a
+# Server-Sent Events stream of door transitions and alerts. The last
+# HTTP_EVENT_BACKLOG events are kept for clients that reconnect, and idle
+# streams get a keep-alive comment every HTTP_KEEPALIVE seconds.
+# /analytics returns the usage statistics of every door as JSON.
+HTTP_EVENT_BACKLOG = 100
+HTTP_KEEPALIVE = 30
+
+##############################################################################
+# Hub settings
+##############################################################################
+
+# Door transitions can be forwarded to a hub, which decides alerts for the
+# doors of many Pis. Events use the same JSON format as alerts, with door
+# names prefixed by HUB_SITE and a slash, and an "epoch" field holding the
+# time of the transition in seconds since 1970 (UTC), so the Pis and the hub
+# may be in different time zones. "timestamp" is the Pi's local time, for
+# display.
+
+# Uncomment to forward by UDP and/or by MQTT (using the MQTT settings below)
+#HUB_FORWARD_ADDRESS = ('hub.example.com', 9788)
+#HUB_FORWARD_TOPIC = 'garage/events'
+
+# Name of this site. Defaults to the host name.
+#HUB_SITE = 'home'
+
+# The following are used by the hub, which is started with
+# "pi_garage_alert.py --hub".
+
+# UDP address and port to receive events on, and the MQTT topic to
+# subscribe to. Events are not authenticated, and anyone who can send them
+# can trigger alerts, so only listen on other addresses (e.g. '0.0.0.0') on
+# a trusted network.
+HUB_UDP_ADDRESS = '127.0.0.1'
+HUB_UDP_PORT = 9788
+#HUB_MQTT_TOPIC = 'garage/events'
+
+# Doors and their alerts, like GARAGE_DOORS but without pins and with
+# names of the form "site/door name"
+HUB_DOORS = [
+#    {
+#        'name': "home/Garage Door 1",
+#        'alerts': [
+#            {
+#                'state': 'open',
+#                'time': 600,
+#                'recipients': [ 'sms:+11112223333' ]
+#            }
+#        ]
+#    },
+]
+
+# Alerts for doors that aren't listed in HUB_DOORS
+HUB_DEFAULT_ALERTS = []
+
+# Number of processes evaluating alerts. 0 uses one per CPU core.
+HUB_SHARDS = 0
+
+# Events are passed to the shard processes in batches of up to HUB_BATCH,
+# at least every HUB_FLUSH_INTERVAL seconds
+HUB_BATCH = 100
+HUB_FLUSH_INTERVAL = 0.005
+
 ##############################################################################
 # Email settings
 ##############################################################################
@@ -52,6 +316,19 @@ SMTP_SERVER = 'localhost'
 SMTP_PORT = 25
 EMAIL_FROM = 'Garage Door <user@example.com>'
 
+# Uncomment to use STARTTLS and log in to the SMTP server
+
+#SMTP_STARTTLS = True
+#SMTP_USER = ''
+#SMTP_PASSWORD = ''
+
+# SMTP sessions are kept open between alerts. A session idle for longer than
+# SMTP_NOOP_AFTER seconds is checked with NOOP before reuse, and one idle for
+# longer than SMTP_IDLE_TIMEOUT seconds is closed and reopened.
+
+SMTP_NOOP_AFTER = 15
+SMTP_IDLE_TIMEOUT = 240
+
 ##############################################################################
 # Twitter settings
 ##############################################################################
@@ -77,6 +354,9 @@ TWILIO_TOKEN = ''
 # SMS will be sent from this phone number
 TWILIO_PHONE_NUMBER = '+11234567890'
 
+# Address of the Twilio REST API, which can be changed for testing
+#TWILIO_API_URL = 'https://api.twilio.com'
+
 ##############################################################################
 # Jabber settings
 ##############################################################################
@@ -96,6 +376,12 @@ JABBER_PASSWORD = ''
 
 JABBER_AUTHORIZED_IDS = []
 
+# The daemon keeps running while the Jabber server is unreachable, retrying
+# with exponential backoff up to JABBER_RECONNECT_MAX seconds apart. Alerts
+# wait in the outbox until the connection comes back.
+
+JABBER_RECONNECT_MAX = 300
+
 ##############################################################################
 # MQTT settings
 ##############################################################################
@@ -104,3 +390,28 @@ MQTT_HOST = ''
 
 #MQTT_HOST = 'test.mosquitto.org'
 
+MQTT_PORT = 1883
+MQTT_USER = ''
+MQTT_PASSWORD = ''
+
+# Quality of service for published messages (0, 1 or 2)
+MQTT_QOS = 1
+
+# Alerts published while the broker is unreachable wait in the outbox until
+# it comes back. Only the latest state of each door is kept for
+# MQTT_STATE_TOPIC.
+
+# Uncomment to publish the state of every door ('open' or 'closed') as a
+# retained message. %s is replaced with the door name.
+#MQTT_STATE_TOPIC = 'garage/%s/state'
+
+# Format of events published to mqtt: recipients. One of:
+#   'json'    - same JSON text as the other channels
+#   'msgpack' - MessagePack map with the same fields
+#   'binary'  - 11 bytes: timestamp (uint32), door index in GARAGE_DOORS
+#               (uint16), state (uint8, 1 = open), seconds in state (uint32),
+#               all in network byte order. In hub mode the index is into
+#               HUB_DOORS, and doors that aren't listed there have index
+#               65535. Indexes follow the list, so they shift when a door
+#               is added or removed above another on a reload.
+MQTT_EVENT_FORMAT = 'json'